@@ -5,10 +5,8 @@ from common.model.deeplearning.prediction.PredictionsSummary import PredictionsS
 
 class CatsVsDogsCsvWriter:
     @staticmethod
+    # prediction_summaries can be a generator, so records get built while predictions are still streaming in
     def write_predictions_for_class_id_to_csv(prediction_summaries: [PredictionsSummary], class_id):
-        if len(prediction_summaries) == 0:
-            return
-
         records = []
 
         for prediction_summary in prediction_summaries:
@@ -17,6 +15,9 @@ class CatsVsDogsCsvWriter:
             clipped_confidence = 0.01 if confidence < 0.01 else (0.99 if confidence > 0.99 else confidence)
             records.append({'id': test_id, 'label': clipped_confidence})
 
+        if len(records) == 0:
+            return
+
         df = pd.DataFrame.from_records(records)
         df['id'] = pd.to_numeric(df['id'])
         df = df.sort_values('id')
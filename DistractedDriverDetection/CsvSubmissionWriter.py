@@ -7,10 +7,8 @@ import numpy as np
 
 class CsvSubmissionWritter:
     @staticmethod
+    # pred_summaries can be a generator, so records get built while predictions are still streaming in
     def write_predictions_to_csv(pred_summaries: [PredictionsSummary]):
-        if len(pred_summaries) == 0:
-            return
-
         records = []
 
         for pred_summary in pred_summaries:
@@ -31,6 +29,9 @@ class CsvSubmissionWritter:
 
             records.append(row)
 
+        if len(records) == 0:
+            return
+
         df = pd.DataFrame.from_records(records)
         df = df.sort_values('img')
         df.to_csv('submission.csv', index=False)
@@ -4,13 +4,13 @@ import os
 import pandas as pd
 from common.setup.DataSetup import DataSetup
 from common.setup.ImagesDirectoryCreationMode import ImagesDirectoryCreationMode
-import shutil
 from numpy.random import permutation
 
 
 class DistractedDriverDataSetup(DataSetup):
-    def __init__(self):
-        super(DistractedDriverDataSetup, self).__init__()
+    def __init__(self, num_workers: int = None, allow_hardlinks: bool = False,
+                 creation_mode: ImagesDirectoryCreationMode = ImagesDirectoryCreationMode.COPY, num_augmentation_workers: int = None):
+        super(DistractedDriverDataSetup, self).__init__(num_workers, allow_hardlinks, creation_mode, num_augmentation_workers)
 
     #Creating validation set with different drivers rather than randomly moved images, to reduce overfitting when running
     #validation tests
@@ -24,17 +24,20 @@ class DistractedDriverDataSetup(DataSetup):
         image_to_driver = image_to_driver_csv.set_index('img')['subject'].to_dict()
         training_directory=DataSetup._cleanup_directory_path(training_directory)
         valid_directory=DataSetup._cleanup_directory_path(valid_directory)
-        DataSetup._establish_directory_if_needed(valid_directory)
-        source_sub_directories = DataSetup._get_sub_directories(training_directory)
+        self._establish_directory_if_needed(valid_directory)
+        source_sub_directories = self._get_sub_directories(training_directory)
+        operations = []
 
         for source_sub_directory in source_sub_directories:
             destination_sub_directory = str.replace(source_sub_directory, training_directory, valid_directory)
-            DataSetup._establish_directory_if_needed(destination_sub_directory)
-            source_images = DataSetup._get_files_with_extension(source_sub_directory, image_file_extension)
+            self._establish_directory_if_needed(destination_sub_directory)
+            source_images = self._get_files_with_extension(source_sub_directory, image_file_extension)
             images_to_move_or_copy = [image for image in source_images if image_to_driver[os.path.basename(image)] in validation_drivers]
 
             for source_image_to_move_or_copy in images_to_move_or_copy:
                 new_image_path = str.replace(source_image_to_move_or_copy, training_directory, valid_directory)
-                shutil.move(source_image_to_move_or_copy, new_image_path)
+                operations.append((source_image_to_move_or_copy, new_image_path, ImagesDirectoryCreationMode.MOVE))
+
+        self._execute_operations(operations)
 
 
@@ -11,9 +11,13 @@ from DistractedDriverDetection.DistractedDriverDataSetup import DistractedDriver
 from DistractedDriverDetection.CsvSubmissionWriter import CsvSubmissionWritter
 from common.model.deeplearning.prediction.PredictionsSummary import PredictionsSummary
 from common.model.deeplearning.imagerec.MasterImageClassifier import MasterImageClassifier
+from common.model.deeplearning.imagerec.optimization.BatchSizeTuner import BatchSizeTuner
+from common.model.deeplearning.imagerec.optimization.CropPolicy import CropPolicy
+from common.model.deeplearning.imagerec.optimization.CropPolicyEvaluator import CropPolicyEvaluator
 from common.model.deeplearning.imagerec.pretrained import vgg16
 from common.model.deeplearning.imagerec.pretrained.vgg16 import Vgg16
 from common.setup.DataSetup import DataSetup
+from common.setup.ImagesDirectoryCreationMode import ImagesDirectoryCreationMode
 from common.utils import utils
 from common.visualization.ImagePerformanceVisualizer import ImagePerformanceVisualizer
 from theano import config as theano_config
@@ -25,15 +29,33 @@ theano_config.exception_verbosity = 'high'
 run_main_test = True
 refine_training = False
 image_splitting = False
+# With image splitting, images whose full image prediction is at least this confident aren't cropped
+image_splitting_early_exit_confidence = 0.98
 visualize_performance = True
 visualization_class = 'c0'
 use_sample = False
 number_of_epochs = 100
+# With auto tuning, these are replaced by the fastest batch sizes that fit the memory budget on this machine (probed
+# once per machine, the first time each is needed)
+auto_tune_batch_sizes = False
+batch_size_memory_budget = 3 * 1024 * 1024 * 1024
 training_batch_size = 64
 validation_batch_size = 64
-test_batch_size = 64
 fast_conv_cache_training = True
 drop_out=0.5
+# Measures which crop families are worth predicting on the validation set, and saves that as the crop policy used for
+# image splitting.  The budget is in images predicted per test id (the full image plus its crops).
+evaluate_crop_policy = False
+crop_policy_max_images_per_test_id = 9
+# How the main/sample splits are made from the source images.  COPY makes independent copies.  The rest are opt in:
+# LINK and SYMLINK don't duplicate image bytes (but share them with the source images), MANIFEST only writes index files
+# that the batch loaders read directly, and PACKED packs each split into a few large shard files (for network or
+# spinning storage, where opening many small files is slow).
+data_setup_creation_mode = ImagesDirectoryCreationMode.COPY
+# With online augmentation, conv features of this many augmented variants of each training image are cached instead of
+# writing augmented images to disk during data setup (offline augmentation, train_augment_factor)
+num_online_augmented_variants = 0
+train_augment_factor = 0 if num_online_augmented_variants > 0 else 10
 
 reload(utils)
 np.set_printoptions(precision=4, linewidth=100)
@@ -56,10 +78,10 @@ sample_test_set_path = sample_directory + "test/"
 sample_cache_path = "./cache/sample/"
 sample_steps_per_epoch = 10
 
-data_setup = DistractedDriverDataSetup()
+data_setup = DistractedDriverDataSetup(creation_mode=data_setup_creation_mode)
 
 data_setup.establish_working_data_directory_if_needed(source_directory=source_directory, destination_directory=main_directory,
-            destination_sample_directory=sample_directory, valid_to_test_ratio=0.12, sample_ratio=0.04, train_augment_factor=10)
+            destination_sample_directory=sample_directory, valid_to_test_ratio=0.12, sample_ratio=0.04, train_augment_factor=train_augment_factor)
 
 training_set_path = sample_training_set_path if use_sample else main_training_set_path
 validation_set_path = sample_validation_set_path if use_sample else main_validation_set_path
@@ -67,17 +89,25 @@ test_set_path = sample_test_set_path if use_sample else main_test_set_path
 cache_directory = sample_cache_path if use_sample else main_cache_path
 steps_per_epoch = sample_steps_per_epoch if use_sample else main_steps_per_epoch
 
+batch_size_tuner = BatchSizeTuner(cache_directory + 'batch_sizes.json', batch_size_memory_budget) if auto_tune_batch_sizes else None
 vgg = Vgg16(load_weights_from_cache=True, training_images_path=training_set_path, training_batch_size=training_batch_size, validation_images_path=validation_set_path,
             validation_batch_size=validation_batch_size, cache_directory=cache_directory, num_dense_layers_to_retrain=4, fast_conv_cache_training=fast_conv_cache_training,
-            drop_out=drop_out)
+            drop_out=drop_out, batch_size_tuner=batch_size_tuner, num_augmented_variants=num_online_augmented_variants)
 
 if refine_training:
     vgg.refine_training(steps_per_epoch=steps_per_epoch, number_of_epochs=number_of_epochs)
 
-image_classifier = MasterImageClassifier(vgg)
+crop_policy_path = cache_directory + 'crop_policy.json'
+
+if evaluate_crop_policy:
+    CropPolicyEvaluator(vgg, max_images_per_test_id=crop_policy_max_images_per_test_id).evaluate(validation_set_path).save(crop_policy_path)
+
+image_classifier = MasterImageClassifier(vgg, crop_policy=CropPolicy.load_if_exists(crop_policy_path),
+                                         early_exit_confidence=image_splitting_early_exit_confidence)
+test_batch_size = vgg.get_prediction_batch_size()
 
 if run_main_test:
-    prediction_summaries = image_classifier.get_all_predictions(test_set_path, False, test_batch_size)
+    prediction_summaries = image_classifier.generate_predictions(test_set_path, False, test_batch_size)
     CsvSubmissionWritter.write_predictions_to_csv(prediction_summaries)
 
 if visualize_performance:
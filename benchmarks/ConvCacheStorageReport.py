@@ -0,0 +1,47 @@
+from __future__ import division, print_function
+
+from common.model.deeplearning.imagerec.optimization.ConvCacheIterator import ConvCacheIterator
+from common.model.deeplearning.imagerec.optimization.ConvFeatureStorageType import ConvFeatureStorageType
+from common.model.deeplearning.imagerec.pretrained.vgg16 import Vgg16
+
+# Evaluates the trained dense head on the validation conv cache stored at each ConvFeatureStorageType, and reports the
+# loss/accuracy change against FLOATX next to the disk space each one takes.  Uses the latest cached weights, so run
+# training first.  Run from the repository root:  python -m benchmarks.ConvCacheStorageReport
+
+training_set_path = "data/main/train"
+validation_set_path = "data/main/valid"
+cache_directory = "./cache/main/"
+batch_size = 64
+storage_types = [ConvFeatureStorageType.FLOATX, ConvFeatureStorageType.FLOAT16, ConvFeatureStorageType.UINT8]
+
+
+def evaluate_storage_type(vgg: Vgg16, storage_type: ConvFeatureStorageType) -> ([float], int):
+    # Each storage type gets its own batch id, so they don't replace each other's shards
+    conv_cache_batches = ConvCacheIterator(cache_directory=cache_directory + '/convcache_report/', batches=vgg.VALIDATION_BATCHES,
+                                           batch_id='validation_' + storage_type.name.lower(), conv_model=vgg.conv_model_portion,
+                                           batch_size=batch_size, shuffle=False, storage_type=storage_type)
+
+    try:
+        scores = vgg.dense_model_portion.evaluate_generator(conv_cache_batches, conv_cache_batches.get_num_steps_per_epoch())
+        return scores, conv_cache_batches.get_cache_num_bytes()
+    finally:
+        conv_cache_batches.close()
+
+
+if __name__ == '__main__':
+    model = Vgg16(load_weights_from_cache=True, training_images_path=training_set_path, training_batch_size=batch_size,
+                  validation_images_path=validation_set_path, validation_batch_size=batch_size, cache_directory=cache_directory,
+                  num_dense_layers_to_retrain=4, fast_conv_cache_training=True)
+    baseline_scores = None
+    baseline_num_bytes = None
+    print('{:<10}{:>12}{:>12}{:>14}{:>14}{:>12}'.format('storage', 'loss', 'accuracy', 'loss delta', 'acc delta', 'size'))
+
+    for storage_type in storage_types:
+        storage_scores, num_bytes = evaluate_storage_type(model, storage_type)
+
+        if baseline_scores is None:
+            baseline_scores, baseline_num_bytes = storage_scores, num_bytes
+
+        print('{:<10}{:>12.5f}{:>12.5f}{:>+14.5f}{:>+14.5f}{:>11.1f}%'.format(
+            storage_type.name, storage_scores[0], storage_scores[1], storage_scores[0] - baseline_scores[0],
+            storage_scores[1] - baseline_scores[1], 100.0 * num_bytes / baseline_num_bytes))
@@ -0,0 +1,55 @@
+from __future__ import division, print_function
+
+import time
+
+from common.image.ImageInfo import ImageInfo
+from common.image.ImageSplitter import ImageSplitter
+from common.image.ModelImageConverter import ModelImageConverter
+
+# Compares decoding every crop from disk (before) against decoding each source once and cutting all of its
+# crops from that one decoded image (after).  Run from the repository root:  python -m benchmarks.CropDecodeBenchmark
+
+test_images_path = "data/main/test"
+num_source_images = 200
+num_repeats = 3
+
+
+def generate_test_image_infos(source_image_infos: [ImageInfo]) -> [ImageInfo]:
+    test_image_infos = []
+
+    for source_image_info in source_image_infos:
+        test_image_infos.append(source_image_info)
+        test_image_infos.extend(ImageSplitter.get_all_image_portions(source_image_info))
+
+    return test_image_infos
+
+
+def decode_every_crop(image_infos: [ImageInfo]):
+    return [image_info.get_pil_image() for image_info in image_infos]
+
+
+def decode_each_source_once(image_infos: [ImageInfo]):
+    return ModelImageConverter.get_all_pil_images(image_infos)
+
+
+def time_best_of(function, image_infos: [ImageInfo]) -> float:
+    best_seconds = float('inf')
+
+    for repeat in range(num_repeats):
+        start = time.perf_counter()
+        function(image_infos)
+        best_seconds = min(best_seconds, time.perf_counter() - start)
+
+    return best_seconds
+
+
+source_image_infos = ImageInfo.load_image_infos_from_directory(test_images_path)[:num_source_images]
+test_image_infos = generate_test_image_infos(source_image_infos)
+print('Source images: ' + str(len(source_image_infos)) + ', test images including crops: ' + str(len(test_image_infos)))
+
+before_seconds = time_best_of(decode_every_crop, test_image_infos)
+after_seconds = time_best_of(decode_each_source_once, test_image_infos)
+
+print('Before (decode per crop):      {:.3f}s, {:.1f} images/sec'.format(before_seconds, len(test_image_infos) / before_seconds))
+print('After (decode once per source): {:.3f}s, {:.1f} images/sec'.format(after_seconds, len(test_image_infos) / after_seconds))
+print('Speedup: {:.2f}x'.format(before_seconds / after_seconds))
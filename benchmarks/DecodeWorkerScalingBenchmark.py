@@ -0,0 +1,86 @@
+from __future__ import division, print_function
+
+import time
+
+from common.image.ImageInfo import ImageInfo
+from common.image.ImageSplitter import ImageSplitter
+from common.image.ModelImageConverter import ModelImageConverter
+from common.image.ResamplingMode import ResamplingMode
+from common.model.deeplearning.imagerec.optimization.SharedMemoryBatchPrefetcher import SharedMemoryBatchPrefetcher
+
+# Shows how decode/preprocess throughput feeding the model scales with the number of SharedMemoryBatchPrefetcher
+# worker processes.  simulated_inference_seconds stands in for model.predict on each batch, so that the overlap of
+# decoding with inference shows up too (set it to 0 for raw decode throughput).  Run from the repository root:
+# python -m benchmarks.DecodeWorkerScalingBenchmark
+
+test_images_path = "data/main/test"
+num_source_images = 256
+use_image_splitting = False
+batch_size = 64
+worker_counts = [1, 2, 4, 8]
+resampling_mode = ResamplingMode.ANTIALIAS
+simulated_inference_seconds = 0.0
+target_width = 224
+target_height = 224
+
+
+def generate_batches() -> [[ImageInfo]]:
+    source_image_infos = ImageInfo.load_image_infos_from_directory(test_images_path)[:num_source_images]
+    test_image_infos = []
+
+    for source_image_info in source_image_infos:
+        test_image_infos.append(source_image_info)
+        if use_image_splitting:
+            test_image_infos.extend(ImageSplitter.get_all_image_portions(source_image_info))
+
+    return [test_image_infos[index:index + batch_size] for index in range(0, len(test_image_infos), batch_size)]
+
+
+def run_in_process(batches: [[ImageInfo]]) -> float:
+    start = time.perf_counter()
+
+    for batch in batches:
+        ModelImageConverter.generate_image_array_for_image_infos(batch, target_width, target_height, resampling_mode)
+        time.sleep(simulated_inference_seconds)
+
+    return time.perf_counter() - start
+
+
+def run_with_workers(batches: [[ImageInfo]], num_workers: int) -> float:
+    prefetcher = SharedMemoryBatchPrefetcher(num_workers, batch_size, target_width, target_height, resampling_mode, num_slots=num_workers + 2)
+    # Worker start up (and imports, on platforms that spawn) isn't part of steady state throughput
+    prefetcher.submit(batches[0]).release()
+    start = time.perf_counter()
+    pending = []
+
+    try:
+        for batch in batches:
+            # Keep every worker busy, consuming the oldest batch once all the slots are taken
+            if len(pending) == num_workers + 1:
+                oldest = pending.pop(0)
+                oldest.get_image_array()
+                time.sleep(simulated_inference_seconds)
+                oldest.release()
+            pending.append(prefetcher.submit(batch))
+
+        for prefetched_batch in pending:
+            prefetched_batch.get_image_array()
+            time.sleep(simulated_inference_seconds)
+            prefetched_batch.release()
+
+        return time.perf_counter() - start
+    finally:
+        prefetcher.close()
+
+
+if __name__ == '__main__':
+    all_batches = generate_batches()
+    num_images = sum(len(batch) for batch in all_batches)
+    print('Images: ' + str(num_images) + ' in ' + str(len(all_batches)) + ' batches of up to ' + str(batch_size))
+
+    baseline_seconds = run_in_process(all_batches)
+    print('{:<20}{:>12.1f} images/sec'.format('in process', num_images / baseline_seconds))
+
+    for worker_count in worker_counts:
+        seconds = run_with_workers(all_batches, worker_count)
+        print('{:<20}{:>12.1f} images/sec  ({:.2f}x in process)'.format(str(worker_count) + ' workers', num_images / seconds, baseline_seconds / seconds))
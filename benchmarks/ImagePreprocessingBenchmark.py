@@ -0,0 +1,79 @@
+from __future__ import division, print_function
+
+import time
+
+from keras.preprocessing import image as image_processing
+import numpy as np
+import PIL.Image
+
+from common.image.ImageInfo import ImageInfo
+from common.image.ImageSplitter import ImageSplitter
+from common.image.ModelImageConverter import ModelImageConverter
+from common.image.ResamplingMode import ResamplingMode
+
+# Reports images/sec for each way of turning ImageInfos into a model input array.  Run from the repository root:
+# python -m benchmarks.ImagePreprocessingBenchmark
+
+test_images_path = "data/main/test"
+num_source_images = 64
+use_image_splitting = True
+target_width = 224
+target_height = 224
+num_repeats = 3
+
+
+def legacy_loop(image_infos: [ImageInfo]):
+    # The original per-image loop: resize, img_to_array, reshape, then copy into a zeroed array
+    pil_images = ModelImageConverter.get_all_pil_images(image_infos)
+    image_array = np.zeros((len(pil_images),) + (3, target_width, target_height), dtype=image_processing.K.floatx())
+
+    for index in range(len(pil_images)):
+        pil_image = pil_images[index]
+        aspect_ratio = target_width / target_height
+        cropped_width = min(int(aspect_ratio * pil_image.height), pil_image.width)
+        cropped_height = min(int(pil_image.width / aspect_ratio), pil_image.height)
+        x0 = int((pil_image.width - cropped_width) / 2)
+        y0 = int((pil_image.height - cropped_height) / 2)
+        x1 = pil_image.width - int((pil_image.width - cropped_width) / 2)
+        y1 = pil_image.height - int((pil_image.height - cropped_height) / 2)
+        cropped_image = pil_image.crop((x0, y0, x1, y1))
+        resized_image = cropped_image.resize((target_width, target_height), PIL.Image.ANTIALIAS)
+        x = image_processing.img_to_array(resized_image)
+        image_array[index] = x.reshape(1, 3, target_width, target_height)
+
+    return image_array
+
+
+def engine(resampling_mode: ResamplingMode, num_threads: int):
+    def run(image_infos: [ImageInfo]):
+        return ModelImageConverter.generate_image_array_for_image_infos(image_infos, target_width, target_height, resampling_mode, num_threads)
+
+    return run
+
+
+def images_per_second(function, image_infos: [ImageInfo]) -> float:
+    best_seconds = float('inf')
+
+    for repeat in range(num_repeats):
+        start = time.perf_counter()
+        function(image_infos)
+        best_seconds = min(best_seconds, time.perf_counter() - start)
+
+    return len(image_infos) / best_seconds
+
+
+source_image_infos = ImageInfo.load_image_infos_from_directory(test_images_path)[:num_source_images]
+test_image_infos = []
+
+for source_image_info in source_image_infos:
+    test_image_infos.append(source_image_info)
+    if use_image_splitting:
+        test_image_infos.extend(ImageSplitter.get_all_image_portions(source_image_info))
+
+print('Images per run: ' + str(len(test_image_infos)))
+print('{:<32}{:>12.1f} images/sec'.format('legacy loop', images_per_second(legacy_loop, test_image_infos)))
+
+for mode in ResamplingMode:
+    for threads in [1, None]:
+        label = mode.name + (', 1 thread' if threads == 1 else ', thread pool')
+        print('{:<32}{:>12.1f} images/sec'.format(label, images_per_second(engine(mode, threads), test_image_infos)))
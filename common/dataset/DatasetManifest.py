@@ -0,0 +1,79 @@
+import json
+import os
+
+
+# A data set split (i.e. data/main/train) as an index file instead of a directory tree:  each image's class and the path
+# of the file it really lives in, so that splits can share image files without copying or linking any of them.  The
+# file sits where the split's directory would, with FILE_SUFFIX added, and wherever a split's directory is expected
+# (batch loaders, image info scans), its manifest is used first if there is one.
+class DatasetManifest:
+    FILE_SUFFIX = '.manifest.json'
+    VERSION = 1
+
+    # Handles the backslashed paths DataSetup works with, so writers and readers agree on where the file is
+    @staticmethod
+    def normalize_path(path: str) -> str:
+        return os.path.normpath(path.replace('\\', '/'))
+
+    @staticmethod
+    def get_manifest_path(split_path: str) -> str:
+        return DatasetManifest.normalize_path(split_path) + DatasetManifest.FILE_SUFFIX
+
+    @staticmethod
+    def exists(split_path: str) -> bool:
+        return os.path.isfile(DatasetManifest.get_manifest_path(split_path))
+
+    @staticmethod
+    def load(split_path: str):
+        with open(DatasetManifest.get_manifest_path(split_path), 'r') as manifest_file:
+            contents = json.load(manifest_file)
+
+        if contents.get('version') != DatasetManifest.VERSION:
+            raise ValueError('Unsupported manifest version for ' + split_path + ': ' + str(contents.get('version')))
+
+        return DatasetManifest(split_path, [tuple(entry) for entry in contents['entries']])
+
+    # The image paths of a split, or of one of its class "subdirectories", if either has a manifest; otherwise None
+    @staticmethod
+    def find_image_paths(path: str) -> [str]:
+        if DatasetManifest.exists(path):
+            return DatasetManifest.load(path).get_image_paths()
+
+        split_path, class_name = os.path.split(DatasetManifest.normalize_path(path))
+
+        if DatasetManifest.exists(split_path):
+            return DatasetManifest.load(split_path).get_image_paths(class_name)
+
+        return None
+
+    # entries are (class name, image path) pairs
+    def __init__(self, split_path: str, entries: [(str, str)]):
+        self.__split_path = split_path
+        self.__entries = sorted(entries)
+
+    def get_split_path(self) -> str:
+        return self.__split_path
+
+    # (class name, image path) pairs, sorted by class and then path like a directory listing
+    def get_entries(self) -> [(str, str)]:
+        return self.__entries
+
+    def get_class_names(self) -> [str]:
+        return sorted(set(class_name for class_name, image_path in self.__entries))
+
+    def get_image_paths(self, class_name: str = None) -> [str]:
+        return [image_path for entry_class_name, image_path in self.__entries if class_name is None or entry_class_name == class_name]
+
+    def save(self):
+        manifest_path = DatasetManifest.get_manifest_path(self.__split_path)
+        directory = os.path.dirname(manifest_path)
+
+        if directory != '' and not os.path.exists(directory):
+            os.makedirs(directory)
+
+        temp_path = manifest_path + '.tmp'
+
+        with open(temp_path, 'w') as manifest_file:
+            json.dump({'version': DatasetManifest.VERSION, 'entries': self.__entries}, manifest_file, indent=1)
+
+        os.replace(temp_path, manifest_path)
@@ -0,0 +1,202 @@
+import io
+import json
+import mmap
+import os
+import threading
+
+import PIL.Image
+
+from common.dataset.DatasetManifest import DatasetManifest
+
+
+# A data set split (i.e. data/main/train) packed into a few large shard files of encoded images, written back to back,
+# plus an index file of each image's class, shard, offset, length, file name and dimensions.  Reading a split is then
+# sequential reads out of a handful of memory mapped files, instead of a directory walk and an open/seek per image.
+# The index sits where the split's directory would, with FILE_SUFFIX added, and the shards next to it.
+#
+# Each packed image has a record path, <absolute index path>/<entry number>/<original file name>, which stands in for its
+# file path (i.e. in ImageInfo):  the image number and file name come out of it as usual, and open_image_file() gives
+# something PIL (and keras' load_img) can open for either kind of path.
+class PackedDataset:
+    FILE_SUFFIX = '.pack.json'
+    SHARD_SUFFIX = '.bin'
+    VERSION = 1
+    DEFAULT_MAX_SHARD_NUM_BYTES = 256 * 1024 * 1024
+
+    __open_datasets = {}
+    __open_datasets_lock = threading.Lock()
+
+    @staticmethod
+    def get_index_path(split_path: str) -> str:
+        return DatasetManifest.normalize_path(split_path) + PackedDataset.FILE_SUFFIX
+
+    @staticmethod
+    def exists(split_path: str) -> bool:
+        return os.path.isfile(PackedDataset.get_index_path(split_path))
+
+    # Datasets stay open (with their shards memory mapped) once loaded, so record paths can be read from anywhere
+    @staticmethod
+    def load(split_path: str):
+        index_path = PackedDataset.get_index_path(split_path)
+
+        with PackedDataset.__open_datasets_lock:
+            dataset = PackedDataset.__open_datasets.get(index_path)
+
+            if dataset is None or dataset.__index_mtime_ns != os.stat(index_path).st_mtime_ns:
+                dataset = PackedDataset(index_path)
+                PackedDataset.__open_datasets[index_path] = dataset
+
+            return dataset
+
+    # The (record path, width, height) of every image of a split, or of one of its class "subdirectories", if either is
+    # packed; otherwise None
+    @staticmethod
+    def find_records(path: str) -> [(str, int, int)]:
+        if PackedDataset.exists(path):
+            return PackedDataset.load(path).get_records()
+
+        split_path, class_name = os.path.split(DatasetManifest.normalize_path(path))
+
+        if PackedDataset.exists(split_path):
+            return PackedDataset.load(split_path).get_records(class_name)
+
+        return None
+
+    @staticmethod
+    def is_record_path(path: str) -> bool:
+        return PackedDataset.FILE_SUFFIX + '/' in path.replace('\\', '/')
+
+    # The packed dataset and entry number of a record path
+    @staticmethod
+    def parse_record_path(record_path: str) -> (object, int):
+        split_path, entry_path = record_path.replace('\\', '/').split(PackedDataset.FILE_SUFFIX + '/', 1)
+        return PackedDataset.load(split_path), int(entry_path.split('/', 1)[0])
+
+    # Something PIL can open:  the image's bytes for a record path, otherwise the path itself
+    @staticmethod
+    def open_image_file(path: str):
+        if not PackedDataset.is_record_path(path):
+            return path
+
+        dataset, entry_num = PackedDataset.parse_record_path(path)
+        return io.BytesIO(dataset.get_image_bytes(entry_num))
+
+    # The file an image's bytes are stored in (i.e. for stat based cache keys):  its shard for a record path, otherwise
+    # the path itself
+    @staticmethod
+    def get_file_path(path: str) -> str:
+        if not PackedDataset.is_record_path(path):
+            return path
+
+        dataset, entry_num = PackedDataset.parse_record_path(path)
+        return dataset.get_shard_path(entry_num)
+
+    # Packs (class name, image path) entries in class and then path order (so reading a split in order is one sequential
+    # pass through its shards).  Dimensions come from the image headers.  Shards are renamed into place once complete,
+    # and the index is written last.
+    @staticmethod
+    def write(split_path: str, entries: [(str, str)], max_shard_num_bytes: int = DEFAULT_MAX_SHARD_NUM_BYTES):
+        index_path = PackedDataset.get_index_path(split_path)
+        directory = os.path.dirname(index_path)
+        shard_prefix = os.path.basename(index_path)[:-len(PackedDataset.FILE_SUFFIX)] + '.pack-'
+
+        if directory != '' and not os.path.exists(directory):
+            os.makedirs(directory)
+
+        class_names = sorted(set(class_name for class_name, image_path in entries))
+        class_nums = dict(zip(class_names, range(len(class_names))))
+        shard_file_names = []
+        index_entries = []
+        shard_file = None
+        offset = 0
+
+        try:
+            for class_name, image_path in sorted(entries):
+                with open(image_path, 'rb') as image_file:
+                    image_bytes = image_file.read()
+
+                if shard_file is None or (offset > 0 and offset + len(image_bytes) > max_shard_num_bytes):
+                    PackedDataset.__close_shard(shard_file, directory, shard_file_names)
+                    shard_file_names.append(shard_prefix + '{:05d}'.format(len(shard_file_names)) + PackedDataset.SHARD_SUFFIX)
+                    shard_file = open(os.path.join(directory, shard_file_names[-1] + '.tmp'), 'wb')
+                    offset = 0
+
+                with PIL.Image.open(io.BytesIO(image_bytes)) as pil_image:
+                    width, height = pil_image.size
+
+                shard_file.write(image_bytes)
+                index_entries.append([class_nums[class_name], len(shard_file_names) - 1, offset, len(image_bytes),
+                                      os.path.basename(image_path), width, height])
+                offset = offset + len(image_bytes)
+        finally:
+            PackedDataset.__close_shard(shard_file, directory, shard_file_names)
+
+        temp_path = index_path + '.tmp'
+
+        with open(temp_path, 'w') as index_file:
+            json.dump({'version': PackedDataset.VERSION, 'classes': class_names, 'shards': shard_file_names, 'entries': index_entries},
+                      index_file)
+
+        os.replace(temp_path, index_path)
+
+    @staticmethod
+    def __close_shard(shard_file, directory: str, shard_file_names: [str]):
+        if shard_file is None or shard_file.closed:
+            return
+
+        shard_file.close()
+        os.replace(os.path.join(directory, shard_file_names[-1] + '.tmp'), os.path.join(directory, shard_file_names[-1]))
+
+    def __init__(self, index_path: str):
+        with open(index_path, 'r') as index_file:
+            contents = json.load(index_file)
+
+        if contents.get('version') != PackedDataset.VERSION:
+            raise ValueError('Unsupported packed dataset version for ' + index_path + ': ' + str(contents.get('version')))
+
+        self.__index_path = os.path.abspath(index_path)
+        self.__index_mtime_ns = os.stat(index_path).st_mtime_ns
+        self.__directory = os.path.dirname(index_path)
+        self.__class_names = contents['classes']
+        self.__shard_file_names = contents['shards']
+        self.__entries = contents['entries']
+        self.__shard_maps = {}
+        self.__lock = threading.Lock()
+
+    def get_split_path(self) -> str:
+        return self.__index_path[:-len(PackedDataset.FILE_SUFFIX)]
+
+    def get_num_images(self) -> int:
+        return len(self.__entries)
+
+    def get_class_names(self) -> [str]:
+        return self.__class_names
+
+    # Class numbers index get_class_names()
+    def get_class_nums(self) -> [int]:
+        return [entry[0] for entry in self.__entries]
+
+    def get_record_path(self, entry_num: int) -> str:
+        return self.__index_path + '/' + str(entry_num) + '/' + self.__entries[entry_num][4]
+
+    def get_records(self, class_name: str = None) -> [(str, int, int)]:
+        return [(self.get_record_path(entry_num), entry[5], entry[6]) for entry_num, entry in enumerate(self.__entries)
+                if class_name is None or self.__class_names[entry[0]] == class_name]
+
+    def get_dimensions(self, entry_num: int) -> (int, int):
+        return self.__entries[entry_num][5], self.__entries[entry_num][6]
+
+    def get_shard_path(self, entry_num: int) -> str:
+        return os.path.join(self.__directory, self.__shard_file_names[self.__entries[entry_num][1]])
+
+    def get_image_bytes(self, entry_num: int) -> bytes:
+        class_num, shard_num, offset, length = self.__entries[entry_num][:4]
+        return self.__get_shard_map(shard_num)[offset:offset + length]
+
+    def __get_shard_map(self, shard_num: int) -> mmap.mmap:
+        with self.__lock:
+            if not (shard_num in self.__shard_maps):
+                with open(os.path.join(self.__directory, self.__shard_file_names[shard_num]), 'rb') as shard_file:
+                    self.__shard_maps[shard_num] = mmap.mmap(shard_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+            return self.__shard_maps[shard_num]
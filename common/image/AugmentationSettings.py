@@ -0,0 +1,5 @@
+# The random transforms training images are augmented with, as ImageDataGenerator arguments.  Shared by offline
+# augmentation (DataSetup) and online augmentation (Vgg16's conv cache), so both make the same kind of variants.
+class AugmentationSettings:
+    GENERATOR_ARGUMENTS = {'rotation_range': 15, 'width_shift_range': 0.1, 'height_shift_range': 0.1, 'shear_range': 0.2,
+                           'zoom_range': 0.1, 'horizontal_flip': True, 'channel_shift_range': 0.2, 'fill_mode': 'nearest'}
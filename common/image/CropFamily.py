@@ -0,0 +1,19 @@
+from enum import Enum
+
+
+# The groups of crops ImageSplitter can cut out of an image, for test time augmentation
+class CropFamily(Enum):
+    # Four half width, half height corners
+    SQUARE_QUADRANTS = 1
+    # Four half width, half height crops centered on each edge
+    CROSS_QUADRANTS = 2
+    # Top and bottom halves
+    HORIZONTAL_HALVES = 3
+    # Left and right halves
+    VERTICAL_HALVES = 4
+    # Four three quarters width, three quarters height corners
+    SQUARE_THREE_QUARTERS_CORNERS = 5
+    # Four three quarters width, three quarters height crops centered on each edge
+    THREE_QUARTERS_CROSS = 6
+    # One half width, half height crop from the center
+    HALF_CENTER = 7
@@ -0,0 +1,75 @@
+import json
+import os
+
+import PIL.Image
+
+
+# Persistent sidecar index of image path -> (width, height, mtime) for a directory, so that re-scanning a large
+# directory only costs a stat call per image instead of opening every file.
+class ImageDimensionsIndex:
+    INDEX_FILE_NAME = '.image_dimensions_index.json'
+    VERSION = 1
+
+    @staticmethod
+    def load(images_directory_path: str):
+        index_path = os.path.join(images_directory_path, ImageDimensionsIndex.INDEX_FILE_NAME)
+        entries = {}
+
+        if os.path.exists(index_path):
+            try:
+                with open(index_path, 'r') as index_file:
+                    contents = json.load(index_file)
+                if contents.get('version') == ImageDimensionsIndex.VERSION:
+                    entries = contents.get('entries', {})
+            except (OSError, ValueError):
+                # A corrupt index is just rebuilt
+                entries = {}
+
+        return ImageDimensionsIndex(images_directory_path, index_path, entries)
+
+    # Reads only the file header; PIL doesn't decode pixel data until it's asked for
+    @staticmethod
+    def probe_dimensions(image_path: str) -> (int, int):
+        with PIL.Image.open(image_path) as pil_image:
+            return pil_image.width, pil_image.height
+
+    def __init__(self, images_directory_path: str, index_path: str, entries: {}):
+        self.__images_directory_path = images_directory_path
+        self.__index_path = index_path
+        self.__previous_entries = entries
+        self.__current_entries = {}
+        self.__changed = False
+
+    def get_dimensions(self, image_path: str) -> (int, int):
+        key = os.path.relpath(image_path, self.__images_directory_path)
+        mtime = os.stat(image_path).st_mtime_ns
+        entry = self.__previous_entries.get(key)
+
+        if entry is None or entry[2] != mtime:
+            width, height = ImageDimensionsIndex.probe_dimensions(image_path)
+            entry = [width, height, mtime]
+            self.__changed = True
+
+        self.__current_entries[key] = entry
+        return entry[0], entry[1]
+
+    # Only entries looked up since loading are kept, so files removed from the directory drop out of the index
+    def save_if_changed(self):
+        removed_keys = set(self.__previous_entries.keys()) - set(self.__current_entries.keys())
+
+        if not self.__changed and len(removed_keys) == 0:
+            return
+
+        temp_index_path = self.__index_path + '.tmp'
+
+        try:
+            with open(temp_index_path, 'w') as index_file:
+                json.dump({'version': ImageDimensionsIndex.VERSION, 'entries': self.__current_entries}, index_file)
+            os.replace(temp_index_path, self.__index_path)
+        except OSError:
+            # Read-only data directories still work, they just don't get the speedup on the next scan
+            return
+
+        self.__previous_entries = self.__current_entries
+        self.__current_entries = {}
+        self.__changed = False
@@ -3,70 +3,123 @@ import os
 
 from keras.preprocessing import image as image_processing
 from PIL.Image import Image
+import PIL.Image
 
+from common.dataset.DatasetManifest import DatasetManifest
+from common.dataset.PackedDataset import PackedDataset
 from common.image.CropBox import CropBox
+from common.image.ImageDimensionsIndex import ImageDimensionsIndex
 
 
 class ImageInfo:
     @staticmethod
     def load_image_infos_from_directory(images_directory_path: str):
+        return list(ImageInfo.generate_image_infos_from_directory(images_directory_path))
+
+    # Yields image infos while the directory is still being scanned, rather than building the whole list up front.  A
+    # split set up in manifest mode (or one of its class subdirectories) is read from its manifest instead, and a packed
+    # split from its index, with images at their record paths (see PackedDataset).
+    @staticmethod
+    def generate_image_infos_from_directory(images_directory_path: str):
         file_extension = "jpg"
+        packed_records = PackedDataset.find_records(images_directory_path)
+
+        if packed_records is not None:
+            for record_path, width, height in packed_records:
+                if record_path.endswith("." + file_extension):
+                    yield ImageInfo.get_instance_for_image_path(record_path, width, height)
+
+            return
+
+        manifest_image_paths = DatasetManifest.find_image_paths(images_directory_path)
+
+        if manifest_image_paths is not None:
+            for image_path in manifest_image_paths:
+                if image_path.endswith("." + file_extension):
+                    yield ImageInfo.get_instance_for_image_path(image_path)
+
+            return
+
         images_locator = os.path.join(images_directory_path+"/**", "*." + file_extension)
-        image_paths = glob.glob(images_locator, recursive=True)
-        image_infos = []
+        dimensions_index = ImageDimensionsIndex.load(images_directory_path)
 
-        for image_path in image_paths:
-            image_info = ImageInfo.get_instance_for_image_path(image_path)
-            image_infos.append(image_info)
+        for image_path in glob.iglob(images_locator, recursive=True):
+            width, height = dimensions_index.get_dimensions(image_path)
+            yield ImageInfo.get_instance_for_image_path(image_path, width, height)
 
-        return image_infos
+        dimensions_index.save_if_changed()
 
     @staticmethod
-    def get_instance_for_image_path(image_path: str):
+    def get_instance_for_image_path(image_path: str, width: int = None, height: int = None):
         image_number = ImageInfo.__determine_image_number(image_path)
-        return ImageInfo.get_instance(image_number, image_path)
+        return ImageInfo.get_instance(image_number, image_path, width=width, height=height)
 
     @staticmethod
-    def get_instance(image_number: int, image_path: str, crop_box: CropBox = None):
-        return ImageInfo(image_number, image_path, crop_box)
+    def get_instance(image_number: int, image_path: str, crop_box: CropBox = None, width: int = None, height: int = None):
+        return ImageInfo(image_number, image_path, crop_box, width, height)
 
-    def __init__(self, image_number: int, image_path: str, crop_box: CropBox = None):
+    # Dimensions are either passed in (i.e. from a dimensions index), taken from the crop box, or read lazily from the
+    # file header the first time they're asked for.  The pixel data is never decoded just to get them.
+    def __init__(self, image_number: int, image_path: str, crop_box: CropBox = None, width: int = None, height: int = None):
         self.__image_number = image_number
         self.__image_path = image_path
         self.__crop_box = crop_box
-        # Just using for dimension info, then discarding to preserve memory
-        pil_image = self.get_pil_image()
-        self.__width = pil_image.width
-        self.__height = pil_image.height
+
+        if crop_box is not None:
+            width = crop_box.get_width()
+            height = crop_box.get_height()
+
+        self.__width = width
+        self.__height = height
 
     def get_image_number(self) -> int:
         return self.__image_number
 
     # lazy loading, to prevent huge amounts of memory being used
     def get_pil_image(self) -> Image:
-        original_pil_image = ImageInfo.__load_pil_image_from_path(self.__image_path)
+        return self.get_pil_image_from_source(self.load_source_pil_image())
+
+    # Decodes the whole source file, ignoring the crop box
+    def load_source_pil_image(self) -> Image:
+        return ImageInfo.__load_pil_image_from_path(self.__image_path)
 
+    # Opens the whole source file without decoding it yet, i.e. so the decoder can be configured with draft()
+    def open_source_pil_image(self) -> Image:
+        return PIL.Image.open(PackedDataset.open_image_file(self.__image_path))
+
+    # Cuts this image's portion out of an already decoded source image, so that one decode can serve every crop of the same file
+    def get_pil_image_from_source(self, source_pil_image: Image) -> Image:
         if self.__crop_box is None:
-            return original_pil_image
+            return source_pil_image
 
-        return ImageInfo.__get_pil_image_portion(original_pil_image, self.__crop_box)
+        return ImageInfo.__get_pil_image_portion(source_pil_image, self.__crop_box)
 
     def get_image_path(self) -> str:
         return self.__image_path
 
+    def get_crop_box(self) -> CropBox:
+        return self.__crop_box
+
     def get_width(self) -> int:
+        if self.__width is None:
+            self.__probe_dimensions()
         return self.__width
 
     def get_height(self) -> int:
+        if self.__height is None:
+            self.__probe_dimensions()
         return self.__height
 
+    def __probe_dimensions(self):
+        self.__width, self.__height = ImageDimensionsIndex.probe_dimensions(PackedDataset.open_image_file(self.__image_path))
+
     @staticmethod
     def __determine_image_number(image_path) -> int:
         return os.path.split(image_path)[-1][0:-4]
 
     @staticmethod
     def __load_pil_image_from_path(image_path: str) -> Image:
-        return image_processing.load_img(image_path)
+        return image_processing.load_img(PackedDataset.open_image_file(image_path))
 
     @staticmethod
     def __get_pil_image_portion(source_pil_image: Image, crop_box: CropBox) -> Image:
@@ -1,8 +1,46 @@
 from common.image.CropBox import CropBox
+from common.image.CropFamily import CropFamily
 from common.image.ImageInfo import ImageInfo
 
 
 class ImageSplitter:
+    NUM_IMAGE_PORTIONS_PER_CROP_FAMILY = {CropFamily.SQUARE_QUADRANTS: 4, CropFamily.CROSS_QUADRANTS: 4, CropFamily.HORIZONTAL_HALVES: 2,
+                                          CropFamily.VERTICAL_HALVES: 2, CropFamily.SQUARE_THREE_QUARTERS_CORNERS: 4,
+                                          CropFamily.THREE_QUARTERS_CROSS: 4, CropFamily.HALF_CENTER: 1}
+
+    @staticmethod
+    def get_all_image_portions(source_image_info: ImageInfo) -> [ImageInfo]:
+        return ImageSplitter.get_image_portions(source_image_info, list(CropFamily))
+
+    # Portions of every given family, family by family in the order given
+    @staticmethod
+    def get_image_portions(source_image_info: ImageInfo, crop_families: [CropFamily]) -> [ImageInfo]:
+        new_image_infos = []
+
+        for crop_family in crop_families:
+            new_image_infos.extend(ImageSplitter.get_crop_family_image_portions(source_image_info, crop_family))
+
+        return new_image_infos
+
+    @staticmethod
+    def get_crop_family_image_portions(source_image_info: ImageInfo, crop_family: CropFamily) -> [ImageInfo]:
+        if crop_family == CropFamily.SQUARE_QUADRANTS:
+            return ImageSplitter.get_image_divided_into_square_quadrants(source_image_info)
+        if crop_family == CropFamily.CROSS_QUADRANTS:
+            return ImageSplitter.get_image_divided_into_cross_quadrants(source_image_info)
+        if crop_family == CropFamily.HORIZONTAL_HALVES:
+            return ImageSplitter.get_image_divided_into_horizontal_halves(source_image_info)
+        if crop_family == CropFamily.VERTICAL_HALVES:
+            return ImageSplitter.get_image_divided_into_vertical_halves(source_image_info)
+        if crop_family == CropFamily.SQUARE_THREE_QUARTERS_CORNERS:
+            return ImageSplitter.get_image_divided_into_square_three_quarters_corners(source_image_info)
+        if crop_family == CropFamily.THREE_QUARTERS_CROSS:
+            return ImageSplitter.get_image_divided_into_three_quarters_cross(source_image_info)
+        if crop_family == CropFamily.HALF_CENTER:
+            return ImageSplitter.get_image_half_center(source_image_info)
+
+        raise ValueError('Unsupported crop family: ' + str(crop_family))
+
     @staticmethod
     def get_image_divided_into_vertical_halves(source_image_info: ImageInfo) -> [ImageInfo]:
         new_image_infos = []
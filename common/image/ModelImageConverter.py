@@ -1,49 +1,153 @@
+import concurrent.futures
+import math
+from collections import OrderedDict
+
 from keras.preprocessing import image as image_processing
 from PIL.Image import Image
 import PIL.Image
 import numpy as np
 from common.image.ImageInfo import ImageInfo
+from common.image.ResamplingMode import ResamplingMode
 
 
 class ModelImageConverter:
     @staticmethod
     def get_all_pil_images(image_infos: [ImageInfo]) -> [Image]:
+        # Each source file is decoded only once, and all of its crops are cut from that decoded image
+        image_path_to_source_pil_image = {}
         pil_images = []
 
         for image_info in image_infos:
-            pil_images.append(image_info.get_pil_image())
+            image_path = image_info.get_image_path()
+            if not (image_path in image_path_to_source_pil_image):
+                image_path_to_source_pil_image[image_path] = image_info.load_source_pil_image()
+
+            pil_images.append(image_info.get_pil_image_from_source(image_path_to_source_pil_image[image_path]))
 
         return pil_images
 
     @staticmethod
     def generate_image_array_for_prediction(pil_images: [Image], width: int, height: int) -> [int]:
-        resized_pil_images = []
-
-        for pil_image in pil_images:
-            resized_pil_image = ModelImageConverter.__generate_resized_pil_image(pil_image, width, height)
-            resized_pil_images.append(resized_pil_image)
+        image_array = ModelImageConverter.allocate_image_array(len(pil_images), width, height)
 
-        batch_size = len(resized_pil_images)
-        image_array = np.zeros((batch_size,) + (3, width, height), dtype=image_processing.K.floatx())
+        for index in range(len(pil_images)):
+            resized_pil_image = ModelImageConverter.__generate_resized_pil_image(pil_images[index], width, height, PIL.Image.ANTIALIAS)
+            ModelImageConverter.__write_pil_image_to_array(resized_pil_image, image_array, index)
 
-        for index in range(len(resized_pil_images)):
-            pil_image = resized_pil_images[index]
-            x = image_processing.img_to_array(pil_image)
-            x = x.reshape(1, 3, width, height)
-            image_array[index] = x
+        return image_array
 
+    @staticmethod
+    def generate_image_array_for_image_infos(image_infos: [ImageInfo], width: int, height: int,
+                                             resampling_mode: ResamplingMode = ResamplingMode.ANTIALIAS, num_threads: int = None) -> np.ndarray:
+        image_array = ModelImageConverter.allocate_image_array(len(image_infos), width, height)
+        ModelImageConverter.fill_image_array(image_infos, image_array, resampling_mode, num_threads)
         return image_array
 
     @staticmethod
-    def __generate_resized_pil_image(pil_image: Image, width: int, height: int) -> Image:
-        # crop to maintain aspect ratio, then resize
+    def allocate_image_array(batch_size: int, width: int, height: int) -> np.ndarray:
+        return np.empty((batch_size, 3, height, width), dtype=image_processing.K.floatx())
+
+    # Decodes, crops and resizes straight into rows of a preallocated (N, 3, height, width) array.  Work is split by
+    # source file across a thread pool (PIL releases the GIL while decoding and resizing), and each source is decoded
+    # only once no matter how many of its crops are in the batch.
+    @staticmethod
+    def fill_image_array(image_infos: [ImageInfo], image_array: np.ndarray, resampling_mode: ResamplingMode = ResamplingMode.ANTIALIAS,
+                         num_threads: int = None):
+        image_path_to_indexes = OrderedDict()
+
+        for index in range(len(image_infos)):
+            image_path = image_infos[index].get_image_path()
+            if not (image_path in image_path_to_indexes):
+                image_path_to_indexes[image_path] = []
+            image_path_to_indexes[image_path].append(index)
+
+        def fill_rows_for_source(indexes: [int]):
+            ModelImageConverter.__fill_rows_for_source(image_infos, indexes, image_array, resampling_mode)
+
+        if num_threads == 1 or len(image_path_to_indexes) == 1:
+            for indexes in image_path_to_indexes.values():
+                fill_rows_for_source(indexes)
+            return
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=num_threads) as executor:
+            # list() so that exceptions from the workers are raised here
+            list(executor.map(fill_rows_for_source, image_path_to_indexes.values()))
+
+    @staticmethod
+    def __fill_rows_for_source(image_infos: [ImageInfo], indexes: [int], image_array: np.ndarray, resampling_mode: ResamplingMode):
+        height, width = image_array.shape[2], image_array.shape[3]
+        source_info = image_infos[indexes[0]]
+
+        if resampling_mode == ResamplingMode.FAST_DRAFT:
+            source_pil_image, scale_x, scale_y = ModelImageConverter.__load_drafted_source_pil_image(source_info, [image_infos[index] for index in indexes],
+                                                                                                     width, height)
+            resample = PIL.Image.BILINEAR
+        else:
+            source_pil_image, scale_x, scale_y = source_info.load_source_pil_image(), 1.0, 1.0
+            resample = PIL.Image.ANTIALIAS
+
+        for index in indexes:
+            portion_pil_image = ModelImageConverter.__get_scaled_portion(image_infos[index], source_pil_image, scale_x, scale_y)
+            resized_pil_image = ModelImageConverter.__generate_resized_pil_image(portion_pil_image, width, height, resample)
+            ModelImageConverter.__write_pil_image_to_array(resized_pil_image, image_array, index)
+
+    # Asks the JPEG decoder to downscale (by 1/2, 1/4 or 1/8) as far as it can while every requested portion still comes
+    # out at least as big as the model input
+    @staticmethod
+    def __load_drafted_source_pil_image(source_info: ImageInfo, portion_infos: [ImageInfo], width: int, height: int) -> (Image, float, float):
+        source_pil_image = source_info.open_source_pil_image()
+        full_width, full_height = source_pil_image.size
+        requested_width = 1
+        requested_height = 1
+
+        for portion_info in portion_infos:
+            portion_width, portion_height = ModelImageConverter.__get_aspect_cropped_size(portion_info.get_width(), portion_info.get_height(), width, height)
+            requested_width = max(requested_width, int(math.ceil(full_width * width / max(portion_width, 1))))
+            requested_height = max(requested_height, int(math.ceil(full_height * height / max(portion_height, 1))))
+
+        if requested_width < full_width and requested_height < full_height:
+            source_pil_image.draft('RGB', (requested_width, requested_height))
+
+        if source_pil_image.mode != 'RGB':
+            source_pil_image = source_pil_image.convert('RGB')
+        else:
+            source_pil_image.load()
+
+        return source_pil_image, source_pil_image.width / full_width, source_pil_image.height / full_height
+
+    @staticmethod
+    def __get_scaled_portion(image_info: ImageInfo, source_pil_image: Image, scale_x: float, scale_y: float) -> Image:
+        crop_box = image_info.get_crop_box()
+
+        if crop_box is None:
+            return source_pil_image
+
+        if scale_x == 1.0 and scale_y == 1.0:
+            return image_info.get_pil_image_from_source(source_pil_image)
+
+        return source_pil_image.crop((int(round(crop_box.get_begin_x() * scale_x)), int(round(crop_box.get_begin_y() * scale_y)),
+                                      int(round(crop_box.get_end_x() * scale_x)), int(round(crop_box.get_end_y() * scale_y))))
+
+    @staticmethod
+    def __write_pil_image_to_array(pil_image: Image, image_array: np.ndarray, index: int):
+        # HWC uint8 -> CHW floatx, cast while copying into the destination row
+        image_array[index] = np.asarray(pil_image, dtype=np.uint8).transpose(2, 0, 1)
+
+    @staticmethod
+    def __get_aspect_cropped_size(source_width: int, source_height: int, width: int, height: int) -> (int, int):
         aspect_ratio = width / height
-        cropped_width = min(int(aspect_ratio * pil_image.height), pil_image.width)
-        cropped_height = min(int(pil_image.width / aspect_ratio), pil_image.height)
+        cropped_width = min(int(aspect_ratio * source_height), source_width)
+        cropped_height = min(int(source_width / aspect_ratio), source_height)
+        return cropped_width, cropped_height
+
+    @staticmethod
+    def __generate_resized_pil_image(pil_image: Image, width: int, height: int, resample) -> Image:
+        # crop to maintain aspect ratio, then resize
+        cropped_width, cropped_height = ModelImageConverter.__get_aspect_cropped_size(pil_image.width, pil_image.height, width, height)
         x0 = int((pil_image.width - cropped_width) / 2)
         y0 = int((pil_image.height - cropped_height) / 2)
         x1 = pil_image.width - int((pil_image.width - cropped_width) / 2)
         y1 = pil_image.height - int((pil_image.height - cropped_height) / 2)
         cropped_image = pil_image.crop((x0, y0, x1, y1))
-        resized_image = cropped_image.resize((width, height), PIL.Image.ANTIALIAS)
+        resized_image = cropped_image.resize((width, height), resample)
         return resized_image
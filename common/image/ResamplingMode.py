@@ -0,0 +1,8 @@
+from enum import Enum
+
+
+class ResamplingMode(Enum):
+    # Full decode, then a high quality ANTIALIAS downscale
+    ANTIALIAS = 1
+    # JPEGs are downscaled by the decoder itself (PIL draft()), then finished with a cheap BILINEAR resize
+    FAST_DRAFT = 2
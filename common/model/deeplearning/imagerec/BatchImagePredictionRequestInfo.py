@@ -1,16 +1,46 @@
 from common.image.ImageInfo import ImageInfo
 from common.image.ModelImageConverter import ModelImageConverter
+from common.image.ResamplingMode import ResamplingMode
+from common.model.deeplearning.imagerec.IBatchPrefetcher import IBatchPrefetcher
 from common.model.deeplearning.imagerec.ImagePredictionRequest import ImagePredictionRequest
+from common.model.deeplearning.imagerec.optimization.InferenceFeatureStore import InferenceFeatureStore
+from common.model.deeplearning.imagerec.optimization.PredictionStore import PredictionStore
+from common.model.deeplearning.imagerec.optimization.PrefetchedImageBatch import PrefetchedImageBatch
 
 
 class BatchImagePredictionRequestInfo:
     @staticmethod
-    def get_instance(image_prediction_requests: [ImagePredictionRequest], target_image_width: int, target_image_height: int):
+    def get_instance(image_prediction_requests: [ImagePredictionRequest], target_image_width: int, target_image_height: int,
+                     resampling_mode: ResamplingMode = ResamplingMode.ANTIALIAS, prefetcher: IBatchPrefetcher = None,
+                     feature_store: InferenceFeatureStore = None, prediction_store: PredictionStore = None):
         test_id_to_ordered_image_infos = BatchImagePredictionRequestInfo.__generate_test_id_to_ordered_image_infos_mapping(image_prediction_requests)
         test_ids, image_infos = BatchImagePredictionRequestInfo.__generate_batch_data(test_id_to_ordered_image_infos)
-        batch_pil_images = ModelImageConverter.get_all_pil_images(image_infos)
-        image_array = ModelImageConverter.generate_image_array_for_prediction(batch_pil_images, target_image_width, target_image_height)
-        return BatchImagePredictionRequestInfo(test_ids, image_infos, image_array)
+        cached_predictions = [None] * len(image_infos)
+        cached_features = [None] * len(image_infos)
+
+        # Images with cached predictions need nothing else, and images with cached features don't need decoding.  The
+        # image array only holds the rest.
+        if prediction_store is not None:
+            cached_predictions = prediction_store.get_cached_predictions(image_infos)
+
+        unpredicted_indexes = [index for index, predictions in enumerate(cached_predictions) if predictions is None]
+
+        if feature_store is not None and len(unpredicted_indexes) > 0:
+            unpredicted_cached_features = feature_store.get_cached_features([image_infos[index] for index in unpredicted_indexes])
+
+            for index, features in zip(unpredicted_indexes, unpredicted_cached_features):
+                cached_features[index] = features
+
+        uncached_image_infos = [image_infos[index] for index in unpredicted_indexes if cached_features[index] is None]
+
+        # With a prefetcher the image array is filled asynchronously by a worker process
+        if prefetcher is not None and len(uncached_image_infos) > 0:
+            return BatchImagePredictionRequestInfo(test_ids, image_infos, None, prefetcher.submit(uncached_image_infos), cached_features,
+                                                   cached_predictions)
+
+        image_array = ModelImageConverter.generate_image_array_for_image_infos(uncached_image_infos, target_image_width, target_image_height,
+                                                                               resampling_mode)
+        return BatchImagePredictionRequestInfo(test_ids, image_infos, image_array, None, cached_features, cached_predictions)
 
     @staticmethod
     def __generate_test_id_to_ordered_image_infos_mapping(image_prediction_requests: [ImagePredictionRequest]) -> {}:
@@ -42,14 +72,43 @@ class BatchImagePredictionRequestInfo:
             batch_image_infos.append(image_info)
             batch_test_ids.append(current_test_id)
 
-    def __init__(self, test_ids: [int], image_infos: [ImageInfo], image_array: [int]):
+    def __init__(self, test_ids: [int], image_infos: [ImageInfo], image_array: [int], prefetched_batch: PrefetchedImageBatch = None,
+                 cached_features: [] = None, cached_predictions: [] = None):
         self.__test_ids = test_ids
         self.__image_infos = image_infos
         self.__image_array = image_array
+        self.__prefetched_batch = prefetched_batch
+        self.__cached_features = cached_features if cached_features is not None else [None] * len(image_infos)
+        self.__cached_predictions = cached_predictions if cached_predictions is not None else [None] * len(image_infos)
 
+    # Holds the images of get_uncached_indexes(), in order (which is all of them without feature or prediction stores)
     def get_image_array(self):
+        if self.__image_array is None and self.__prefetched_batch is not None:
+            self.__image_array = self.__prefetched_batch.get_image_array()
+
         return self.__image_array
 
+    # Frees any shared memory backing the image array.  The array must not be used afterwards.
+    def release(self):
+        if self.__prefetched_batch is not None:
+            self.__image_array = None
+            self.__prefetched_batch.release()
+
+    # Per image info, its cached conv features, or None if there aren't any (or it has a cached prediction)
+    def get_cached_features(self) -> []:
+        return self.__cached_features
+
+    # Per image info, its cached softmax vector, or None if it still needs predicting
+    def get_cached_predictions(self) -> []:
+        return self.__cached_predictions
+
+    def get_unpredicted_indexes(self) -> [int]:
+        return [index for index, predictions in enumerate(self.__cached_predictions) if predictions is None]
+
+    # Indexes of the image infos with nothing cached, which have to go through the whole model
+    def get_uncached_indexes(self) -> [int]:
+        return [index for index in self.get_unpredicted_indexes() if self.__cached_features[index] is None]
+
     def get_test_ids(self):
         return self.__test_ids
 
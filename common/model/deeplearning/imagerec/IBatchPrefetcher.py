@@ -0,0 +1,15 @@
+from abc import ABCMeta, abstractmethod
+from common.image.ImageInfo import ImageInfo
+from common.model.deeplearning.imagerec.optimization.PrefetchedImageBatch import PrefetchedImageBatch
+
+
+# Interface
+class IBatchPrefetcher:
+    __metaclass__ = ABCMeta
+
+    # Starts filling the image array for the image infos, and returns a handle on it straight away
+    @abstractmethod
+    def submit(self, image_infos: [ImageInfo]) -> PrefetchedImageBatch: raise NotImplementedError
+
+    @abstractmethod
+    def close(self): raise NotImplementedError
@@ -1,4 +1,7 @@
 from abc import ABCMeta, abstractmethod
+from common.image.ResamplingMode import ResamplingMode
+from common.model.deeplearning.imagerec.BatchImagePredictionRequestInfo import BatchImagePredictionRequestInfo
+from common.model.deeplearning.imagerec.IBatchPrefetcher import IBatchPrefetcher
 from common.model.deeplearning.imagerec.ImagePredictionRequest import ImagePredictionRequest
 from common.model.deeplearning.imagerec.ImagePredictionResult import ImagePredictionResult
 
@@ -13,9 +16,26 @@ class IImageRecModel:
     @abstractmethod
     def get_image_height(self): raise NotImplementedError
 
+    @abstractmethod
+    def get_prediction_resampling_mode(self) -> ResamplingMode: raise NotImplementedError
+
     @abstractmethod
     def predict(self, requests: [ImagePredictionRequest], batch_size: int, details=False) -> [ImagePredictionResult]: raise NotImplementedError
 
+    # Preprocessing half of predict, kept separate so that it can run on a different thread than inference
+    @abstractmethod
+    def prepare_batch(self, requests: [ImagePredictionRequest], prefetcher: IBatchPrefetcher = None) -> BatchImagePredictionRequestInfo:
+        raise NotImplementedError
+
+    # Inference half of predict
+    @abstractmethod
+    def predict_batch(self, batch_request_info: BatchImagePredictionRequestInfo, batch_size: int, details=False) -> [ImagePredictionResult]:
+        raise NotImplementedError
+
+    # The batch size predict uses when callers don't give one
+    @abstractmethod
+    def get_prediction_batch_size(self) -> int: raise NotImplementedError
+
     @abstractmethod
     def refine_training(self, steps_per_epoch: int, number_of_epochs: int): raise NotImplementedError
 
@@ -1,60 +1,69 @@
+import numpy as np
+
 from common.image.ImageInfo import ImageInfo
 from common.model.deeplearning.imagerec.BatchImagePredictionRequestInfo import BatchImagePredictionRequestInfo
-from common.model.deeplearning.prediction.PredictionInfo import PredictionInfo
 from common.model.deeplearning.prediction.PredictionsSummary import PredictionsSummary
 
 
+# Holds the raw confidences of a test id's images (one row each), and only builds PredictionsSummary objects for them
+# when asked, since most callers just aggregate the confidences.
 class ImagePredictionResult:
     @staticmethod
-    def generate_image_prediction_results(batch_confidences: [float], batch_request_info: BatchImagePredictionRequestInfo, classes: {}):
-        test_id_to_prediction_summaries = ImagePredictionResult.__generate_test_id_to_prediction_summaries(batch_confidences,
-                                                                                                           batch_request_info.get_test_ids(), batch_request_info.get_image_infos(),
-                                                                                                           classes)
+    def generate_image_prediction_results(batch_confidences: np.ndarray, batch_request_info: BatchImagePredictionRequestInfo, classes: {}):
+        test_id_to_indexes = {}
+
+        for index, test_id in enumerate(batch_request_info.get_test_ids()):
+            if not (test_id in test_id_to_indexes):
+                test_id_to_indexes[test_id] = []
+
+            test_id_to_indexes[test_id].append(index)
+
+        batch_image_infos = batch_request_info.get_image_infos()
         image_prediction_results = []
 
-        for test_id in test_id_to_prediction_summaries.keys():
-            prediction_summaries = test_id_to_prediction_summaries[test_id]
-            image_prediction_result = ImagePredictionResult.get_instance(test_id, prediction_summaries)
+        for test_id, indexes in test_id_to_indexes.items():
+            image_infos = [batch_image_infos[index] for index in indexes]
+            image_prediction_result = ImagePredictionResult.get_instance(test_id, batch_confidences[indexes], image_infos, classes)
             image_prediction_results.append(image_prediction_result)
 
         return image_prediction_results
 
     @staticmethod
-    def get_instance(test_id: int, prediction_summaries: [PredictionsSummary]):
-        return ImagePredictionResult(test_id, prediction_summaries)
+    def get_instance(test_id: int, confidences: np.ndarray, image_infos: [ImageInfo], classes: {}):
+        return ImagePredictionResult(test_id, confidences, image_infos, classes)
 
+    # Combines results for the same test id (i.e. parts that straddled batches) into one, rows in the order given
     @staticmethod
-    def __generate_test_id_to_prediction_summaries(batch_confidences: [float], batch_test_ids: [int], batch_image_infos: [ImageInfo], classes: {}) -> {}:
-        test_id_to_prediction_summaries = {}
-
-        for index in range(len(batch_confidences)):
-            test_id = batch_test_ids[index]
-            image_info = batch_image_infos[index]
-            confidences = batch_confidences[index]
-            prediction_summary = ImagePredictionResult.__generate_prediction_summary(image_info, confidences, classes)
-
-            if not (test_id in test_id_to_prediction_summaries):
-                test_id_to_prediction_summaries[test_id] = []
+    def merge(results: []):
+        if len(results) == 1:
+            return results[0]
 
-            test_id_to_prediction_summaries[test_id].append(prediction_summary)
+        confidences = np.concatenate([result.get_confidences() for result in results])
+        image_infos = [image_info for result in results for image_info in result.get_image_infos()]
+        return ImagePredictionResult.get_instance(results[0].get_test_id(), confidences, image_infos, results[0].get_classes())
 
-        return test_id_to_prediction_summaries
-
-    @staticmethod
-    def __generate_prediction_summary(image_info: ImageInfo, confidences: [float], classes: {}) -> PredictionsSummary:
-        class_ids = range(len(confidences))
-        class_names = [classes[class_id] for class_id in class_ids]
-        prediction_infos = PredictionInfo.generate_prediction_infos(
-            confidences, class_ids, class_names, 0.0, 1.0)
-        prediction_summary = PredictionsSummary(image_info, prediction_infos)
-        return prediction_summary
-
-    def __init__(self, test_id: int, prediction_summaries: [PredictionsSummary]):
+    def __init__(self, test_id: int, confidences: np.ndarray, image_infos: [ImageInfo], classes: {}):
         self.__test_id = test_id
-        self.__prediction_summaries = prediction_summaries
+        self.__confidences = confidences
+        self.__image_infos = image_infos
+        self.__classes = classes
+        self.__prediction_summaries = None
 
     def get_test_id(self):
         return self.__test_id
 
-    def get_prediction_summaries(self):
+    # (number of images, number of classes)
+    def get_confidences(self) -> np.ndarray:
+        return self.__confidences
+
+    def get_image_infos(self) -> [ImageInfo]:
+        return self.__image_infos
+
+    def get_classes(self) -> {}:
+        return self.__classes
+
+    def get_prediction_summaries(self) -> [PredictionsSummary]:
+        if self.__prediction_summaries is None:
+            self.__prediction_summaries = PredictionsSummary.generate_instances(self.__confidences, self.__image_infos, self.__classes)
+
         return self.__prediction_summaries
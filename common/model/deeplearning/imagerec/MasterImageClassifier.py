@@ -1,19 +1,35 @@
+import numpy as np
+
 from common.image.ImageInfo import ImageInfo
 from common.image.ImageSplitter import ImageSplitter
 from common.model.deeplearning.imagerec.IImageRecModel import IImageRecModel
-from common.model.deeplearning.imagerec.ImagePredictionRequest import ImagePredictionRequest
+from common.model.deeplearning.imagerec.ImagePredictionResult import ImagePredictionResult
+from common.model.deeplearning.imagerec.StreamingPredictionPipeline import StreamingPredictionPipeline
+from common.model.deeplearning.imagerec.optimization.CropPolicy import CropPolicy
+from common.model.deeplearning.prediction.PredictionAggregator import PredictionAggregator
+from common.model.deeplearning.prediction.PredictionFusionMode import PredictionFusionMode
 from common.model.deeplearning.prediction.PredictionsSummary import PredictionsSummary
-from common.math.MathUtils import MathUtils
 from common.model.deeplearning.test.TestResultSummary import TestResultSummary
 
 
 class MasterImageClassifier:
-    def __init__(self, model: IImageRecModel):
+    # num_decode_workers > 0 moves image decoding/preprocessing into that many worker processes.  fusion_mode decides how
+    # the predictions for a test id's images are combined, and crop_policy which crops are made with image splitting (all
+    # of them by default; see CropPolicyEvaluator).  With early_exit_confidence, image splitting only crops images whose
+    # full image prediction is less sure of its top class than that.
+    def __init__(self, model: IImageRecModel, max_queue_size: int = 2, num_decode_workers: int = 0,
+                 fusion_mode: PredictionFusionMode = PredictionFusionMode.MAX, crop_policy: CropPolicy = None,
+                 early_exit_confidence: float = None):
         self.__model = model
+        self.__fusion_mode = fusion_mode
+        self.__crop_policy = crop_policy if crop_policy is not None else CropPolicy.get_all_crop_families_instance()
+        self.__early_exit_confidence = early_exit_confidence
+        self.__max_queue_size = max_queue_size
+        self.__num_decode_workers = num_decode_workers
 
     # Takes source image info, creates different versions of the same image,
-    # and returns the prediction with the most confidence
-    # TODO:  Determine batch sizes automatically?  That would be nice!
+    # and returns the prediction with the most confidence.  A batch_size of None uses the model's own (which can be tuned
+    # to the machine, see BatchSizeTuner).
 
     def get_all_test_results(self, test_images_path: str, use_image_splitting: bool, batch_size: int, class_name: str) -> [TestResultSummary]:
         prediction_summaries = self.get_all_predictions(test_images_path, use_image_splitting, batch_size)
@@ -25,55 +41,84 @@ class MasterImageClassifier:
 
         return test_result_summaries
 
-    def get_all_predictions(self, test_images_path: str, use_image_splitting: bool, batch_size: int) -> [PredictionsSummary]:
-        source_image_infos = ImageInfo.load_image_infos_from_directory(test_images_path)
-        test_image_infos = MasterImageClassifier.__generate_all_test_images(source_image_infos, use_image_splitting)
+    def get_all_predictions(self, test_images_path: str, use_image_splitting: bool, batch_size: int = None) -> [PredictionsSummary]:
+        return list(self.generate_predictions(test_images_path, use_image_splitting, batch_size))
 
-        prediction_summaries = []
-        images_per_test_id = int(round(len(test_image_infos) / len(source_image_infos), 0))
-        request_size = MathUtils.lcm(batch_size, images_per_test_id)
+    # Streams final predictions out as soon as they're ready, so that consumers (i.e. csv writers) can start before
+    # inference over the whole test set finishes.  Memory use stays fixed regardless of how big the test set is.
+    def generate_predictions(self, test_images_path: str, use_image_splitting: bool, batch_size: int = None):
+        if batch_size is None:
+            batch_size = self.__model.get_prediction_batch_size()
 
-        while len(test_image_infos) > 0:
-            batch_test_image_infos = []
-            # To reduce memory footprint- only request a portion at a time that is lcm of the batch size and number of
-            # test images per test id, to group same test id images together
-            while len(test_image_infos) > 0 and len(batch_test_image_infos) < request_size:
-                batch_test_image_infos.append(test_image_infos.pop())
+        if use_image_splitting and self.__early_exit_confidence is not None:
+            for prediction_summary in self.__generate_early_exit_predictions(test_images_path, batch_size):
+                yield prediction_summary
 
-            prediction_summaries.extend(self.__get_predictions_for_all_images(batch_test_image_infos, batch_size))
+            return
 
-        return prediction_summaries
+        source_image_infos = ImageInfo.generate_image_infos_from_directory(test_images_path)
+        pipeline = StreamingPredictionPipeline(self.__model, batch_size, self.__max_queue_size, self.__num_decode_workers)
 
-    @staticmethod
-    def __generate_all_test_images(full_image_infos: [ImageInfo], use_image_splitting: bool):
+        def generate_test_images(source_image_info: ImageInfo) -> [ImageInfo]:
+            return self.__generate_all_test_images([source_image_info], use_image_splitting)
+
+        for results in pipeline.generate_result_batches(source_image_infos, generate_test_images):
+            for prediction_summary in self.__generate_final_prediction_summaries(results):
+                yield prediction_summary
+
+    # Stage one predicts the full images alone, and those sure enough of their top class are done.  Stage two then crops
+    # just the rest, batched together, and fuses the crops' predictions with their full image's.  Results come out of
+    # order:  the confident images as stage one goes, then the rest.
+    def __generate_early_exit_predictions(self, test_images_path: str, batch_size: int):
+        source_image_infos = ImageInfo.generate_image_infos_from_directory(test_images_path)
+        full_image_pipeline = StreamingPredictionPipeline(self.__model, batch_size, self.__max_queue_size, self.__num_decode_workers)
+        test_id_to_full_image_result = {}
+        unconfident_image_infos = []
+
+        def generate_full_image(source_image_info: ImageInfo) -> [ImageInfo]:
+            return [source_image_info]
+
+        for results in full_image_pipeline.generate_result_batches(source_image_infos, generate_full_image):
+            confident_results = []
+
+            for result in results:
+                if result.get_confidences().max() >= self.__early_exit_confidence:
+                    confident_results.append(result)
+                else:
+                    test_id_to_full_image_result[result.get_test_id()] = result
+                    unconfident_image_infos.append(result.get_image_infos()[0])
+
+            if len(confident_results) > 0:
+                for prediction_summary in self.__generate_final_prediction_summaries(confident_results):
+                    yield prediction_summary
+
+        crop_pipeline = StreamingPredictionPipeline(self.__model, batch_size, self.__max_queue_size, self.__num_decode_workers)
+
+        def generate_crops(source_image_info: ImageInfo) -> [ImageInfo]:
+            return ImageSplitter.get_image_portions(source_image_info, self.__crop_policy.get_crop_families())
+
+        for results in crop_pipeline.generate_result_batches(unconfident_image_infos, generate_crops):
+            merged_results = [ImagePredictionResult.merge([test_id_to_full_image_result.pop(result.get_test_id()), result]) for result in results]
+
+            for prediction_summary in self.__generate_final_prediction_summaries(merged_results):
+                yield prediction_summary
+
+        # Left over when there's nothing to crop (i.e. a crop policy without any crop families)
+        if len(test_id_to_full_image_result) > 0:
+            for prediction_summary in self.__generate_final_prediction_summaries(list(test_id_to_full_image_result.values())):
+                yield prediction_summary
+
+    def __generate_all_test_images(self, full_image_infos: [ImageInfo], use_image_splitting: bool):
         test_image_infos = []
 
         for full_image_info in full_image_infos:
             test_image_infos.append(full_image_info)
 
             if use_image_splitting:
-                test_image_infos.extend(ImageSplitter.get_image_divided_into_square_quadrants(full_image_info))
-                test_image_infos.extend(ImageSplitter.get_image_divided_into_cross_quadrants(full_image_info))
-                test_image_infos.extend(ImageSplitter.get_image_divided_into_horizontal_halves(full_image_info))
-                test_image_infos.extend(ImageSplitter.get_image_divided_into_vertical_halves(full_image_info))
-                test_image_infos.extend(ImageSplitter.get_image_divided_into_square_three_quarters_corners(full_image_info))
-                test_image_infos.extend(ImageSplitter.get_image_divided_into_three_quarters_cross(full_image_info))
-                test_image_infos.extend(ImageSplitter.get_image_half_center(full_image_info))
+                test_image_infos.extend(ImageSplitter.get_image_portions(full_image_info, self.__crop_policy.get_crop_families()))
 
         return test_image_infos
 
-    def __get_predictions_for_all_images(self, image_infos: [ImageInfo], batch_size: int) -> [PredictionsSummary]:
-        requests = ImagePredictionRequest.generate_instances(image_infos)
-        results = self.__model.predict(requests, batch_size)
-        final_prediction_summaries = []
-
-        for result in results:
-            all_prediction_summaries = result.get_prediction_summaries()
-            final_prediction_summary = MasterImageClassifier.__generate_final_prediction_summary(all_prediction_summaries)
-            final_prediction_summaries.append(final_prediction_summary)
-
-        return final_prediction_summaries
-
     @staticmethod
     def __get_full_image_prediction_summary(prediction_summaries: [PredictionsSummary]) -> PredictionsSummary:
         summary_with_largest_image = prediction_summaries[0]
@@ -88,12 +133,10 @@ class MasterImageClassifier:
 
         return summary_with_largest_image
 
-    # Generates "tie-breaker" out of subimage predictions if there isn't sufficient confidence on the top prediction
-    # for the full image.
-    # TODO: How exactly should that threshold be determined...?  For now, using one that works for two classes.  Definitely revisit
-    @staticmethod
-    def __generate_final_prediction_summary(prediction_summaries: [PredictionsSummary]) -> PredictionsSummary:
-        prediction_summaries.sort(reverse=True)
-        return prediction_summaries[0]
-
-
+    # Fuses each result's images into one prediction summary, for all of the results at once
+    def __generate_final_prediction_summaries(self, results: [ImagePredictionResult]) -> [PredictionsSummary]:
+        confidences = np.concatenate([result.get_confidences() for result in results])
+        group_indexes = np.repeat(np.arange(len(results)), [len(result.get_image_infos()) for result in results])
+        image_infos = [image_info for result in results for image_info in result.get_image_infos()]
+        fused_confidences, representative_rows = PredictionAggregator.fuse(confidences, group_indexes, self.__fusion_mode)
+        return PredictionsSummary.generate_instances(fused_confidences, [image_infos[row] for row in representative_rows], results[0].get_classes())
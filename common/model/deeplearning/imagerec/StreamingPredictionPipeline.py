@@ -0,0 +1,118 @@
+from common.model.deeplearning.imagerec.IImageRecModel import IImageRecModel
+from common.model.deeplearning.imagerec.ImagePredictionRequest import ImagePredictionRequest
+from common.model.deeplearning.imagerec.ImagePredictionResult import ImagePredictionResult
+from common.model.deeplearning.imagerec.optimization.SharedMemoryBatchPrefetcher import SharedMemoryBatchPrefetcher
+from common.utils.BackgroundGenerator import BackgroundGenerator
+
+
+# Generator based prediction pipeline.  Each stage runs on its own thread and hands its output to the next stage
+# through a bounded queue:
+#   directory scan -> test image (crop) generation -> preprocessing (decode/resize) -> model inference
+# Inference runs on the consuming thread, so decoding of the next chunks overlaps inference on the current one, and
+# peak memory is fixed by the queue sizes and batch size rather than by the size of the test set.  Results are
+# yielded per test id as soon as its last chunk has been through the model.
+# With num_decode_workers > 0, decoding/preprocessing is farmed out to a SharedMemoryBatchPrefetcher process pool.
+# Prepared batches that are never run through the model (i.e. when the consumer stops early) are released as the
+# stages are closed, so their prefetcher slots are handed back before the prefetcher itself is closed.
+class StreamingPredictionPipeline:
+    __PREPROCESS_STAGE_JOIN_TIMEOUT_SECONDS = 10
+
+    def __init__(self, model: IImageRecModel, batch_size: int, max_queue_size: int = 2, num_decode_workers: int = 0):
+        self.__model = model
+        self.__batch_size = batch_size
+        self.__max_queue_size = max_queue_size
+        self.__num_decode_workers = num_decode_workers
+        self.__prefetcher = None
+
+    # test_image_generator maps a source image info to all of the image infos (i.e. crops) to predict for its test id
+    def generate_results(self, source_image_infos, test_image_generator) -> [ImagePredictionResult]:
+        for results in self.generate_result_batches(source_image_infos, test_image_generator):
+            for result in results:
+                yield result
+
+    # Same as generate_results, but yields the results completed by each model batch together, so that callers can
+    # aggregate them in one go
+    def generate_result_batches(self, source_image_infos, test_image_generator) -> [[ImagePredictionResult]]:
+        scan_stage = BackgroundGenerator(source_image_infos, self.__max_queue_size * self.__batch_size, 'prediction-scan')
+        chunk_stage = BackgroundGenerator(self.__generate_request_chunks(scan_stage, test_image_generator), self.__max_queue_size,
+                                          'prediction-crop')
+        preprocess_stage = BackgroundGenerator(self.__generate_prepared_batches(chunk_stage), self.__max_queue_size, 'prediction-preprocess',
+                                               StreamingPredictionPipeline.__release_prepared_batch)
+        test_id_to_partial_results = {}
+
+        try:
+            for batch_request_info, completed_test_ids in preprocess_stage:
+                try:
+                    results = self.__model.predict_batch(batch_request_info, self.__batch_size)
+                finally:
+                    batch_request_info.release()
+
+                # A test id's images can straddle chunks, so its result is only yielded once its last chunk is in
+                for result in results:
+                    if not (result.get_test_id() in test_id_to_partial_results):
+                        test_id_to_partial_results[result.get_test_id()] = []
+
+                    test_id_to_partial_results[result.get_test_id()].append(result)
+
+                completed_results = [ImagePredictionResult.merge(test_id_to_partial_results.pop(test_id))
+                                     for test_id in completed_test_ids if test_id in test_id_to_partial_results]
+
+                if len(completed_results) > 0:
+                    yield completed_results
+        finally:
+            for stage in [preprocess_stage, chunk_stage, scan_stage]:
+                stage.close()
+
+            # The preprocess thread may be part way through preparing a batch, which it releases as soon as it sees the
+            # stage is closed.  Closing the prefetcher also wakes it up if it's waiting on a slot.
+            preprocess_stage.join(StreamingPredictionPipeline.__PREPROCESS_STAGE_JOIN_TIMEOUT_SECONDS)
+
+            if self.__prefetcher is not None:
+                self.__prefetcher.close()
+                self.__prefetcher = None
+
+    @staticmethod
+    def __release_prepared_batch(prepared_batch):
+        batch_request_info, completed_test_ids = prepared_batch
+        batch_request_info.release()
+
+    # To reduce memory footprint- only request one full batch of images at a time.  Test ids are packed in whole where
+    # they fit, and otherwise split across chunks.  Each chunk comes with the test ids whose last images are in it.
+    def __generate_request_chunks(self, source_image_infos, test_image_generator) -> [([ImagePredictionRequest], [int])]:
+        chunk = []
+        completed_test_ids = []
+        num_images_in_chunk = 0
+
+        for source_image_info in source_image_infos:
+            test_image_infos = test_image_generator(source_image_info)
+            start_index = 0
+
+            while start_index < len(test_image_infos):
+                end_index = min(len(test_image_infos), start_index + self.__batch_size - num_images_in_chunk)
+                request = ImagePredictionRequest(test_image_infos[start_index:end_index])
+                chunk.append(request)
+                num_images_in_chunk = num_images_in_chunk + end_index - start_index
+                start_index = end_index
+
+                if start_index == len(test_image_infos):
+                    completed_test_ids.append(request.get_test_id())
+
+                if num_images_in_chunk == self.__batch_size:
+                    yield chunk, completed_test_ids
+                    chunk = []
+                    completed_test_ids = []
+                    num_images_in_chunk = 0
+
+        if len(chunk) > 0:
+            yield chunk, completed_test_ids
+
+    def __generate_prepared_batches(self, request_chunks):
+        for requests, completed_test_ids in request_chunks:
+            if self.__num_decode_workers > 0 and self.__prefetcher is None:
+                # Enough slots for every worker to be busy while the queue is full and a batch is in inference
+                num_slots = self.__num_decode_workers + self.__max_queue_size + 2
+                self.__prefetcher = SharedMemoryBatchPrefetcher(self.__num_decode_workers, self.__batch_size, self.__model.get_image_width(),
+                                                                self.__model.get_image_height(), self.__model.get_prediction_resampling_mode(),
+                                                                num_slots)
+
+            yield self.__model.prepare_batch(requests, self.__prefetcher), completed_test_ids
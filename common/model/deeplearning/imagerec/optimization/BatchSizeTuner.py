@@ -0,0 +1,180 @@
+import json
+import os
+import socket
+import time
+
+import numpy as np
+from keras.models import Model, Sequential
+from keras.preprocessing import image
+
+
+# Picks batch sizes by measuring throughput on the current machine.  Each candidate batch size whose estimated memory
+# use fits in memory_budget_bytes is timed (after a warm up batch, which also covers compilation), stopping at the first
+# one that runs out of memory, and the fastest wins.  Results are saved per (model name, input/output shape, host,
+# budget) to a JSON file, so probing only happens once per machine.
+#
+# Memory is estimated rather than measured, since the backends don't report it portably:  weights (times four when
+# training, for gradients and Adam's two moments) plus every layer's output for the whole batch (times two when
+# training, for the gradients flowing back).  Running out of memory anyway is recognized by the backend's own errors;
+# anything else is re-raised.
+class BatchSizeTuner:
+    VERSION = 1
+    DEFAULT_CANDIDATE_BATCH_SIZES = [8, 16, 32, 64, 128, 256]
+
+    def __init__(self, results_path: str, memory_budget_bytes: int, candidate_batch_sizes: [int] = None, num_timed_batches: int = 3):
+        self.__results_path = results_path
+        self.__memory_budget_bytes = memory_budget_bytes
+        self.__candidate_batch_sizes = candidate_batch_sizes if candidate_batch_sizes is not None else BatchSizeTuner.DEFAULT_CANDIDATE_BATCH_SIZES
+        self.__num_timed_batches = num_timed_batches
+        self.__results = self.__load_results()
+
+    def get_prediction_batch_size(self, model: Model, model_name: str) -> int:
+        return self.__get_batch_size(model, model_name, training=False)
+
+    # The model's weights (and optimizer state) are put back afterwards, so probing doesn't train it
+    def get_training_batch_size(self, model: Model, model_name: str) -> int:
+        return self.__get_batch_size(model, model_name, training=True)
+
+    @staticmethod
+    def estimate_memory_bytes(model: Model, batch_size: int, training: bool) -> int:
+        bytes_per_value = np.dtype(image.K.floatx()).itemsize
+        num_weight_values = sum(int(np.prod(weights.shape)) for weights in model.get_weights())
+        num_activation_values = sum(BatchSizeTuner.__get_num_output_values(layer) for layer in model.layers)
+        weights_multiplier = 4 if training else 1
+        activations_multiplier = 2 if training else 1
+        return bytes_per_value * (num_weight_values * weights_multiplier + num_activation_values * activations_multiplier * batch_size)
+
+    def __get_batch_size(self, model: Model, model_name: str, training: bool) -> int:
+        key = self.__generate_key(model, model_name, training)
+
+        if not (key in self.__results):
+            print('Tuning ' + ('training' if training else 'prediction') + ' batch size for ' + model_name)
+            self.__results[key] = self.__probe(model, training)
+            self.__save_results()
+
+        return self.__results[key]['batch_size']
+
+    def __probe(self, model: Model, training: bool) -> {}:
+        images_per_second = {}
+
+        if training:
+            # The optimizer's weights (i.e. Adam's moments) only exist once the train function is built, the same as
+            # when keras loads a saved optimizer state
+            BatchSizeTuner.__make_train_function(model)
+
+        saved_weights = model.get_weights() if training else None
+        saved_optimizer_weights = model.optimizer.get_weights() if training else None
+
+        try:
+            for batch_size in sorted(self.__candidate_batch_sizes):
+                if BatchSizeTuner.estimate_memory_bytes(model, batch_size, training) > self.__memory_budget_bytes:
+                    break
+
+                try:
+                    seconds = self.__time_batches(model, batch_size, training)
+                except Exception as exception:
+                    if not BatchSizeTuner.__is_out_of_memory(exception):
+                        raise
+
+                    break
+
+                images_per_second[str(batch_size)] = batch_size * self.__num_timed_batches / seconds
+                print('  batch size ' + str(batch_size) + ':  ' + '{:.1f}'.format(images_per_second[str(batch_size)]) + ' images/sec')
+        finally:
+            if training:
+                model.set_weights(saved_weights)
+                model.optimizer.set_weights(saved_optimizer_weights)
+
+        if len(images_per_second) == 0:
+            # Nothing fits the budget, so go as small as possible
+            return {'batch_size': min(self.__candidate_batch_sizes), 'images_per_second': {}}
+
+        best_batch_size = max(images_per_second.keys(), key=lambda batch_size: images_per_second[batch_size])
+        return {'batch_size': int(best_batch_size), 'images_per_second': images_per_second}
+
+    def __time_batches(self, model: Model, batch_size: int, training: bool) -> float:
+        batch_x = np.random.random((batch_size,) + model.input_shape[1:]).astype(image.K.floatx())
+        batch_y = np.zeros((batch_size,) + model.output_shape[1:], dtype=image.K.floatx())
+        batch_y[:, 0] = 1
+
+        def run_batch():
+            if training:
+                model.train_on_batch(batch_x, batch_y)
+            else:
+                model.predict_on_batch(batch_x)
+
+        run_batch()
+        start = time.perf_counter()
+
+        for batch_num in range(self.__num_timed_batches):
+            run_batch()
+
+        return time.perf_counter() - start
+
+    @staticmethod
+    def __make_train_function(model: Model):
+        if isinstance(model, Sequential):
+            model.model._make_train_function()
+        else:
+            model._make_train_function()
+
+    @staticmethod
+    def __is_out_of_memory(exception: Exception) -> bool:
+        if isinstance(exception, MemoryError):
+            return True
+
+        if image.K.backend() == 'tensorflow':
+            import tensorflow as tf
+            return isinstance(exception, tf.errors.ResourceExhaustedError)
+
+        if image.K.backend() == 'theano':
+            # The old cuda backend raises RuntimeErrors, and gpuarray raises GpuArrayExceptions (not always importable)
+            gpu_error_types = (RuntimeError,)
+
+            try:
+                from pygpu.gpuarray import GpuArrayException
+                gpu_error_types = gpu_error_types + (GpuArrayException,)
+            except ImportError:
+                pass
+
+            return isinstance(exception, gpu_error_types) and 'out of memory' in str(exception).lower()
+
+        return False
+
+    def __generate_key(self, model: Model, model_name: str, training: bool) -> str:
+        return '|'.join([model_name, 'training' if training else 'prediction', str(model.input_shape[1:]), str(model.output_shape[1:]),
+                         socket.gethostname(), str(self.__memory_budget_bytes)])
+
+    @staticmethod
+    def __get_num_output_values(layer) -> int:
+        output_shape = layer.output_shape
+
+        if isinstance(output_shape, list):
+            return sum(int(np.prod(shape[1:])) for shape in output_shape)
+
+        return int(np.prod(output_shape[1:]))
+
+    def __load_results(self) -> {}:
+        if not os.path.exists(self.__results_path):
+            return {}
+
+        try:
+            with open(self.__results_path, 'r') as results_file:
+                contents = json.load(results_file)
+        except (OSError, ValueError):
+            return {}
+
+        return contents.get('results', {}) if contents.get('version') == BatchSizeTuner.VERSION else {}
+
+    def __save_results(self):
+        directory = os.path.dirname(self.__results_path)
+
+        if directory != '' and not os.path.exists(directory):
+            os.makedirs(directory)
+
+        temp_path = self.__results_path + '.tmp'
+
+        with open(temp_path, 'w') as results_file:
+            json.dump({'version': BatchSizeTuner.VERSION, 'results': self.__results}, results_file, indent=1)
+
+        os.replace(temp_path, self.__results_path)
@@ -0,0 +1,217 @@
+import queue
+import threading
+import time
+from functools import partial
+
+import numpy as np
+from keras.preprocessing import image
+
+from common.model.deeplearning.imagerec.optimization.CachedTrainingPair import CachedTrainingPair
+from common.model.deeplearning.imagerec.optimization.ConvCacheShuffleMode import ConvCacheShuffleMode
+from common.model.deeplearning.imagerec.optimization.ConvFeatureCache import ConvFeatureCache
+
+
+# Bounded producer/consumer queue of cache shards for ConvCacheIterator.  Producer threads block on the queue when it's
+# full and the consumer blocks when it's empty, so nobody spins.  The threads only reference this loader (never the
+# iterator), so the iterator can still be garbage collected, at which point it stops the loader.
+#
+# Timing counters show where time goes:  if the consumer spends a lot of time waiting (or gathering rows out of the
+# memory mapped shards) relative to the time the model takes per batch, training is I/O-bound.
+#
+# With ConvCacheShuffleMode.GLOBAL, queue items aren't whole shards but shuffle windows:  each epoch the rows of every
+# shard are cut into contiguous blocks of block_size rows and all the blocks are globally permuted.  A window takes
+# the next blocks_per_window blocks, reads each one as a contiguous slice (in file order), and scatters the rows into
+# a shuffled in-memory window, dequantized to floatx.  queue_size must be at least num_threads.
+#
+# With num_variants, the cache holds that many augmented variants of each image (see ConvCacheSourceSequence), and
+# every time an image comes up, one of its variants is picked at random to stand for it.  Blocks and rows are then
+# counted in images rather than cache rows, so an epoch still goes over each image once.
+class CacheShardLoader:
+    def __init__(self, cache: ConvFeatureCache, shuffle: bool, num_threads: int, queue_size: int,
+                 shuffle_mode: ConvCacheShuffleMode = ConvCacheShuffleMode.FILE_LOCAL, block_size: int = 8, blocks_per_window: int = 32,
+                 seed: int = None, num_variants: int = 1):
+        self.__cache = cache
+        self.__num_variants = num_variants
+        self.__shuffle = shuffle
+        self.__use_global_shuffle = shuffle and shuffle_mode == ConvCacheShuffleMode.GLOBAL
+        self.__block_size = block_size
+        self.__blocks_per_window = blocks_per_window
+        self.__random_state = np.random.RandomState(seed)
+        self.__block_array = np.zeros((0, 3), dtype=int)
+        self.__part_arrays = {}
+        self.__queue = queue.Queue(maxsize=queue_size)
+        self.__stop_event = threading.Event()
+        self.__file_num_lock = threading.Lock()
+        self.__file_num_array = np.array([], dtype=int)
+        self.__stats_lock = threading.Lock()
+        self.__consumer_wait_seconds = 0.0
+        self.__consumer_gather_seconds = 0.0
+        self.__producer_load_seconds = 0.0
+        self.__num_shards_loaded = 0
+        self.__threads = []
+
+        for thread_num in range(num_threads):
+            thread = threading.Thread(target=self.__populate_queue, name='conv-cache-loader-' + str(thread_num))
+            thread.daemon = True
+            thread.start()
+            self.__threads.append(thread)
+
+    def get_next_pair(self) -> CachedTrainingPair:
+        start = time.perf_counter()
+        array_pair = self.__queue.get()
+        self.__add_consumer_wait_seconds(time.perf_counter() - start)
+        return array_pair
+
+    # The shards are memory mapped, so the actual reads happen when the consumer gathers a batch's rows
+    def gather(self, array_pair: CachedTrainingPair, index_array: np.ndarray) -> (np.ndarray, np.ndarray):
+        start = time.perf_counter()
+        array_index_array = array_pair.get_array_indexes(index_array)
+        batch_x = array_pair.dequantize_features(array_pair.get_feature_array()[array_index_array])
+        batch_y = array_pair.get_label_array()[array_index_array]
+
+        with self.__stats_lock:
+            self.__consumer_gather_seconds = self.__consumer_gather_seconds + time.perf_counter() - start
+
+        return batch_x, batch_y
+
+    def stop(self, timeout_seconds: float = 1.0):
+        if self.__stop_event.is_set():
+            return
+
+        self.__stop_event.set()
+        # Frees a slot for every producer that may be blocked on a full queue; each puts at most once more, then exits
+        self.__drain_queue()
+
+        for thread in self.__threads:
+            if thread is not threading.current_thread():
+                thread.join(timeout_seconds)
+
+        self.__drain_queue()
+
+    def is_stopped(self) -> bool:
+        return self.__stop_event.is_set()
+
+    # Rows in each queued pair are already shuffled when global shuffling is on
+    def is_pre_shuffled(self) -> bool:
+        return self.__use_global_shuffle
+
+    def get_consumer_wait_seconds(self) -> float:
+        return self.__consumer_wait_seconds
+
+    def get_consumer_gather_seconds(self) -> float:
+        return self.__consumer_gather_seconds
+
+    def get_producer_load_seconds(self) -> float:
+        return self.__producer_load_seconds
+
+    def get_num_shards_loaded(self) -> int:
+        return self.__num_shards_loaded
+
+    def __add_consumer_wait_seconds(self, seconds: float):
+        with self.__stats_lock:
+            self.__consumer_wait_seconds = self.__consumer_wait_seconds + seconds
+
+    def __populate_queue(self):
+        while not self.__stop_event.is_set():
+            if self.__use_global_shuffle:
+                window_blocks = self.__get_next_window_blocks()
+                start = time.perf_counter()
+                array_pair = self.__load_shuffle_window(window_blocks)
+            else:
+                file_num = self.__get_next_file_num()
+                start = time.perf_counter()
+                array_pair = CachedTrainingPair(feature_array=self.__cache.load_features(file_num), label_array=self.__cache.load_labels(file_num),
+                                                feature_dequantizer=partial(self.__cache.dequantize_features, file_num),
+                                                row_index_array=self.__generate_variant_row_index_array(file_num))
+
+            with self.__stats_lock:
+                self.__producer_load_seconds = self.__producer_load_seconds + time.perf_counter() - start
+                self.__num_shards_loaded = self.__num_shards_loaded + 1
+
+            self.__queue.put(array_pair)
+
+    def __get_next_file_num(self) -> int:
+        with self.__file_num_lock:
+            if len(self.__file_num_array) == 0:
+                num_parts = self.__cache.get_num_parts()
+                self.__file_num_array = np.random.permutation(num_parts) if self.__shuffle else np.arange(num_parts)
+
+            file_num, self.__file_num_array = self.__file_num_array[0], self.__file_num_array[1:]
+            return file_num
+
+    def __get_next_window_blocks(self) -> np.ndarray:
+        with self.__file_num_lock:
+            if len(self.__block_array) == 0:
+                self.__block_array = self.__generate_epoch_block_array()
+
+            window_blocks = self.__block_array[:self.__blocks_per_window]
+            self.__block_array = self.__block_array[self.__blocks_per_window:]
+            return window_blocks
+
+    # One randomly picked variant's row per image of the part, or None when there's a single variant (i.e. every row)
+    def __generate_variant_row_index_array(self, part_num: int):
+        if self.__num_variants == 1:
+            return None
+
+        num_images = self.__cache.get_part_num_rows(part_num) // self.__num_variants
+
+        with self.__file_num_lock:
+            variant_nums = self.__random_state.randint(self.__num_variants, size=num_images)
+
+        return np.arange(num_images) * self.__num_variants + variant_nums
+
+    # Images [begin, end) of part_num for every block, in a random order
+    def __generate_epoch_block_array(self) -> np.ndarray:
+        blocks = []
+
+        for part_num in range(self.__cache.get_num_parts()):
+            num_images = self.__cache.get_part_num_rows(part_num) // self.__num_variants
+            for begin in range(0, num_images, self.__block_size):
+                blocks.append((part_num, begin, min(begin + self.__block_size, num_images)))
+
+        block_array = np.array(blocks, dtype=int).reshape((-1, 3))
+        return block_array[self.__random_state.permutation(len(block_array))]
+
+    def __load_shuffle_window(self, window_blocks: np.ndarray) -> CachedTrainingPair:
+        # Reading in file order keeps each shard's reads sequential
+        window_blocks = window_blocks[np.lexsort((window_blocks[:, 1], window_blocks[:, 0]))]
+        num_rows = int(np.sum(window_blocks[:, 2] - window_blocks[:, 1]))
+        first_features, first_labels = self.__get_part_arrays(window_blocks[0][0])
+        window_features = np.empty((num_rows,) + first_features.shape[1:], dtype=image.K.floatx())
+        window_labels = np.empty((num_rows,) + first_labels.shape[1:], dtype=first_labels.dtype)
+        # Each block's rows are scattered straight to their shuffled positions, so there's only one copy
+        destinations = self.__random_state.permutation(num_rows)
+        offset = 0
+
+        for part_num, begin, end in window_blocks:
+            features, labels = self.__get_part_arrays(part_num)
+            block_destinations = destinations[offset:offset + end - begin]
+            block_rows = self.__generate_block_row_index_array(begin, end)
+            window_features[block_destinations] = self.__cache.dequantize_features(part_num, features[block_rows])
+            window_labels[block_destinations] = labels[block_rows]
+            offset = offset + end - begin
+
+        return CachedTrainingPair(feature_array=window_features, label_array=window_labels)
+
+    # Cache rows of images [begin, end):  a contiguous slice, or with variants, one random variant's row of each image
+    # (which still reads the block's rows in file order)
+    def __generate_block_row_index_array(self, begin: int, end: int):
+        if self.__num_variants == 1:
+            return slice(begin, end)
+
+        variant_nums = self.__random_state.randint(self.__num_variants, size=end - begin)
+        return np.arange(begin, end) * self.__num_variants + variant_nums
+
+    def __get_part_arrays(self, part_num: int) -> (np.ndarray, np.ndarray):
+        with self.__file_num_lock:
+            if not (part_num in self.__part_arrays):
+                self.__part_arrays[part_num] = (self.__cache.load_features(part_num), self.__cache.load_labels(part_num))
+
+            return self.__part_arrays[part_num]
+
+    def __drain_queue(self):
+        while True:
+            try:
+                self.__queue.get_nowait()
+            except queue.Empty:
+                return
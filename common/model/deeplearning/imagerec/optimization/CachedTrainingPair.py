@@ -1,12 +1,37 @@
 import numpy as np
 
 class CachedTrainingPair:
-    def __init__(self, feature_array: np.ndarray, label_array: np.ndarray):
+    # With a row index array, the pair only serves those rows of the arrays (i.e. one augmented variant per image), as if
+    # they were the whole arrays
+    def __init__(self, feature_array: np.ndarray, label_array: np.ndarray, feature_dequantizer=None, row_index_array: np.ndarray = None):
         self.__FEATURE_ARRAY = feature_array
         self.__LABEL_ARRAY = label_array
+        self.__FEATURE_DEQUANTIZER = feature_dequantizer
+        self.__ROW_INDEX_ARRAY = row_index_array
 
     def get_feature_array(self):
         return self.__FEATURE_ARRAY
 
     def get_label_array(self):
-        return self.__LABEL_ARRAY
\ No newline at end of file
+        return self.__LABEL_ARRAY
+
+    def get_num_rows(self) -> int:
+        if self.__ROW_INDEX_ARRAY is None:
+            return len(self.__FEATURE_ARRAY)
+
+        return len(self.__ROW_INDEX_ARRAY)
+
+    # Positions in the arrays of the served rows at index_array.  Row index arrays are ascending, so sorted indexes stay
+    # sorted.
+    def get_array_indexes(self, index_array: np.ndarray) -> np.ndarray:
+        if self.__ROW_INDEX_ARRAY is None:
+            return index_array
+
+        return self.__ROW_INDEX_ARRAY[index_array]
+
+    # Rows of the feature array are stored at the cache's storage type; this turns them back into floatx
+    def dequantize_features(self, feature_rows: np.ndarray) -> np.ndarray:
+        if self.__FEATURE_DEQUANTIZER is None:
+            return feature_rows
+
+        return self.__FEATURE_DEQUANTIZER(feature_rows)
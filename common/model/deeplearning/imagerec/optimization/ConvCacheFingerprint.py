@@ -0,0 +1,88 @@
+import hashlib
+import os
+import zlib
+
+import numpy as np
+from keras.models import Sequential
+
+from common.dataset.PackedDataset import PackedDataset
+from common.model.deeplearning.imagerec.optimization.ConvFeatureStorageType import ConvFeatureStorageType
+
+
+# Keys that decide whether cached conv features can be reused.  The cache key covers everything that applies to the
+# whole cache (batch id, target size, conv weights, storage type); each part's input key adds the part's files, their
+# mtimes and sizes, and their labels on top of that.  A part is recomputed exactly when its input key changes.  Caches
+# of augmented variants also key on the number of variants and the augmentation settings.
+class ConvCacheFingerprint:
+    @staticmethod
+    def get_model_fingerprint(model: Sequential) -> str:
+        digest = hashlib.sha1()
+
+        for layer in model.layers:
+            digest.update(layer.__class__.__name__.encode('utf-8'))
+            for weights in layer.get_weights():
+                digest.update(str(weights.shape).encode('utf-8'))
+                digest.update(np.ascontiguousarray(weights).tobytes())
+
+        return digest.hexdigest()
+
+    # The generator's plain settings (ranges, flags and so on); arrays fitted to data and functions aren't included
+    @staticmethod
+    def get_augmentation_fingerprint(augmentation_generator, num_variants: int) -> str:
+        settings = sorted((name, repr(value)) for name, value in vars(augmentation_generator).items()
+                          if value is None or isinstance(value, (bool, int, float, str, tuple, list)))
+        return ConvCacheFingerprint.__hash_strings([str(num_variants)] + [name + '=' + value for name, value in settings])
+
+    @staticmethod
+    def get_cache_key(batch_id: str, target_size: tuple, model_fingerprint: str, storage_type: ConvFeatureStorageType,
+                      augmentation_fingerprint: str = None) -> str:
+        strings = [batch_id, str(tuple(target_size)), model_fingerprint, storage_type.name]
+
+        if augmentation_fingerprint is not None:
+            strings.append(augmentation_fingerprint)
+
+        return ConvCacheFingerprint.__hash_strings(strings)
+
+    @staticmethod
+    def get_part_input_key(cache_key: str, directory: str, file_names: [str], classes: np.ndarray) -> str:
+        strings = [cache_key]
+
+        for file_name, class_index in zip(file_names, classes):
+            file_stat = os.stat(PackedDataset.get_file_path(os.path.join(directory, file_name)))
+            strings.append(file_name + ':' + str(file_stat.st_mtime_ns) + ':' + str(file_stat.st_size) + ':' + str(int(class_index)))
+
+        return ConvCacheFingerprint.__hash_strings(strings)
+
+    # Splits the (sorted) file list into parts of roughly target_num_rows each.  Boundaries are picked from the file
+    # names themselves rather than from positions, so adding or removing a file only moves the boundaries around it and
+    # the other parts keep their input keys.
+    @staticmethod
+    def generate_part_ranges(file_names: [str], target_num_rows: int) -> [(int, int)]:
+        min_num_rows = max(1, target_num_rows // 2)
+        max_num_rows = target_num_rows * 2
+        boundary_modulus = max(1, target_num_rows - min_num_rows)
+        part_ranges = []
+        begin = 0
+
+        for index, file_name in enumerate(file_names):
+            num_rows = index + 1 - begin
+            is_boundary = num_rows >= min_num_rows and zlib.crc32(file_name.encode('utf-8')) % boundary_modulus == 0
+
+            if is_boundary or num_rows >= max_num_rows:
+                part_ranges.append((begin, index + 1))
+                begin = index + 1
+
+        if begin < len(file_names):
+            part_ranges.append((begin, len(file_names)))
+
+        return part_ranges
+
+    @staticmethod
+    def __hash_strings(strings: [str]) -> str:
+        digest = hashlib.sha1()
+
+        for string in strings:
+            digest.update(string.encode('utf-8'))
+            digest.update(b'\n')
+
+        return digest.hexdigest()
@@ -1,4 +1,4 @@
-from keras.preprocessing.image import array_to_img, NumpyArrayIterator, Iterator, DirectoryIterator
+from keras.preprocessing.image import array_to_img, NumpyArrayIterator, Iterator, DirectoryIterator, ImageDataGenerator
 import numpy as np
 import os
 import threading
@@ -7,54 +7,94 @@ import multiprocessing.pool
 from functools import partial
 from keras.models import Sequential
 from keras.preprocessing import image
+from keras.utils.data_utils import OrderedEnqueuer
 from keras.utils.np_utils import to_categorical
-import bcolz
-from collections import deque
-import time
-import threading
+import weakref
 
 
+from common.model.deeplearning.imagerec.optimization.CacheShardLoader import CacheShardLoader
 from common.model.deeplearning.imagerec.optimization.CachedTrainingPair import CachedTrainingPair
-from common.model.deeplearning.imagerec.optimization.TransparentDirectoryIterator import TransparentDirectoryIterator
+from common.model.deeplearning.imagerec.optimization.ConvCacheFingerprint import ConvCacheFingerprint
+from common.model.deeplearning.imagerec.optimization.ConvCacheShuffleMode import ConvCacheShuffleMode
+from common.model.deeplearning.imagerec.optimization.ConvCacheSourceSequence import ConvCacheSourceSequence
+from common.model.deeplearning.imagerec.optimization.ConvFeatureCache import ConvFeatureCache
+from common.model.deeplearning.imagerec.optimization.ConvFeatureStorageType import ConvFeatureStorageType
 
 
+# Online augmentation:  with num_augmented_variants, the cache holds the conv features of that many seeded
+# augmentation_generator variants of each image, all computed in one pass over the decoded source images (so no
+# augmented images are ever written to disk).  Training then serves one randomly picked variant per image per epoch.
 class ConvCacheIterator(Iterator):
     def __init__(self, cache_directory: str, batches: DirectoryIterator, batch_id: str, conv_model: Sequential, batch_size=32,
-                 shuffle=False, seed=None, steps_per_file=20):
-        self.FILE_NUM_ARRAY = np.array([])
+                 shuffle=False, seed=None, steps_per_file=20, shuffle_mode=ConvCacheShuffleMode.FILE_LOCAL, num_loading_workers=4,
+                 loading_queue_size=10, storage_type=ConvFeatureStorageType.FLOATX, num_augmented_variants=0,
+                 augmentation_generator: ImageDataGenerator = None):
         self.batch_index = 0
-        self.FILE_NUM_LOCK = threading.Lock()
-        self.FILE_QUEUE_APPEND_LOCK = threading.Lock()
         self.FILE_QUEUE_SIZE = 3
+        self.NUM_LOADING_WORKERS = num_loading_workers
+        self.LOADING_QUEUE_SIZE = loading_queue_size
         self.SHUFFLE = shuffle
         self.CONV_MODEL = conv_model
         self.SOURCE_BATCHES = batches
         self.CACHE_DIRECTORY = cache_directory
         ConvCacheIterator.__establish_directory_if_needed(cache_directory)
         self.BATCH_SIZE = batch_size
-        self.LABELS = self.__onehot(batches.classes)
+        self.LABELS = self.__onehot(batches.classes).astype(image.K.floatx())
         self.BATCH_ID = batch_id
         self.STEPS_PER_FILE = steps_per_file
         self.NUM_ITEMS_IN_BATCHES = batches.samples
         self.n = self.NUM_ITEMS_IN_BATCHES
-        self.NUM_CACHE_PARTS = int(np.ceil(self.NUM_ITEMS_IN_BATCHES / self.BATCH_SIZE / self.STEPS_PER_FILE))
+        self.AUGMENTATION_GENERATOR = augmentation_generator if num_augmented_variants > 0 else None
+        self.NUM_VARIANTS = num_augmented_variants if self.AUGMENTATION_GENERATOR is not None else 1
+        # Parts keep about the same number of rows however many variants each image has
+        self.PART_RANGES = ConvCacheFingerprint.generate_part_ranges(batches.filenames,
+                                                                     max(1, self.BATCH_SIZE * self.STEPS_PER_FILE // self.NUM_VARIANTS))
+        self.NUM_CACHE_PARTS = len(self.PART_RANGES)
+        self.STORAGE_TYPE = storage_type
+        augmentation_fingerprint = None if self.AUGMENTATION_GENERATOR is None \
+            else ConvCacheFingerprint.get_augmentation_fingerprint(self.AUGMENTATION_GENERATOR, self.NUM_VARIANTS)
+        self.CACHE_KEY = ConvCacheFingerprint.get_cache_key(batch_id, batches.target_size, ConvCacheFingerprint.get_model_fingerprint(conv_model),
+                                                            storage_type, augmentation_fingerprint)
+        self.CACHE = ConvFeatureCache(cache_directory, batch_id, self.CACHE_KEY, storage_type)
         self.__generate_batch_data_cache_if_needed()
-        self.CACHE_FILE_QUEUE = deque(maxlen=self.FILE_QUEUE_SIZE)
-        self.__start_file_load_daemon_threads()
+        self.GLOBAL_SHUFFLE = shuffle and shuffle_mode == ConvCacheShuffleMode.GLOBAL
+        self.LOADER = CacheShardLoader(self.CACHE, shuffle=shuffle, num_threads=self.FILE_QUEUE_SIZE, queue_size=self.FILE_QUEUE_SIZE,
+                                       shuffle_mode=shuffle_mode, seed=seed, num_variants=self.NUM_VARIANTS)
+        # The loader threads don't reference this iterator, so it can be collected; stop them when it is
+        self.__finalizer = weakref.finalize(self, self.LOADER.stop)
         super(ConvCacheIterator, self).__init__(0, batch_size=batch_size, shuffle=shuffle, seed=seed)
 
     def next(self):
         with self.lock:
             return next(self.index_generator)
 
-    def __start_file_load_daemon_threads(self):
-        for thread_num in range(self.FILE_QUEUE_SIZE):
-            thread = threading.Thread(target=self.__file_queue_populator_thread, args=())
-            thread.daemon = True
-            thread.start()
+    def close(self):
+        self.__finalizer()
+
+    # Steps for one pass over every image.  Batches never straddle parts, so that's each part's batches added up rather
+    # than the number of images over the batch size.  With global shuffling, batches come out of shuffle windows of
+    # random blocks instead, so this is the nearest estimate (an epoch's boundary may then land part way into a window).
+    def get_num_steps_per_epoch(self) -> int:
+        if self.GLOBAL_SHUFFLE:
+            return int(np.ceil(self.NUM_ITEMS_IN_BATCHES / self.BATCH_SIZE))
+
+        return sum(int(np.ceil((end - begin) / self.BATCH_SIZE)) for begin, end in self.PART_RANGES)
+
+    # Total time the training loop spent blocked waiting for a shard to be loaded
+    def get_consumer_wait_seconds(self) -> float:
+        return self.LOADER.get_consumer_wait_seconds()
+
+    # Total time spent gathering batch rows out of the memory mapped shards (this is where the disk reads happen)
+    def get_consumer_gather_seconds(self) -> float:
+        return self.LOADER.get_consumer_gather_seconds()
+
+    # Bytes on disk taken by the cache's shards
+    def get_cache_num_bytes(self) -> int:
+        return self.CACHE.get_num_bytes()
 
-        while len(self.CACHE_FILE_QUEUE) < self.FILE_QUEUE_SIZE:
-            time.sleep(0.01)
+    # Total time the loader threads spent opening shards
+    def get_producer_load_seconds(self) -> float:
+        return self.LOADER.get_producer_load_seconds()
 
     def _flow_index(self, n, batch_size=32, shuffle=False, seed=None):
         self.reset()
@@ -86,9 +126,9 @@ class ConvCacheIterator(Iterator):
                 index_array = self.__generate_index_array(shuffle=shuffle, num_entries_in_file=num_entries_in_file, seed=seed)
 
             self.total_batches_seen += 1
-            batch_index_array = index_array[current_index: current_index + current_batch_size]
-            batch_x = self.CURRENT_FEATURE_ARRAY[batch_index_array]
-            batch_y = self.CURRENT_LABEL_ARRAY[batch_index_array]
+            # Sorted so that rows are gathered from the memory mapped features in file order
+            batch_index_array = np.sort(index_array[current_index: current_index + current_batch_size])
+            batch_x, batch_y = self.LOADER.gather(self.CURRENT_ARRAY_PAIR, batch_index_array)
             num_entries_batch_x = len(batch_x)
             num_entries_batch_y = len(batch_y)
 
@@ -103,122 +143,63 @@ class ConvCacheIterator(Iterator):
         if seed is not None:
             np.random.seed(seed + self.total_batches_seen)
 
-        if shuffle:
+        if shuffle and not self.LOADER.is_pre_shuffled():
             return np.random.permutation(num_entries_in_file)
         else:
             return np.arange(num_entries_in_file)
 
-    #TODO:  make this smarter eventually
-    def __cache_exists(self):
-        cache_path = self.__generate_features_cache_path(file_num=0)
-        return os.path.exists(cache_path)
-
+    # Only parts whose input key (files, mtimes, labels, conv weights, target size) changed are recomputed.  Each
+    # part is saved as soon as it's done, so an interrupted run picks up where it left off.
     def __generate_batch_data_cache_if_needed(self):
-        if self.__cache_exists():
-            return
-
-        batch_labels_list = []
-
-        def record_labels(batch_x, batch_y):
-            batch_labels_list.append(batch_y)
-
-        num_samples_cached = 0
-        transparent_batches = TransparentDirectoryIterator(self.SOURCE_BATCHES, record_labels)
-
-        for cache_part_num in range(self.NUM_CACHE_PARTS):
-            print('Caching model features for ' + self.BATCH_ID + ', part ' + str(cache_part_num+1) + ' out of ' + str(self.NUM_CACHE_PARTS))
-            num_items_remaining = self.NUM_ITEMS_IN_BATCHES - num_samples_cached
-            features_array_raw = self.CONV_MODEL.predict_generator(transparent_batches, self.STEPS_PER_FILE, max_queue_size=1)
-            #only take the number of items needed to match total number of samples in source batch
-            num_items_to_fetch = min(len(features_array_raw), num_items_remaining)
-            features_array = features_array_raw[:num_items_to_fetch]
-            features_cache_path = self.__generate_features_cache_path(cache_part_num)
-            ConvCacheIterator.__save_array(features_cache_path, features_array)
-            features_array_length = len(features_array)
-            labels_array = np.zeros(tuple([features_array_length] + list(batch_labels_list[0].shape)[1:]), dtype=image.K.floatx())
-            index = 0
-
-            for batch_labels in batch_labels_list:
-                for label_pair in batch_labels:
-                    if index >= features_array_length:
-                        break
-                    labels_array[index]=label_pair
-                    index=index+1
-                    num_samples_cached=num_samples_cached+1
-
-            print(self.BATCH_ID + ': Num cached: ' + str(num_samples_cached) + ' vs num samples: '
-                  + str(self.NUM_ITEMS_IN_BATCHES) + ' vs steps per file: ' + str(self.STEPS_PER_FILE))
-            batch_labels_list.clear()
-            labels_cache_path = self.__generate_labels_cache_path(cache_part_num)
-            ConvCacheIterator.__save_array(labels_cache_path, labels_array)
-            transparent_batches.mark_last_batch_skipped()
+        input_keys = [self.__get_part_input_key(begin, end) for begin, end in self.PART_RANGES]
 
+        # Caches from before the manifest were only ever of unaugmented images
+        if self.NUM_VARIANTS == 1:
+            self.CACHE.import_legacy_cache_if_needed(self.PART_RANGES, input_keys, self.LABELS, self.CONV_MODEL.output_shape[1:])
 
-    def __get_num_entries_in_current_file(self):
-        return len(self.CURRENT_FEATURE_ARRAY)
-
-    def __advance_to_next_cache_file(self):
-        while len(self.CACHE_FILE_QUEUE) == 0:
-            time.sleep(0.01)
-
-        array_pair = self.CACHE_FILE_QUEUE.popleft()
-        self.CURRENT_FEATURE_ARRAY = array_pair.get_feature_array()
-        self.CURRENT_LABEL_ARRAY = array_pair.get_label_array()
+        if self.CACHE.is_up_to_date(input_keys):
+            return
 
+        part_nums_to_compute = [part_num for part_num in range(self.NUM_CACHE_PARTS)
+                                if not self.CACHE.reuse_part_if_cached(part_num, input_keys[part_num])]
 
-    def __file_queue_populator_thread(self):
-        while True:
-            file_num = self.__get_next_file_num()
-            feature_array = self.__load_feature_array(file_num)
-            label_array = self.__load_label_array(file_num)
-            array_pair = CachedTrainingPair(feature_array=feature_array, label_array=label_array)
+        if len(part_nums_to_compute) > 0:
+            self.__compute_cache_parts(part_nums_to_compute, input_keys)
 
-            with self.FILE_QUEUE_APPEND_LOCK:
-                while len(self.CACHE_FILE_QUEUE) == self.CACHE_FILE_QUEUE.maxlen:
-                    time.sleep(0.01)
-                self.CACHE_FILE_QUEUE.append(array_pair)
+        self.CACHE.save_manifest()
 
-    def __get_next_file_num(self):
-        with self.FILE_NUM_LOCK:
-            #TODO:  Is this causing miscounts of how many samples there are?  Not sure yet....
+    def __get_part_input_key(self, begin: int, end: int) -> str:
+        return ConvCacheFingerprint.get_part_input_key(self.CACHE_KEY, self.SOURCE_BATCHES.directory,
+                                                       self.SOURCE_BATCHES.filenames[begin:end], self.SOURCE_BATCHES.classes[begin:end])
 
-            if len(self.FILE_NUM_ARRAY) == 0:
-                if self.SHUFFLE:
-                    self.FILE_NUM_ARRAY = np.random.permutation(self.NUM_CACHE_PARTS)
-                else:
-                    self.FILE_NUM_ARRAY = np.arange(self.NUM_CACHE_PARTS)
+    # Worker processes load and transform upcoming source batches while the conv model runs on the current one
+    def __compute_cache_parts(self, part_nums: [int], input_keys: [str]):
+        source_sequence = ConvCacheSourceSequence(self.SOURCE_BATCHES, [self.PART_RANGES[part_num] for part_num in part_nums], self.BATCH_SIZE,
+                                                  self.NUM_VARIANTS, self.AUGMENTATION_GENERATOR)
+        enqueuer = OrderedEnqueuer(source_sequence, use_multiprocessing=True)
+        enqueuer.start(workers=self.NUM_LOADING_WORKERS, max_queue_size=self.LOADING_QUEUE_SIZE)
+        source_generator = enqueuer.get()
 
-            file_num, self.FILE_NUM_ARRAY = self.FILE_NUM_ARRAY[0], self.FILE_NUM_ARRAY[1:]
-            return file_num
+        try:
+            for part_num, num_batches in zip(part_nums, source_sequence.get_num_batches_per_part()):
+                print('Caching model features for ' + self.BATCH_ID + ', part ' + str(part_num+1) + ' out of ' + str(self.NUM_CACHE_PARTS))
+                features_array = np.concatenate([self.CONV_MODEL.predict_on_batch(next(source_generator)) for batch_num in range(num_batches)])
+                begin, end = self.PART_RANGES[part_num]
+                # Every variant row gets its image's label
+                self.CACHE.save_part(part_num, input_keys[part_num], features_array, np.repeat(self.LABELS[begin:end], self.NUM_VARIANTS, axis=0))
+        finally:
+            enqueuer.stop()
 
-    def __load_feature_array(self, file_num: int):
-        cache_path = self.__generate_features_cache_path(file_num=file_num)
-        feature_array = self.__load_array(cache_path)
-        return feature_array
+    def __get_num_entries_in_current_file(self):
+        return self.CURRENT_ARRAY_PAIR.get_num_rows()
 
-    def __load_label_array(self, file_num: int):
-        cache_path = self.__generate_labels_cache_path(file_num=file_num)
-        label_array = self.__load_array(cache_path)
-        return label_array
+    def __advance_to_next_cache_file(self):
+        self.CURRENT_ARRAY_PAIR = self.LOADER.get_next_pair()
 
     def __onehot(self, x):
         return to_categorical(x)
 
-    def __load_array(self, fname:str):
-        return bcolz.open(fname)[:]
-
-    @staticmethod
-    def __save_array(fname, arr):
-        c = bcolz.carray(arr, rootdir=fname, mode='w')
-        c.flush()
-
     @staticmethod
     def __establish_directory_if_needed(directory: str):
         if not os.path.exists(directory):
             os.makedirs(directory)
-
-    def __generate_features_cache_path(self, file_num: int):
-        return self.CACHE_DIRECTORY + '/' + self.BATCH_ID + '_convlayer_features_' + str(file_num) + '_.bc'
-
-    def __generate_labels_cache_path(self, file_num: int):
-        return self.CACHE_DIRECTORY+ '/' + self.BATCH_ID  +  ' _convlayer_labels_' + str(file_num) + '_.bc'
\ No newline at end of file
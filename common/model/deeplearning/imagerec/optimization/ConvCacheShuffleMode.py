@@ -0,0 +1,9 @@
+from enum import Enum
+
+
+class ConvCacheShuffleMode(Enum):
+    # Shuffles the order of cache shards, and rows within the current shard.  Every batch comes from a single shard.
+    FILE_LOCAL = 1
+    # Global permutation of small contiguous blocks of rows across all shards, read in file order and then mixed
+    # through a shuffle buffer.  Batches are close to i.i.d. over the whole data set.
+    GLOBAL = 2
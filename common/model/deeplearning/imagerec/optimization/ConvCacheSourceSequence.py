@@ -0,0 +1,66 @@
+import os
+import zlib
+
+import numpy as np
+from keras.preprocessing import image
+from keras.preprocessing.image import DirectoryIterator, ImageDataGenerator
+from keras.utils import Sequence
+
+from common.dataset.PackedDataset import PackedDataset
+
+
+# Source image batches for the conv cache parts that need computing, in part order.  Batches never straddle parts, so
+# each part's features are just the outputs of its run of batches.  Being a Sequence, it can be loaded by keras worker
+# processes ahead of (and in parallel with) conv model inference, while still coming back in order.
+#
+# With num_variants, each image is decoded once and comes back as that many rows, one per augmented variant from
+# augmentation_generator (file major, so image i's variant v is row i * num_variants + v of its part).  Each variant's
+# transform is seeded from the CRC32 of the file name and variant number, so the variants don't depend on which worker
+# makes them.  Batches then hold batch_size // num_variants images, so the conv model still sees batch_size rows at a
+# time.
+class ConvCacheSourceSequence(Sequence):
+    def __init__(self, batches: DirectoryIterator, part_ranges: [(int, int)], batch_size: int, num_variants: int = 1,
+                 augmentation_generator: ImageDataGenerator = None):
+        self.__directory = batches.directory
+        self.__file_names = batches.filenames
+        self.__image_shape = batches.image_shape
+        self.__target_size = batches.target_size
+        self.__grayscale = batches.color_mode == 'grayscale'
+        self.__data_format = batches.data_format
+        self.__image_data_generator = batches.image_data_generator if augmentation_generator is None else augmentation_generator
+        self.__num_variants = num_variants
+        self.__is_augmenting = augmentation_generator is not None
+        self.__batch_ranges = []
+        self.__num_batches_per_part = []
+        batch_size = max(1, batch_size // num_variants)
+
+        for begin, end in part_ranges:
+            part_batch_ranges = [(batch_begin, min(batch_begin + batch_size, end)) for batch_begin in range(begin, end, batch_size)]
+            self.__batch_ranges.extend(part_batch_ranges)
+            self.__num_batches_per_part.append(len(part_batch_ranges))
+
+    def get_num_batches_per_part(self) -> [int]:
+        return self.__num_batches_per_part
+
+    def __len__(self):
+        return len(self.__batch_ranges)
+
+    # Same loading and transforms as DirectoryIterator.next, for an explicit range of files
+    def __getitem__(self, index: int) -> np.ndarray:
+        begin, end = self.__batch_ranges[index]
+        batch_x = np.zeros(((end - begin) * self.__num_variants,) + self.__image_shape, dtype=image.K.floatx())
+
+        for image_num, file_name in enumerate(self.__file_names[begin:end]):
+            img = image.load_img(PackedDataset.open_image_file(os.path.join(self.__directory, file_name)), grayscale=self.__grayscale,
+                                 target_size=self.__target_size)
+            x = image.img_to_array(img, data_format=self.__data_format)
+
+            for variant_num in range(self.__num_variants):
+                if self.__is_augmenting:
+                    np.random.seed(zlib.crc32((file_name + ':' + str(variant_num)).encode('utf-8')) & 0xffffffff)
+
+                # standardize can work in place, so every variant starts from its own copy
+                variant_x = self.__image_data_generator.random_transform(x.copy())
+                batch_x[image_num * self.__num_variants + variant_num] = self.__image_data_generator.standardize(variant_x)
+
+        return batch_x
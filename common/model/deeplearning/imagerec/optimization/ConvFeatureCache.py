@@ -0,0 +1,268 @@
+import json
+import os
+
+import numpy as np
+
+from common.model.deeplearning.imagerec.optimization.ConvFeatureQuantizer import ConvFeatureQuantizer
+from common.model.deeplearning.imagerec.optimization.ConvFeatureStorageType import ConvFeatureStorageType
+
+
+# On disk store for cached conv layer features, split into parts ("shards").  Each shard is a plain .npy file that's
+# memory mapped on load, so serving a batch only pages in the rows it gathers rather than decompressing a whole part
+# into RAM.  A JSON manifest, written last, lists the shards, their row counts and the input key each was computed
+# from (see ConvCacheFingerprint).  Features can be stored at reduced precision (see ConvFeatureStorageType); they're
+# dequantized back to floatx as rows are served.
+class ConvFeatureCache:
+    MANIFEST_VERSION = 2
+    __LEGACY_IMPORT_CHUNK_SIZE = 256
+    # Tags the shard files of legacy parts whose rows can't be traced back to their images (see import_legacy_cache_if_needed)
+    __UNTRACEABLE_LEGACY_FILE_TAG = '_legacy'
+
+    def __init__(self, cache_directory: str, batch_id: str, cache_key: str, storage_type: ConvFeatureStorageType = ConvFeatureStorageType.FLOATX):
+        self.__cache_directory = cache_directory
+        self.__batch_id = batch_id
+        self.__cache_key = cache_key
+        self.__storage_type = storage_type
+        self.__quantization_by_file_name = {}
+        self.__manifest = self.__load_manifest()
+        self.__previous_parts_by_input_key = self.__index_manifest_parts()
+        self.__pending_parts = {}
+
+    def exists(self) -> bool:
+        return self.__manifest is not None
+
+    # True when the manifest lists exactly these parts, in this order, so nothing needs recomputing
+    def is_up_to_date(self, input_keys: [str]) -> bool:
+        return self.exists() and [part['input_key'] for part in self.__manifest['parts']] == list(input_keys)
+
+    def get_num_parts(self) -> int:
+        return len(self.__manifest['parts'])
+
+    def get_part_num_rows(self, part_num: int) -> int:
+        return self.__manifest['parts'][part_num]['num_rows']
+
+    def get_num_rows(self) -> int:
+        return sum(part['num_rows'] for part in self.__manifest['parts'])
+
+    def load_features(self, part_num: int) -> np.ndarray:
+        return np.load(self.__get_path(self.__manifest['parts'][part_num]['features']), mmap_mode='r')
+
+    def load_labels(self, part_num: int) -> np.ndarray:
+        return np.load(self.__get_path(self.__manifest['parts'][part_num]['labels']), mmap_mode='r')
+
+    # Rows of load_features(part_num) back as floatx
+    def dequantize_features(self, part_num: int, stored_rows: np.ndarray) -> np.ndarray:
+        quantization_file_name = self.__manifest['parts'][part_num].get('quantization')
+
+        if quantization_file_name is None:
+            return ConvFeatureQuantizer.dequantize(stored_rows, None, None)
+
+        if not (quantization_file_name in self.__quantization_by_file_name):
+            self.__quantization_by_file_name[quantization_file_name] = np.load(self.__get_path(quantization_file_name))
+
+        scale, zero_point = self.__quantization_by_file_name[quantization_file_name]
+        return ConvFeatureQuantizer.dequantize(stored_rows, scale, zero_point)
+
+    def get_num_bytes(self) -> int:
+        return sum(os.path.getsize(self.__get_path(file_name)) for part in self.__manifest['parts']
+                   for file_name in ConvFeatureCache.__get_part_file_names(part))
+
+    # Keeps an already computed part with the same inputs (possibly at a different position) instead of recomputing it.
+    # That's either a part of the previous manifest, or a completed shard that an interrupted run never got to add to
+    # one:  shard files are only ever renamed into place once fully written, and are named after their input key.
+    def reuse_part_if_cached(self, part_num: int, input_key: str) -> bool:
+        part_entry = self.__previous_parts_by_input_key.get(input_key)
+
+        if part_entry is not None and part_entry.get('untraceable_legacy_rows', False):
+            part_entry = None
+
+        if part_entry is None:
+            part_entry = self.__load_completed_part_entry(input_key)
+
+        if part_entry is None or not os.path.exists(self.__get_path(part_entry['features'])) \
+                or not os.path.exists(self.__get_path(part_entry['labels'])):
+            return False
+
+        self.__pending_parts[part_num] = part_entry
+        return True
+
+    # Labels (and quantization parameters) are written first, so a shard whose features file exists is complete
+    def save_part(self, part_num: int, input_key: str, features: np.ndarray, labels: np.ndarray, file_tag: str = ''):
+        stored_features, scale, zero_point = ConvFeatureQuantizer.quantize(features, self.__storage_type)
+        part_entry = self.__generate_part_entry(input_key, stored_features, file_tag)
+        ConvFeatureCache.__save_array(self.__get_path(part_entry['labels']), labels)
+
+        if part_entry.get('quantization') is not None:
+            ConvFeatureCache.__save_array(self.__get_path(part_entry['quantization']), np.stack([scale, zero_point]))
+
+        ConvFeatureCache.__save_array(self.__get_path(part_entry['features']), stored_features)
+        self.__pending_parts[part_num] = part_entry
+
+    # Shards only count as cached once the manifest naming them has been written.  Any other shards of this batch id
+    # (replaced parts, or leftovers from interrupted runs) are deleted afterwards.
+    def save_manifest(self):
+        parts = [self.__pending_parts[part_num] for part_num in sorted(self.__pending_parts.keys())]
+        manifest = {'version': ConvFeatureCache.MANIFEST_VERSION, 'batch_id': self.__batch_id, 'cache_key': self.__cache_key, 'parts': parts}
+        ConvFeatureCache.__write_json_atomically(self.__get_manifest_path(), manifest)
+        self.__manifest = manifest
+        self.__delete_unreferenced_parts()
+        self.__previous_parts_by_input_key = self.__index_manifest_parts()
+
+    # Imports a cache written by the old bcolz based format (<batch_id>_convlayer_features_<n>_.bc directories) as the
+    # parts in part_ranges, stamped with the input keys computed now.  The old format recorded neither which images its
+    # rows came from nor what computed them, so it's only imported when it matches up:  features of feature_shape, a
+    # row per image, and the same labels as expected_labels.  A shuffled legacy cache (i.e. a training one) has the
+    # right labels in a different order; its rows can't be traced back to their images, so its parts are only reused
+    # while no input has changed at all.  The old directories are left in place.
+    def import_legacy_cache_if_needed(self, part_ranges: [(int, int)], input_keys: [str], expected_labels: np.ndarray,
+                                      feature_shape: tuple) -> bool:
+        if self.exists() or not os.path.exists(self.__get_legacy_features_path(0)):
+            return False
+
+        try:
+            import bcolz
+        except ImportError:
+            print('Found a bcolz conv cache for ' + self.__batch_id + ', but bcolz isn\'t installed to import it; it will be recomputed')
+            return False
+
+        legacy_features = []
+        legacy_labels = []
+
+        while os.path.exists(self.__get_legacy_features_path(len(legacy_features))):
+            legacy_labels.append(bcolz.open(self.__get_legacy_labels_path(len(legacy_features)))[:])
+            legacy_features.append(bcolz.open(self.__get_legacy_features_path(len(legacy_features))))
+
+        labels = np.concatenate(legacy_labels)
+        label_nums = np.argmax(labels, axis=1)
+        expected_label_nums = np.argmax(expected_labels, axis=1)
+
+        if any(tuple(features.shape[1:]) != tuple(feature_shape) for features in legacy_features) or len(labels) != len(expected_labels) \
+                or not np.array_equal(np.sort(label_nums), np.sort(expected_label_nums)):
+            print('The bcolz conv cache for ' + self.__batch_id + ' doesn\'t match the current images or model; it will be recomputed')
+            return False
+
+        is_traceable = np.array_equal(label_nums, expected_label_nums)
+
+        for part_num, (begin, end) in enumerate(part_ranges):
+            print('Importing bcolz conv cache for ' + self.__batch_id + ', part ' + str(part_num + 1) + ' out of ' + str(len(part_ranges)))
+            features = ConvFeatureCache.__read_legacy_rows(legacy_features, begin, end)
+
+            if is_traceable:
+                self.save_part(part_num, input_keys[part_num], features, labels[begin:end])
+            else:
+                self.save_part(part_num, input_keys[part_num], features, labels[begin:end], ConvFeatureCache.__UNTRACEABLE_LEGACY_FILE_TAG)
+                self.__pending_parts[part_num]['untraceable_legacy_rows'] = True
+
+        self.save_manifest()
+        print('Imported the bcolz conv cache for ' + self.__batch_id + '; the old .bc directories can now be deleted')
+        return True
+
+    # Rows begin to end of the legacy parts taken as one array, copied a chunk at a time
+    @staticmethod
+    def __read_legacy_rows(legacy_arrays: [], begin: int, end: int) -> np.ndarray:
+        chunks = []
+        array_begin = 0
+
+        for legacy_array in legacy_arrays:
+            array_end = array_begin + len(legacy_array)
+
+            for chunk_begin in range(max(begin, array_begin), min(end, array_end), ConvFeatureCache.__LEGACY_IMPORT_CHUNK_SIZE):
+                chunk_end = min(chunk_begin + ConvFeatureCache.__LEGACY_IMPORT_CHUNK_SIZE, end, array_end)
+                chunks.append(legacy_array[chunk_begin - array_begin:chunk_end - array_begin])
+
+            array_begin = array_end
+
+        return np.concatenate(chunks)
+
+    def __delete_unreferenced_parts(self):
+        referenced_file_names = set()
+
+        for part in self.__manifest['parts']:
+            referenced_file_names.update(ConvFeatureCache.__get_part_file_names(part))
+
+        shard_prefixes = (self.__batch_id + '_convlayer_features_', self.__batch_id + '_convlayer_labels_',
+                          self.__batch_id + '_convlayer_quantization_')
+
+        for file_name in os.listdir(self.__cache_directory):
+            # isfile leaves legacy .bc directories, which share these prefixes, alone
+            if file_name.startswith(shard_prefixes) and file_name not in referenced_file_names and os.path.isfile(self.__get_path(file_name)):
+                os.remove(self.__get_path(file_name))
+
+    def __load_completed_part_entry(self, input_key: str):
+        part_entry = self.__generate_part_entry(input_key, None)
+
+        if not os.path.exists(self.__get_path(part_entry['features'])):
+            return None
+
+        features = np.load(self.__get_path(part_entry['features']), mmap_mode='r')
+        return self.__generate_part_entry(input_key, features)
+
+    @staticmethod
+    def __get_part_file_names(part: {}) -> [str]:
+        return [file_name for file_name in [part['features'], part['labels'], part.get('quantization')] if file_name is not None]
+
+    def __index_manifest_parts(self) -> {}:
+        if self.__manifest is None:
+            return {}
+
+        return {part['input_key']: part for part in self.__manifest['parts']}
+
+    # Shard files are named after their input key, so a file never gets overwritten with features of different inputs
+    def __generate_part_entry(self, input_key: str, features, file_tag: str = '') -> {}:
+        file_suffix = input_key[:16] + file_tag + '.npy'
+        part_entry = {'input_key': input_key, 'features': self.__batch_id + '_convlayer_features_' + file_suffix,
+                      'labels': self.__batch_id + '_convlayer_labels_' + file_suffix, 'storage': self.__storage_type.name,
+                      'quantization': None}
+
+        if self.__storage_type == ConvFeatureStorageType.UINT8:
+            part_entry['quantization'] = self.__batch_id + '_convlayer_quantization_' + file_suffix
+
+        if features is not None:
+            part_entry.update({'num_rows': len(features), 'feature_shape': list(features.shape[1:]), 'feature_dtype': np.dtype(features.dtype).name})
+
+        return part_entry
+
+    @staticmethod
+    def __save_array(path: str, array: np.ndarray):
+        temp_path = path + '.tmp'
+
+        with open(temp_path, 'wb') as array_file:
+            np.save(array_file, array)
+
+        os.replace(temp_path, path)
+
+    @staticmethod
+    def __write_json_atomically(path: str, contents: {}):
+        temp_path = path + '.tmp'
+
+        with open(temp_path, 'w') as json_file:
+            json.dump(contents, json_file, indent=1)
+
+        os.replace(temp_path, path)
+
+    def __load_manifest(self):
+        manifest_path = self.__get_manifest_path()
+
+        if not os.path.exists(manifest_path):
+            return None
+
+        with open(manifest_path, 'r') as manifest_file:
+            manifest = json.load(manifest_file)
+
+        if manifest.get('version') != ConvFeatureCache.MANIFEST_VERSION:
+            return None
+
+        return manifest
+
+    def __get_manifest_path(self) -> str:
+        return self.__get_path(self.__batch_id + '_convlayer_manifest.json')
+
+    def __get_legacy_features_path(self, part_num: int) -> str:
+        return self.__get_path(self.__batch_id + '_convlayer_features_' + str(part_num) + '_.bc')
+
+    # The old format's labels directories have a space after the batch id
+    def __get_legacy_labels_path(self, part_num: int) -> str:
+        return self.__get_path(self.__batch_id + ' _convlayer_labels_' + str(part_num) + '_.bc')
+
+    def __get_path(self, file_name: str) -> str:
+        return os.path.join(self.__cache_directory, file_name)
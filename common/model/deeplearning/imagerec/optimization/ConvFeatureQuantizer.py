@@ -0,0 +1,48 @@
+import numpy as np
+from keras.preprocessing import image
+
+from common.model.deeplearning.imagerec.optimization.ConvFeatureStorageType import ConvFeatureStorageType
+
+
+# Converts conv features to and from their cache storage type.  UINT8 uses affine quantization per channel (axis 1,
+# channels first):  value = (stored - zero_point) * scale, with the scale and zero point picked from the channel's
+# range over the whole part.
+class ConvFeatureQuantizer:
+    __UINT8_MAX = 255
+
+    # Returns the stored array, plus the per channel scales and zero points (None unless quantized)
+    @staticmethod
+    def quantize(features: np.ndarray, storage_type: ConvFeatureStorageType) -> (np.ndarray, np.ndarray, np.ndarray):
+        if storage_type == ConvFeatureStorageType.FLOAT16:
+            return features.astype(np.float16), None, None
+
+        if storage_type != ConvFeatureStorageType.UINT8:
+            return features, None, None
+
+        reduce_axes = tuple(axis for axis in range(features.ndim) if axis != 1)
+        channel_min = np.minimum(features.min(axis=reduce_axes), 0.0).astype(np.float64)
+        channel_max = np.maximum(features.max(axis=reduce_axes), 0.0).astype(np.float64)
+        channel_range = channel_max - channel_min
+        scale = np.where(channel_range > 0, channel_range / ConvFeatureQuantizer.__UINT8_MAX, 1.0)
+        zero_point = np.clip(np.round(-channel_min / scale), 0, ConvFeatureQuantizer.__UINT8_MAX)
+        broadcast_shape = ConvFeatureQuantizer.__get_channel_broadcast_shape(features.ndim, len(scale))
+        stored = np.round(features / scale.reshape(broadcast_shape) + zero_point.reshape(broadcast_shape))
+        stored = np.clip(stored, 0, ConvFeatureQuantizer.__UINT8_MAX).astype(np.uint8)
+        return stored, scale.astype(np.float32), zero_point.astype(np.float32)
+
+    @staticmethod
+    def dequantize(stored: np.ndarray, scale: np.ndarray, zero_point: np.ndarray) -> np.ndarray:
+        floatx = image.K.floatx()
+
+        if scale is None:
+            return stored.astype(floatx, copy=False)
+
+        broadcast_shape = ConvFeatureQuantizer.__get_channel_broadcast_shape(stored.ndim, len(scale))
+        features = stored.astype(floatx)
+        features -= zero_point.reshape(broadcast_shape).astype(floatx)
+        features *= scale.reshape(broadcast_shape).astype(floatx)
+        return features
+
+    @staticmethod
+    def __get_channel_broadcast_shape(ndim: int, num_channels: int) -> tuple:
+        return (1, num_channels) + (1,) * (ndim - 2)
@@ -0,0 +1,10 @@
+from enum import Enum
+
+
+class ConvFeatureStorageType(Enum):
+    # Stored as computed (floatx)
+    FLOATX = 1
+    # Half the size of float32; plenty of precision for post-ReLU activations
+    FLOAT16 = 2
+    # A quarter of the size of float32, with a scale and zero point per channel and part
+    UINT8 = 3
@@ -0,0 +1,76 @@
+import json
+import os
+
+from common.image.CropFamily import CropFamily
+from common.image.ImageSplitter import ImageSplitter
+
+
+# Which crop families get predicted (along with the full image) when images are split at test time.  Usually produced by
+# CropPolicyEvaluator, which also records the validation log loss it measured for the policy, for all of the families,
+# and how much worse the loss gets without each family.
+class CropPolicy:
+    VERSION = 1
+
+    @staticmethod
+    def get_all_crop_families_instance():
+        return CropPolicy(list(CropFamily))
+
+    @staticmethod
+    def load(path: str):
+        with open(path, 'r') as policy_file:
+            contents = json.load(policy_file)
+
+        if contents.get('version') != CropPolicy.VERSION:
+            raise ValueError('Unsupported crop policy version in ' + path + ': ' + str(contents.get('version')))
+
+        return CropPolicy([CropFamily[name] for name in contents['crop_families']], contents.get('log_loss'),
+                          contents.get('all_crop_families_log_loss'), contents.get('crop_family_contributions'))
+
+    # Falls back to every crop family when there's no saved policy yet
+    @staticmethod
+    def load_if_exists(path: str):
+        if not os.path.exists(path):
+            return CropPolicy.get_all_crop_families_instance()
+
+        return CropPolicy.load(path)
+
+    def __init__(self, crop_families: [CropFamily], log_loss: float = None, all_crop_families_log_loss: float = None,
+                 crop_family_contributions: {} = None):
+        self.__crop_families = crop_families
+        self.__log_loss = log_loss
+        self.__all_crop_families_log_loss = all_crop_families_log_loss
+        self.__crop_family_contributions = crop_family_contributions if crop_family_contributions is not None else {}
+
+    def get_crop_families(self) -> [CropFamily]:
+        return self.__crop_families
+
+    # Including the full image
+    def get_num_images_per_test_id(self) -> int:
+        return 1 + sum(ImageSplitter.NUM_IMAGE_PORTIONS_PER_CROP_FAMILY[crop_family] for crop_family in self.__crop_families)
+
+    def get_log_loss(self) -> float:
+        return self.__log_loss
+
+    def get_all_crop_families_log_loss(self) -> float:
+        return self.__all_crop_families_log_loss
+
+    # Crop family name -> validation log loss increase when it's left out of the full set
+    def get_crop_family_contributions(self) -> {}:
+        return self.__crop_family_contributions
+
+    def save(self, path: str):
+        directory = os.path.dirname(path)
+
+        if directory != '' and not os.path.exists(directory):
+            os.makedirs(directory)
+
+        contents = {'version': CropPolicy.VERSION, 'crop_families': [crop_family.name for crop_family in self.__crop_families],
+                    'num_images_per_test_id': self.get_num_images_per_test_id(), 'log_loss': self.__log_loss,
+                    'all_crop_families_log_loss': self.__all_crop_families_log_loss,
+                    'crop_family_contributions': self.__crop_family_contributions}
+        temp_path = path + '.tmp'
+
+        with open(temp_path, 'w') as policy_file:
+            json.dump(contents, policy_file, indent=1)
+
+        os.replace(temp_path, path)
@@ -0,0 +1,103 @@
+import numpy as np
+
+from common.image.CropFamily import CropFamily
+from common.image.ImageInfo import ImageInfo
+from common.image.ImageSplitter import ImageSplitter
+from common.model.deeplearning.imagerec.IImageRecModel import IImageRecModel
+from common.model.deeplearning.imagerec.StreamingPredictionPipeline import StreamingPredictionPipeline
+from common.model.deeplearning.imagerec.optimization.CropPolicy import CropPolicy
+from common.model.deeplearning.prediction.PredictionAggregator import PredictionAggregator
+from common.model.deeplearning.prediction.PredictionFusionMode import PredictionFusionMode
+
+
+# Works out which crop families are worth their inference cost.  The validation set (one subdirectory per class) goes
+# through the model once with every crop family; after that, the fused log loss of any subset of families is just a
+# matter of masking rows of the confidence matrix.  Families are then added greedily, best log loss improvement per
+# extra image first, until the loss is within max_log_loss_increase of using every family, nothing improves it any more,
+# or the next family would take a test id past max_images_per_test_id (the latency budget).
+class CropPolicyEvaluator:
+    EPSILON = 1e-15
+    FULL_IMAGE_ROW_VALUE = 0
+
+    def __init__(self, model: IImageRecModel, batch_size: int = None, fusion_mode: PredictionFusionMode = PredictionFusionMode.MAX,
+                 max_images_per_test_id: int = None, max_log_loss_increase: float = 0.0, max_queue_size: int = 2, num_decode_workers: int = 0):
+        self.__model = model
+        self.__batch_size = batch_size if batch_size is not None else model.get_prediction_batch_size()
+        self.__fusion_mode = fusion_mode
+        self.__max_images_per_test_id = max_images_per_test_id
+        self.__max_log_loss_increase = max_log_loss_increase
+        self.__max_queue_size = max_queue_size
+        self.__num_decode_workers = num_decode_workers
+
+    def evaluate(self, validation_images_path: str) -> CropPolicy:
+        confidences, row_values, group_indexes, class_ids = self.__predict_all_crop_families(validation_images_path)
+
+        def get_log_loss(crop_families: [CropFamily]) -> float:
+            return self.__get_log_loss(confidences, row_values, group_indexes, class_ids, crop_families)
+
+        all_crop_families_log_loss = get_log_loss(list(CropFamily))
+        crop_family_contributions = {crop_family.name: get_log_loss([other for other in CropFamily if other != crop_family]) - all_crop_families_log_loss
+                                     for crop_family in CropFamily}
+        crop_families = []
+        log_loss = get_log_loss(crop_families)
+        print('Full image only:  log loss ' + '{:.5f}'.format(log_loss) + ', all crop families:  ' + '{:.5f}'.format(all_crop_families_log_loss))
+
+        while log_loss > all_crop_families_log_loss + self.__max_log_loss_increase:
+            candidates = [crop_family for crop_family in CropFamily if not (crop_family in crop_families)
+                          and self.__fits_budget(crop_families + [crop_family])]
+            candidate_log_losses = {crop_family: get_log_loss(crop_families + [crop_family]) for crop_family in candidates}
+            improving_candidates = [crop_family for crop_family in candidates if candidate_log_losses[crop_family] < log_loss]
+
+            if len(improving_candidates) == 0:
+                break
+
+            best_crop_family = max(improving_candidates, key=lambda crop_family: (log_loss - candidate_log_losses[crop_family])
+                                   / ImageSplitter.NUM_IMAGE_PORTIONS_PER_CROP_FAMILY[crop_family])
+            crop_families.append(best_crop_family)
+            log_loss = candidate_log_losses[best_crop_family]
+            print('Adding ' + best_crop_family.name + ':  log loss ' + '{:.5f}'.format(log_loss))
+
+        crop_policy = CropPolicy(crop_families, log_loss, all_crop_families_log_loss, crop_family_contributions)
+        print('Crop policy:  ' + str(crop_policy.get_num_images_per_test_id()) + ' images per test id, down from '
+              + str(CropPolicy.get_all_crop_families_instance().get_num_images_per_test_id()))
+        return crop_policy
+
+    def __fits_budget(self, crop_families: [CropFamily]) -> bool:
+        return self.__max_images_per_test_id is None or CropPolicy(crop_families).get_num_images_per_test_id() <= self.__max_images_per_test_id
+
+    # Returns the confidences of every image (one row each), which crop family each row came from (by enum value, with
+    # FULL_IMAGE_ROW_VALUE for the full image), each row's test id group and each group's actual class id
+    def __predict_all_crop_families(self, validation_images_path: str) -> (np.ndarray, np.ndarray, np.ndarray, np.ndarray):
+        test_image_row_values = np.array([CropPolicyEvaluator.FULL_IMAGE_ROW_VALUE]
+                                         + [crop_family.value for crop_family in CropFamily
+                                            for portion_num in range(ImageSplitter.NUM_IMAGE_PORTIONS_PER_CROP_FAMILY[crop_family])])
+        confidences = []
+        class_ids = []
+
+        def generate_test_images(source_image_info: ImageInfo) -> [ImageInfo]:
+            return [source_image_info] + ImageSplitter.get_all_image_portions(source_image_info)
+
+        for class_id, class_name in enumerate(self.__model.get_classes()):
+            pipeline = StreamingPredictionPipeline(self.__model, self.__batch_size, self.__max_queue_size, self.__num_decode_workers)
+            source_image_infos = ImageInfo.generate_image_infos_from_directory(validation_images_path + '/' + class_name)
+
+            for result in pipeline.generate_results(source_image_infos, generate_test_images):
+                # Test ids that collide within the directory would come back merged; they can't be told apart, so skip them
+                if len(result.get_confidences()) == len(test_image_row_values):
+                    confidences.append(result.get_confidences())
+                    class_ids.append(class_id)
+
+        if len(confidences) == 0:
+            raise ValueError('No validation images found in ' + validation_images_path)
+
+        group_indexes = np.repeat(np.arange(len(confidences)), len(test_image_row_values))
+        row_values = np.tile(test_image_row_values, len(confidences))
+        return np.concatenate(confidences), row_values, group_indexes, np.array(class_ids)
+
+    def __get_log_loss(self, confidences: np.ndarray, row_values: np.ndarray, group_indexes: np.ndarray, class_ids: np.ndarray,
+                       crop_families: [CropFamily]) -> float:
+        mask = np.isin(row_values, [CropPolicyEvaluator.FULL_IMAGE_ROW_VALUE] + [crop_family.value for crop_family in crop_families])
+        fused_confidences, representative_rows = PredictionAggregator.fuse(confidences[mask], group_indexes[mask], self.__fusion_mode)
+        actual_class_confidences = fused_confidences[np.arange(len(fused_confidences)), class_ids]
+        clipped_confidences = np.clip(actual_class_confidences, CropPolicyEvaluator.EPSILON, 1 - CropPolicyEvaluator.EPSILON)
+        return float(-np.mean(np.log(clipped_confidences)))
@@ -0,0 +1,34 @@
+import os
+
+from common.dataset.PackedDataset import PackedDataset
+from common.image.ImageInfo import ImageInfo
+
+
+# Cache keys for image infos:  the image's absolute path, its file's mtime and size, and its crop box.  A key changes
+# whenever the file is replaced or edited.  Packed images (see PackedDataset) go by their record path and their shard.
+class ImageInfoCacheKeys:
+    @staticmethod
+    def generate_keys(image_infos: [ImageInfo]) -> [str]:
+        file_keys_by_path = {}
+        keys = []
+
+        for image_info in image_infos:
+            image_path = image_info.get_image_path()
+
+            # Crops of the same file share one stat call
+            if not (image_path in file_keys_by_path):
+                file_stat = os.stat(PackedDataset.get_file_path(image_path))
+                file_keys_by_path[image_path] = os.path.abspath(image_path) + ':' + str(file_stat.st_mtime_ns) + ':' + str(file_stat.st_size)
+
+            keys.append(file_keys_by_path[image_path] + ':' + ImageInfoCacheKeys.__generate_crop_key(image_info))
+
+        return keys
+
+    @staticmethod
+    def __generate_crop_key(image_info: ImageInfo) -> str:
+        crop_box = image_info.get_crop_box()
+
+        if crop_box is None:
+            return 'full'
+
+        return ','.join(str(value) for value in [crop_box.get_begin_x(), crop_box.get_begin_y(), crop_box.get_width(), crop_box.get_height()])
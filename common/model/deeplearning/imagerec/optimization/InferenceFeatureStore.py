@@ -0,0 +1,32 @@
+import hashlib
+import os
+
+import numpy as np
+
+from common.image.ImageInfo import ImageInfo
+from common.image.ResamplingMode import ResamplingMode
+from common.model.deeplearning.imagerec.optimization.ImageInfoCacheKeys import ImageInfoCacheKeys
+from common.model.deeplearning.imagerec.optimization.KeyedArrayStore import KeyedArrayStore
+
+
+# Conv features computed at prediction time, per image path, file mtime/size and crop box.  Everything else that
+# decides the features (the feature model's weights, the target size and the resampling mode) picks the store's
+# subdirectory, so a store never serves features computed any other way.  Lets repeated evaluation of the same images
+# (i.e. the validation set after each fine tuning session) skip decoding and the conv layers entirely.  Rows are evicted
+# least recently used first past max_num_bytes.  Rows still pending are written by flush(), which is up to the owner
+# (i.e. Vgg16, when it replaces the store and at exit).
+class InferenceFeatureStore:
+    def __init__(self, directory: str, feature_model_fingerprint: str, width: int, height: int, resampling_mode: ResamplingMode,
+                 max_num_bytes: int = None):
+        namespace = hashlib.sha1('\n'.join([feature_model_fingerprint, str(width), str(height), resampling_mode.name]).encode('utf-8'))
+        self.__store = KeyedArrayStore(os.path.join(directory, namespace.hexdigest()[:16]), max_num_bytes=max_num_bytes)
+
+    # Cached features for every image info, or None where they aren't cached yet
+    def get_cached_features(self, image_infos: [ImageInfo]) -> [np.ndarray]:
+        return self.__store.get_rows(ImageInfoCacheKeys.generate_keys(image_infos))
+
+    def save_features(self, image_infos: [ImageInfo], features: np.ndarray):
+        self.__store.put_rows(ImageInfoCacheKeys.generate_keys(image_infos), features)
+
+    def flush(self):
+        self.__store.flush()
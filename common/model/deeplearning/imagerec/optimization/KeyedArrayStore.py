@@ -0,0 +1,235 @@
+import json
+import os
+import threading
+import time
+import uuid
+
+import numpy as np
+
+
+# Persistent key -> array row store.  New rows are buffered in memory and written out together as an .npy shard (memory
+# mapped on read), along with a small JSON file listing the shard's keys in row order.  Like the conv cache's
+# manifests, the keys file is written last and is what makes a shard count, so an interrupted run never leaves a half
+# written shard behind; and since nothing else is rewritten, a flush costs the same however big the store has grown.
+# Shards are named in the order they were written, and a key in more than one shard is served from the latest.  Safe to
+# use from several threads.
+#
+# With max_num_bytes, the least recently used rows are evicted once the store outgrows it:  the rows that are kept are
+# compacted into a single new shard, down to three quarters of the cap so that eviction doesn't happen on every flush.
+# Recency is only tracked in memory; on loading, rows count as used in the order their shards were written.
+#
+# Old shards are dropped by removing their keys file first, which is never memory mapped, so the shard stops counting
+# straight away.  The .npy file itself may still be mapped (i.e. by rows handed out by get_rows), and Windows won't
+# remove a mapped file, so a shard file that can't be removed yet is left for a later load to clean up.
+class KeyedArrayStore:
+    VERSION = 3
+    SHARD_SUFFIX = '.npy'
+    KEYS_SUFFIX = '.keys.json'
+    # Shards without a keys file that are at least this old are leftovers rather than writes still in progress
+    ORPHANED_SHARD_MIN_AGE_SECONDS = 60
+
+    def __init__(self, directory: str, flush_num_rows: int = 512, max_num_bytes: int = None):
+        self.__directory = directory
+        self.__flush_num_rows = flush_num_rows
+        self.__max_num_bytes = max_num_bytes
+        self.__lock = threading.Lock()
+        self.__shard_arrays = {}
+        self.__pending_keys = []
+        self.__pending_rows = []
+        self.__pending_row_by_key = {}
+
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+
+        self.__shard_names, self.__entries, self.__clock = self.__load_shards()
+
+    # Returns a row for every key, or None where the key isn't stored
+    def get_rows(self, keys: [str]) -> [np.ndarray]:
+        rows = []
+
+        with self.__lock:
+            for key in keys:
+                row = self.__pending_row_by_key.get(key)
+
+                if row is None and key in self.__entries:
+                    shard_num, row_num, last_used = self.__entries[key]
+                    row = self.__get_shard_array(shard_num)[row_num]
+                    self.__clock = self.__clock + 1
+                    self.__entries[key] = (shard_num, row_num, self.__clock)
+
+                rows.append(row)
+
+        return rows
+
+    def put_rows(self, keys: [str], rows: np.ndarray):
+        with self.__lock:
+            for key, row in zip(keys, rows):
+                if key in self.__entries or key in self.__pending_row_by_key:
+                    continue
+
+                self.__pending_keys.append(key)
+                self.__pending_rows.append(row)
+                self.__pending_row_by_key[key] = row
+
+            if len(self.__pending_keys) >= self.__flush_num_rows:
+                self.__flush_pending()
+
+    def flush(self):
+        with self.__lock:
+            self.__flush_pending()
+
+    def get_num_entries(self) -> int:
+        with self.__lock:
+            return len(self.__entries) + len(self.__pending_keys)
+
+    def clear(self):
+        with self.__lock:
+            self.__pending_keys = []
+            self.__pending_rows = []
+            self.__pending_row_by_key = {}
+            self.__replace_shards([], {})
+
+    def __flush_pending(self):
+        if len(self.__pending_keys) == 0:
+            return
+
+        # The store was deleted from under us (i.e. invalidated), so it stays deleted
+        if not os.path.isdir(self.__directory):
+            self.__pending_keys = []
+            self.__pending_rows = []
+            self.__pending_row_by_key = {}
+            return
+
+        shard_name = self.__write_shard(self.__pending_keys, np.stack(self.__pending_rows))
+        shard_num = len(self.__shard_names)
+        self.__shard_names.append(shard_name)
+
+        for row_num, key in enumerate(self.__pending_keys):
+            self.__clock = self.__clock + 1
+            self.__entries[key] = (shard_num, row_num, self.__clock)
+
+        row_num_bytes = np.stack(self.__pending_rows[:1]).nbytes
+        self.__pending_keys = []
+        self.__pending_rows = []
+        self.__pending_row_by_key = {}
+
+        if self.__max_num_bytes is not None and len(self.__entries) * row_num_bytes > self.__max_num_bytes:
+            self.__evict_least_recently_used(self.__max_num_bytes * 3 // 4 // row_num_bytes)
+
+    def __evict_least_recently_used(self, num_entries_to_keep: int):
+        kept_keys = sorted(self.__entries.keys(), key=lambda entry_key: self.__entries[entry_key][2], reverse=True)[:num_entries_to_keep]
+        # Oldest first, so that reloading the compacted shard gives the same recency order
+        kept_keys.reverse()
+        shard_names = []
+        entries = {}
+
+        if len(kept_keys) > 0:
+            # Copied out of the old shards' memory maps (np.stack copies), so nothing here still references them
+            kept_rows = np.stack([self.__get_shard_array(self.__entries[key][0])[self.__entries[key][1]] for key in kept_keys])
+            shard_names.append(self.__write_shard(kept_keys, kept_rows))
+            entries = {key: (0, row_num, self.__entries[key][2]) for row_num, key in enumerate(kept_keys)}
+            del kept_rows
+
+        self.__replace_shards(shard_names, entries)
+
+    # Keys files go before their shards, so there's never a keys file naming a missing shard
+    def __replace_shards(self, shard_names: [str], entries: {}):
+        old_shard_names = self.__shard_names
+        self.__shard_names = shard_names
+        self.__entries = entries
+        self.__shard_arrays = {}
+
+        for shard_name in old_shard_names:
+            if shard_name not in shard_names:
+                if os.path.exists(self.__get_path(shard_name + KeyedArrayStore.KEYS_SUFFIX)):
+                    os.remove(self.__get_path(shard_name + KeyedArrayStore.KEYS_SUFFIX))
+
+                self.__remove_shard_file_if_unmapped(shard_name)
+
+    def __remove_shard_file_if_unmapped(self, shard_name: str):
+        try:
+            if os.path.exists(self.__get_path(shard_name + KeyedArrayStore.SHARD_SUFFIX)):
+                os.remove(self.__get_path(shard_name + KeyedArrayStore.SHARD_SUFFIX))
+        except PermissionError:
+            pass
+
+    def __get_shard_array(self, shard_num: int) -> np.ndarray:
+        if not (shard_num in self.__shard_arrays):
+            self.__shard_arrays[shard_num] = np.load(self.__get_path(self.__shard_names[shard_num] + KeyedArrayStore.SHARD_SUFFIX), mmap_mode='r')
+
+        return self.__shard_arrays[shard_num]
+
+    # Returns the shard names, the entries (key -> (shard num, row num, last used)) and the last used clock value
+    def __load_shards(self) -> ([str], {}, int):
+        shard_names = []
+        entries = {}
+        clock = 0
+
+        file_names = sorted(os.listdir(self.__directory))
+        self.__remove_orphaned_shard_files(file_names)
+
+        for file_name in file_names:
+            if not file_name.endswith(KeyedArrayStore.KEYS_SUFFIX):
+                continue
+
+            shard_name = file_name[:-len(KeyedArrayStore.KEYS_SUFFIX)]
+
+            try:
+                with open(self.__get_path(file_name), 'r') as keys_file:
+                    contents = json.load(keys_file)
+            except (OSError, ValueError):
+                # A corrupt keys file just means that shard's rows get computed again
+                continue
+
+            if contents.get('version') != KeyedArrayStore.VERSION or not os.path.exists(self.__get_path(shard_name + KeyedArrayStore.SHARD_SUFFIX)):
+                continue
+
+            shard_num = len(shard_names)
+            shard_names.append(shard_name)
+
+            for row_num, key in enumerate(contents['keys']):
+                clock = clock + 1
+                entries[key] = (shard_num, row_num, clock)
+
+        return shard_names, entries, clock
+
+    # Shard files whose keys file was removed, but which were still memory mapped at the time
+    def __remove_orphaned_shard_files(self, file_names: [str]):
+        keys_file_names = set(file_name for file_name in file_names if file_name.endswith(KeyedArrayStore.KEYS_SUFFIX))
+
+        for file_name in file_names:
+            if not file_name.endswith(KeyedArrayStore.SHARD_SUFFIX):
+                continue
+
+            shard_name = file_name[:-len(KeyedArrayStore.SHARD_SUFFIX)]
+
+            try:
+                is_orphaned = not (shard_name + KeyedArrayStore.KEYS_SUFFIX in keys_file_names) \
+                    and time.time() - os.path.getmtime(self.__get_path(file_name)) >= KeyedArrayStore.ORPHANED_SHARD_MIN_AGE_SECONDS
+            except OSError:
+                continue
+
+            if is_orphaned:
+                self.__remove_shard_file_if_unmapped(shard_name)
+
+    # Shard names start with the time they were written, so that listing the directory gives them in order
+    def __write_shard(self, keys: [str], rows: np.ndarray) -> str:
+        shard_name = '{:020d}'.format(time.time_ns()) + '_' + uuid.uuid4().hex[:8]
+        shard_path = self.__get_path(shard_name + KeyedArrayStore.SHARD_SUFFIX)
+        temp_path = shard_path + '.tmp'
+
+        with open(temp_path, 'wb') as shard_file:
+            np.save(shard_file, rows)
+
+        os.replace(temp_path, shard_path)
+        keys_path = self.__get_path(shard_name + KeyedArrayStore.KEYS_SUFFIX)
+        temp_path = keys_path + '.tmp'
+
+        with open(temp_path, 'w') as keys_file:
+            json.dump({'version': KeyedArrayStore.VERSION, 'keys': keys}, keys_file)
+
+        os.replace(temp_path, keys_path)
+        return shard_name
+
+    def __get_path(self, file_name: str) -> str:
+        return os.path.join(self.__directory, file_name)
@@ -0,0 +1,38 @@
+import numpy as np
+from keras.preprocessing import image
+from keras.preprocessing.image import DirectoryIterator, Iterator
+
+from common.dataset.DatasetManifest import DatasetManifest
+
+
+# A DirectoryIterator over a DatasetManifest's images instead of a directory tree.  It sets up the same attributes a
+# scanned DirectoryIterator would (classes sorted by name, files sorted within each class), so batches come out the
+# same, and so does anything that reads its directory/filenames (i.e. the conv cache).  Filenames are the images' real
+# absolute paths, which os.path.join(directory, filename) passes through unchanged.
+class ManifestDirectoryIterator(DirectoryIterator):
+    def __init__(self, manifest: DatasetManifest, image_data_generator, target_size=(256, 256), color_mode='rgb', class_mode='categorical',
+                 batch_size=32, shuffle=True, seed=None, data_format=None):
+        if data_format is None:
+            data_format = image.K.image_data_format()
+
+        self.directory = manifest.get_split_path()
+        self.image_data_generator = image_data_generator
+        self.target_size = tuple(target_size)
+        self.color_mode = color_mode
+        self.data_format = data_format
+        num_channels = 3 if color_mode == 'rgb' else 1
+        self.image_shape = self.target_size + (num_channels,) if data_format == 'channels_last' else (num_channels,) + self.target_size
+        self.class_mode = class_mode
+        self.save_to_dir = None
+        self.save_prefix = ''
+        self.save_format = 'jpeg'
+
+        class_names = manifest.get_class_names()
+        self.class_indices = dict(zip(class_names, range(len(class_names))))
+        self.num_class = len(class_names)
+        entries = manifest.get_entries()
+        self.filenames = [image_path for class_name, image_path in entries]
+        self.classes = np.array([self.class_indices[class_name] for class_name, image_path in entries], dtype='int32')
+        self.samples = len(self.filenames)
+        print('Found %d images belonging to %d classes in manifest %s.' % (self.samples, self.num_class, self.directory))
+        Iterator.__init__(self, self.samples, batch_size, shuffle, seed)
@@ -0,0 +1,14 @@
+import keras
+from keras.models import Model
+
+
+# ModelCheckpoint that saves a different model from the one being trained.  Used when training a model made of layers
+# shared with a bigger one (e.g. just the trainable tail of a head), so that the checkpoints are still of the bigger
+# model and load the same way they always have.
+class ModelPortionCheckpoint(keras.callbacks.ModelCheckpoint):
+    def __init__(self, model_to_save: Model, filepath: str, **kwargs):
+        self.__model_to_save = model_to_save
+        super(ModelPortionCheckpoint, self).__init__(filepath, **kwargs)
+
+    def set_model(self, model: Model):
+        super(ModelPortionCheckpoint, self).set_model(self.__model_to_save)
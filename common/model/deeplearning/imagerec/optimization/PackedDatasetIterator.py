@@ -0,0 +1,66 @@
+import numpy as np
+from keras.preprocessing import image
+from keras.preprocessing.image import DirectoryIterator, Iterator
+
+from common.dataset.PackedDataset import PackedDataset
+
+
+# A DirectoryIterator over a PackedDataset's images instead of a directory tree.  Like ManifestDirectoryIterator, it
+# sets up the attributes a scanned DirectoryIterator would (classes sorted by name, files sorted within each class), so
+# batches come out the same.  Filenames are the images' record paths, which are absolute, so anything joining them to
+# the directory (i.e. the conv cache) gets them back unchanged and can open them with PackedDataset.open_image_file().
+class PackedDatasetIterator(DirectoryIterator):
+    def __init__(self, dataset: PackedDataset, image_data_generator, target_size=(256, 256), color_mode='rgb',
+                 class_mode='categorical', batch_size=32, shuffle=True, seed=None, data_format=None):
+        if data_format is None:
+            data_format = image.K.image_data_format()
+
+        self.directory = dataset.get_split_path()
+        self.image_data_generator = image_data_generator
+        self.target_size = tuple(target_size)
+        self.color_mode = color_mode
+        self.data_format = data_format
+        num_channels = 3 if color_mode == 'rgb' else 1
+        self.image_shape = self.target_size + (num_channels,) if data_format == 'channels_last' else (num_channels,) + self.target_size
+        self.class_mode = class_mode
+        self.save_to_dir = None
+        self.save_prefix = ''
+        self.save_format = 'jpeg'
+
+        class_names = dataset.get_class_names()
+        self.class_indices = dict(zip(class_names, range(len(class_names))))
+        self.num_class = len(class_names)
+        self.samples = dataset.get_num_images()
+        self.filenames = [dataset.get_record_path(entry_num) for entry_num in range(self.samples)]
+        self.classes = np.array(dataset.get_class_nums(), dtype='int32')
+        print('Found %d images belonging to %d classes in packed dataset %s.' % (self.samples, self.num_class, self.directory))
+        Iterator.__init__(self, self.samples, batch_size, shuffle, seed)
+
+    # Same as DirectoryIterator.next, except that images are read out of the shards, in shard order even when the batch
+    # is shuffled
+    def next(self):
+        with self.lock:
+            index_array, current_index, current_batch_size = next(self.index_generator)
+
+        batch_x = np.zeros((current_batch_size,) + self.image_shape, dtype=image.K.floatx())
+        grayscale = self.color_mode == 'grayscale'
+
+        for i in np.argsort(index_array):
+            img = image.load_img(PackedDataset.open_image_file(self.filenames[index_array[i]]), grayscale=grayscale, target_size=self.target_size)
+            x = image.img_to_array(img, data_format=self.data_format)
+            x = self.image_data_generator.random_transform(x)
+            batch_x[i] = self.image_data_generator.standardize(x)
+
+        if self.class_mode == 'input':
+            batch_y = batch_x.copy()
+        elif self.class_mode == 'sparse':
+            batch_y = self.classes[index_array]
+        elif self.class_mode == 'binary':
+            batch_y = self.classes[index_array].astype(image.K.floatx())
+        elif self.class_mode == 'categorical':
+            batch_y = np.zeros((len(batch_x), self.num_class), dtype=image.K.floatx())
+            batch_y[np.arange(len(batch_x)), self.classes[index_array]] = 1.
+        else:
+            return batch_x
+
+        return batch_x, batch_y
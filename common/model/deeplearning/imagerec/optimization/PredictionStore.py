@@ -0,0 +1,94 @@
+import hashlib
+import json
+import os
+import shutil
+
+import numpy as np
+
+from common.image.ImageInfo import ImageInfo
+from common.image.ResamplingMode import ResamplingMode
+from common.model.deeplearning.imagerec.optimization.ImageInfoCacheKeys import ImageInfoCacheKeys
+from common.model.deeplearning.imagerec.optimization.KeyedArrayStore import KeyedArrayStore
+
+
+# Raw softmax vectors per image path, file mtime/size and crop box, for one set of model weights.  Each model
+# (weights fingerprint, target size, resampling mode) gets its own subdirectory, along with a small JSON file naming the
+# checkpoint its weights came from, so that predictions can be invalidated by checkpoint.  Within a model, rows are
+# evicted least recently used first past max_num_bytes; across models, only the max_num_models most recently opened
+# subdirectories are kept.  Rows still pending are written by flush(), which is up to the owner (i.e. Vgg16, when it
+# replaces the store and at exit).
+class PredictionStore:
+    MODEL_FILE_NAME = 'model.json'
+
+    def __init__(self, directory: str, model_fingerprint: str, checkpoint_name: str, width: int, height: int,
+                 resampling_mode: ResamplingMode, max_num_bytes: int = None, max_num_models: int = 4):
+        namespace = hashlib.sha1('\n'.join([model_fingerprint, str(width), str(height), resampling_mode.name]).encode('utf-8'))
+        self.__model_directory = os.path.join(directory, namespace.hexdigest()[:16])
+        self.__store = KeyedArrayStore(self.__model_directory, max_num_bytes=max_num_bytes)
+        PredictionStore.__write_model_file(self.__model_directory, model_fingerprint, checkpoint_name)
+        PredictionStore.__delete_least_recently_used_models(directory, max_num_models)
+
+    # Removes every model's predictions that came from the named checkpoint (compared by file name).  Returns how many
+    # models' predictions were removed.
+    @staticmethod
+    def invalidate_checkpoint(directory: str, checkpoint_name: str) -> int:
+        num_invalidated = 0
+
+        for model_directory, model_contents in PredictionStore.__load_model_files(directory):
+            if os.path.basename(model_contents.get('checkpoint') or '') == os.path.basename(checkpoint_name):
+                shutil.rmtree(model_directory, ignore_errors=True)
+                num_invalidated = num_invalidated + 1
+
+        return num_invalidated
+
+    # Cached softmax vectors for every image info, or None where they aren't cached yet
+    def get_cached_predictions(self, image_infos: [ImageInfo]) -> [np.ndarray]:
+        return self.__store.get_rows(ImageInfoCacheKeys.generate_keys(image_infos))
+
+    def save_predictions(self, image_infos: [ImageInfo], predictions: np.ndarray):
+        self.__store.put_rows(ImageInfoCacheKeys.generate_keys(image_infos), predictions)
+
+    def flush(self):
+        self.__store.flush()
+
+    # Removes this model's predictions
+    def invalidate(self):
+        self.__store.clear()
+
+    @staticmethod
+    def __write_model_file(model_directory: str, model_fingerprint: str, checkpoint_name: str):
+        model_file_path = os.path.join(model_directory, PredictionStore.MODEL_FILE_NAME)
+        temp_path = model_file_path + '.tmp'
+
+        # Rewritten on every open, so its mtime says when the model was last used
+        with open(temp_path, 'w') as model_file:
+            json.dump({'model_fingerprint': model_fingerprint, 'checkpoint': checkpoint_name}, model_file, indent=1)
+
+        os.replace(temp_path, model_file_path)
+
+    @staticmethod
+    def __delete_least_recently_used_models(directory: str, max_num_models: int):
+        model_directories = [model_directory for model_directory, model_contents in PredictionStore.__load_model_files(directory)]
+        model_directories.sort(key=lambda model_directory: os.path.getmtime(os.path.join(model_directory, PredictionStore.MODEL_FILE_NAME)),
+                               reverse=True)
+
+        for model_directory in model_directories[max_num_models:]:
+            shutil.rmtree(model_directory, ignore_errors=True)
+
+    @staticmethod
+    def __load_model_files(directory: str) -> [(str, {})]:
+        model_files = []
+
+        if not os.path.isdir(directory):
+            return model_files
+
+        for entry_name in os.listdir(directory):
+            model_file_path = os.path.join(directory, entry_name, PredictionStore.MODEL_FILE_NAME)
+
+            try:
+                with open(model_file_path, 'r') as model_file:
+                    model_files.append((os.path.join(directory, entry_name), json.load(model_file)))
+            except (OSError, ValueError):
+                continue
+
+        return model_files
@@ -0,0 +1,35 @@
+import numpy as np
+
+
+# Handle on an image array that a SharedMemoryBatchPrefetcher worker is (or was) filling.  The array is a view onto a
+# shared memory slot, so it's only valid until release() is called.
+class PrefetchedImageBatch:
+    def __init__(self, async_result, slot_index: int, release_callback, image_array_view: np.ndarray):
+        self.__async_result = async_result
+        self.__slot_index = slot_index
+        self.__release_callback = release_callback
+        self.__image_array_view = image_array_view
+        self.__released = False
+
+    # Blocks until the worker is done; worker exceptions are re-raised here
+    def get_image_array(self) -> np.ndarray:
+        if self.__async_result is not None:
+            self.__async_result.get()
+            self.__async_result = None
+
+        return self.__image_array_view
+
+    def release(self):
+        if self.__released:
+            return
+
+        self.__released = True
+
+        if self.__async_result is not None:
+            # Never hand a slot back while a worker may still be writing to it
+            self.__async_result.wait()
+
+        if self.__slot_index is not None:
+            self.__release_callback(self.__slot_index)
+
+        self.__image_array_view = None
@@ -0,0 +1,87 @@
+import multiprocessing
+import queue
+
+import numpy as np
+from keras.preprocessing import image as image_processing
+
+from common.image.ImageInfo import ImageInfo
+from common.image.ModelImageConverter import ModelImageConverter
+from common.image.ResamplingMode import ResamplingMode
+from common.model.deeplearning.imagerec.IBatchPrefetcher import IBatchPrefetcher
+from common.model.deeplearning.imagerec.optimization.PrefetchedImageBatch import PrefetchedImageBatch
+
+# Per worker process state, set up once by the pool initializer
+_worker_slots = None
+_worker_image_shape = None
+_worker_dtype = None
+_worker_resampling_mode = None
+
+
+def _initialize_worker(slots: [], image_shape: tuple, dtype_name: str, resampling_mode: ResamplingMode):
+    global _worker_slots, _worker_image_shape, _worker_dtype, _worker_resampling_mode
+    _worker_slots = slots
+    _worker_image_shape = image_shape
+    _worker_dtype = np.dtype(dtype_name)
+    _worker_resampling_mode = resampling_mode
+
+
+def _fill_slot(slot_index: int, image_infos: [ImageInfo]) -> int:
+    image_array = SharedMemoryBatchPrefetcher.get_slot_view(_worker_slots[slot_index], len(image_infos), _worker_image_shape, _worker_dtype)
+    ModelImageConverter.fill_image_array(image_infos, image_array, _worker_resampling_mode, num_threads=1)
+    return slot_index
+
+
+# Decodes and preprocesses upcoming batches in a pool of worker processes, so that the model isn't left idle while PIL
+# works on the main process.  Finished batches come back through a fixed set of shared memory slots rather than as
+# pickled arrays:  only the (small) image infos are sent to the workers, and only the slot index is sent back.
+class SharedMemoryBatchPrefetcher(IBatchPrefetcher):
+    # Put in place of a free slot index by close(), so that a submit() waiting on a slot wakes up rather than blocking
+    __CLOSED = -1
+
+    @staticmethod
+    def get_slot_view(slot, num_images: int, image_shape: tuple, dtype: np.dtype) -> np.ndarray:
+        num_values = num_images * int(np.prod(image_shape))
+        return np.frombuffer(slot, dtype=dtype, count=num_values).reshape((num_images,) + image_shape)
+
+    def __init__(self, num_workers: int, max_batch_images: int, width: int, height: int,
+                 resampling_mode: ResamplingMode = ResamplingMode.ANTIALIAS, num_slots: int = None):
+        self.__image_shape = (3, height, width)
+        self.__dtype = np.dtype(image_processing.K.floatx())
+        self.__max_batch_images = max_batch_images
+        self.__resampling_mode = resampling_mode
+        num_slots = num_slots if num_slots is not None else num_workers * 2
+        slot_size = max_batch_images * int(np.prod(self.__image_shape))
+        typecode = 'f' if self.__dtype == np.float32 else 'd'
+        self.__slots = [multiprocessing.RawArray(typecode, slot_size) for slot_num in range(num_slots)]
+        self.__free_slot_indexes = queue.Queue()
+
+        for slot_index in range(num_slots):
+            self.__free_slot_indexes.put(slot_index)
+
+        self.__pool = multiprocessing.Pool(processes=num_workers, initializer=_initialize_worker,
+                                           initargs=(self.__slots, self.__image_shape, self.__dtype.name, resampling_mode))
+
+    # Hands the batch to a worker and returns straight away.  Blocks only when every slot is in use, which bounds how far
+    # ahead of the consumer the workers can get.  Raises RuntimeError once the prefetcher is closed.
+    def submit(self, image_infos: [ImageInfo]) -> PrefetchedImageBatch:
+        if len(image_infos) > self.__max_batch_images:
+            # Too big for a slot; rare enough that just doing it in process is fine
+            width, height = self.__image_shape[2], self.__image_shape[1]
+            image_array = ModelImageConverter.generate_image_array_for_image_infos(image_infos, width, height, self.__resampling_mode)
+            return PrefetchedImageBatch(None, None, None, image_array)
+
+        slot_index = self.__free_slot_indexes.get()
+
+        if slot_index == SharedMemoryBatchPrefetcher.__CLOSED:
+            # Left in place for any other waiting submit()
+            self.__free_slot_indexes.put(slot_index)
+            raise RuntimeError('Batch submitted to a closed SharedMemoryBatchPrefetcher')
+
+        async_result = self.__pool.apply_async(_fill_slot, (slot_index, image_infos))
+        image_array_view = SharedMemoryBatchPrefetcher.get_slot_view(self.__slots[slot_index], len(image_infos), self.__image_shape, self.__dtype)
+        return PrefetchedImageBatch(async_result, slot_index, self.__free_slot_indexes.put, image_array_view)
+
+    def close(self):
+        self.__free_slot_indexes.put(SharedMemoryBatchPrefetcher.__CLOSED)
+        self.__pool.terminate()
+        self.__pool.join()
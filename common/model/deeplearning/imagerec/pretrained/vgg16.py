@@ -1,17 +1,19 @@
 from __future__ import absolute_import
 from __future__ import division, print_function
 
+import atexit
 import glob
 import os.path
 import re
+import weakref
 
 import keras
 import numpy as np
 from keras import layers
-from keras.layers import BatchNormalization
+from keras.layers import BatchNormalization, Input
 from keras.layers.convolutional import MaxPooling2D, ZeroPadding2D, Conv2D
 from keras.layers.core import Flatten, Dense, Dropout, Lambda
-from keras.models import Sequential
+from keras.models import Model, Sequential
 from keras.optimizers import Adam
 from keras.optimizers import RMSprop
 from keras.preprocessing import image
@@ -19,9 +21,23 @@ from keras.preprocessing.image import DirectoryIterator, Iterator
 from keras.utils.data_utils import get_file
 from keras.models import load_model
 
+from common.dataset.DatasetManifest import DatasetManifest
+from common.dataset.PackedDataset import PackedDataset
+from common.image.AugmentationSettings import AugmentationSettings
+from common.image.ResamplingMode import ResamplingMode
+from common.model.deeplearning.imagerec.optimization.BatchSizeTuner import BatchSizeTuner
+from common.model.deeplearning.imagerec.optimization.ConvCacheFingerprint import ConvCacheFingerprint
 from common.model.deeplearning.imagerec.optimization.ConvCacheIterator import ConvCacheIterator
+from common.model.deeplearning.imagerec.optimization.ConvCacheShuffleMode import ConvCacheShuffleMode
+from common.model.deeplearning.imagerec.optimization.ConvFeatureStorageType import ConvFeatureStorageType
+from common.model.deeplearning.imagerec.optimization.InferenceFeatureStore import InferenceFeatureStore
+from common.model.deeplearning.imagerec.optimization.ManifestDirectoryIterator import ManifestDirectoryIterator
+from common.model.deeplearning.imagerec.optimization.ModelPortionCheckpoint import ModelPortionCheckpoint
+from common.model.deeplearning.imagerec.optimization.PackedDatasetIterator import PackedDatasetIterator
+from common.model.deeplearning.imagerec.optimization.PredictionStore import PredictionStore
 from common.utils.utils import *
 from common.model.deeplearning.imagerec.BatchImagePredictionRequestInfo import BatchImagePredictionRequestInfo
+from common.model.deeplearning.imagerec.IBatchPrefetcher import IBatchPrefetcher
 from common.model.deeplearning.imagerec.IImageRecModel import IImageRecModel
 from common.model.deeplearning.imagerec.ImagePredictionRequest import ImagePredictionRequest
 from common.model.deeplearning.imagerec.ImagePredictionResult import ImagePredictionResult
@@ -32,10 +48,16 @@ class Vgg16(IImageRecModel):
 
     def __init__(self, load_weights_from_cache: bool, training_images_path: str, training_batch_size: int, validation_images_path: str,
                  validation_batch_size: int, cache_directory: str, num_dense_layers_to_retrain: int, fast_conv_cache_training=True,
-                 drop_out=0.0):
+                 drop_out=0.0, prediction_resampling_mode=ResamplingMode.ANTIALIAS, conv_cache_storage_type=ConvFeatureStorageType.FLOATX,
+                 fold_frozen_head_into_conv_cache=True, cache_inference_features=False,
+                 inference_feature_cache_max_bytes=1024 * 1024 * 1024, cache_predictions=False, prediction_cache_max_bytes=256 * 1024 * 1024,
+                 batch_size_tuner: BatchSizeTuner = None, num_augmented_variants=0, augmentation_generator_arguments: {} = None):
         self.FAST_CONV_CACHE_TRAINING = fast_conv_cache_training
+        self.TRAINING_IMAGES_PATH = training_images_path
+        self.VALIDATION_IMAGES_PATH = validation_images_path
         self.TRAINING_BATCH_SIZE = training_batch_size
         self.VALIDATION_BATCH_SIZE = validation_batch_size
+        self.PREDICTION_BATCH_SIZE = validation_batch_size
         self.TRAINING_BATCHES = self.__get_batches(training_images_path, shuffle=True, batch_size=training_batch_size)
         self.VALIDATION_BATCHES = self.__get_batches(validation_images_path, shuffle=False, batch_size=validation_batch_size)
         self.VGG_MEAN = np.array([123.68, 116.779, 103.939], dtype=np.float32).reshape((3, 1, 1))
@@ -46,27 +68,129 @@ class Vgg16(IImageRecModel):
         self.LOAD_WEIGHTS_FROM_CACHE = load_weights_from_cache
         self.NUM_DENSE_LAYERS_TO_RETRAIN = num_dense_layers_to_retrain
         self.DROP_OUT = drop_out
+        self.PREDICTION_RESAMPLING_MODE = prediction_resampling_mode
+        self.CONV_CACHE_STORAGE_TYPE = conv_cache_storage_type
+        self.FOLD_FROZEN_HEAD_INTO_CONV_CACHE = fold_frozen_head_into_conv_cache
+        self.CACHE_INFERENCE_FEATURES = cache_inference_features
+        self.INFERENCE_FEATURE_CACHE_MAX_BYTES = inference_feature_cache_max_bytes
+        self.CACHE_PREDICTIONS = cache_predictions
+        self.PREDICTION_CACHE_MAX_BYTES = prediction_cache_max_bytes
+        self.BATCH_SIZE_TUNER = batch_size_tuner
+        # Online augmentation of the training set, for fast conv cache training (see ConvCacheIterator).  Uses the same
+        # transforms as offline augmentation by default.
+        self.NUM_AUGMENTED_VARIANTS = num_augmented_variants
+        self.AUGMENTATION_GENERATOR_ARGUMENTS = augmentation_generator_arguments if augmentation_generator_arguments is not None \
+            else AugmentationSettings.GENERATOR_ARGUMENTS
+        # With a tuner, batch sizes are tuned when first needed rather than up front (see __tune_training_batch_sizes)
+        self.__training_batch_sizes_tuned = False
+        self.__prediction_batch_size_tuned = False
         self.__initialize_model()
+        # One exit hook for whichever stores the model has by then; weakly referenced, so it doesn't keep the model alive
+        atexit.register(Vgg16.__flush_caches_at_exit, weakref.ref(self))
 
+    # Without steps_per_epoch, each epoch is one full pass over the training set
     def refine_training(self, steps_per_epoch: int, number_of_epochs: int):
         latest_saved_filename = self.__get_latest_saved_weights_file_name()
         latest_saved_epoch = self.__determine_epoch_num_from_weights_file_name(latest_saved_filename)
         initial_epoch = max(latest_saved_epoch, 0) if self.__can_load_weights_from_cache() else 0
+        self.__tune_training_batch_sizes()
         self.__fit(self.TRAINING_BATCHES, self.VALIDATION_BATCHES, steps_per_epoch=steps_per_epoch, nb_epoch=number_of_epochs, initial_epoch=initial_epoch)
+        # New weights, so features and predictions cached for the old ones no longer apply
+        self.__initialize_inference_feature_store()
+        self.__initialize_prediction_store()
+
+    # Writes out the feature and prediction rows still pending in the stores
+    def flush_caches(self):
+        for store in [self.inference_feature_store, self.prediction_store]:
+            if store is not None:
+                store.flush()
+
+    @staticmethod
+    def __flush_caches_at_exit(model_reference: weakref.ref):
+        model = model_reference()
+
+        if model is not None:
+            model.flush_caches()
 
     def predict(self, image_prediction_requests: [ImagePredictionRequest], batch_size: int, details=False) -> [ImagePredictionResult]:
+        batch_request_info = self.prepare_batch(image_prediction_requests)
+        return self.predict_batch(batch_request_info, batch_size, details)
+
+    def prepare_batch(self, image_prediction_requests: [ImagePredictionRequest],
+                      prefetcher: IBatchPrefetcher = None) -> BatchImagePredictionRequestInfo:
+        return BatchImagePredictionRequestInfo.get_instance(image_prediction_requests, self.get_image_width(), self.get_image_height(),
+                                                            self.PREDICTION_RESAMPLING_MODE, prefetcher, self.inference_feature_store,
+                                                            self.prediction_store)
+
+    def predict_batch(self, batch_request_info: BatchImagePredictionRequestInfo, batch_size: int, details=False) -> [ImagePredictionResult]:
         verbose = 1 if details else 0
-        batch_request_info = BatchImagePredictionRequestInfo.get_instance(image_prediction_requests, self.get_image_width(), self.get_image_height())
-        batch_confidences = self.model.predict(batch_request_info.get_image_array(), batch_size=batch_size, verbose=verbose)
+        image_infos = batch_request_info.get_image_infos()
+        unpredicted_indexes = batch_request_info.get_unpredicted_indexes()
+        batch_confidences = np.empty((len(image_infos), len(self.classes)), dtype=image.K.floatx())
+
+        if len(unpredicted_indexes) > 0:
+            if self.inference_feature_store is None:
+                unpredicted_confidences = self.model.predict(batch_request_info.get_image_array(), batch_size=batch_size, verbose=verbose)
+            else:
+                unpredicted_confidences = self.__predict_with_feature_store(batch_request_info, unpredicted_indexes, batch_size, verbose)
+
+            batch_confidences[unpredicted_indexes] = unpredicted_confidences
+
+            if self.prediction_store is not None:
+                self.prediction_store.save_predictions([image_infos[index] for index in unpredicted_indexes], unpredicted_confidences)
+
+        for index, cached_confidences in enumerate(batch_request_info.get_cached_predictions()):
+            if cached_confidences is not None:
+                batch_confidences[index] = cached_confidences
+
         image_prediction_results = ImagePredictionResult.generate_image_prediction_results(batch_confidences, batch_request_info, self.classes)
         return image_prediction_results
 
+    # Removes cached predictions:  those of the named checkpoint file, or of the current weights if there's no name
+    def invalidate_cached_predictions(self, checkpoint_name: str = None):
+        if checkpoint_name is not None:
+            PredictionStore.invalidate_checkpoint(self.__get_prediction_cache_directory(), checkpoint_name)
+        elif self.prediction_store is not None:
+            self.prediction_store.invalidate()
+
+    # Only images without cached features go through the conv layers (and get their features cached); then the head runs
+    # on all of the images being predicted.  Same layers as self.model, so the results are the same either way.
+    def __predict_with_feature_store(self, batch_request_info: BatchImagePredictionRequestInfo, unpredicted_indexes: [int],
+                                     batch_size: int, verbose: int) -> np.ndarray:
+        image_infos = batch_request_info.get_image_infos()
+        uncached_indexes = batch_request_info.get_uncached_indexes()
+        feature_rows_by_index = dict(zip(unpredicted_indexes, range(len(unpredicted_indexes))))
+        features = np.empty((len(unpredicted_indexes),) + self.conv_cache_feature_model.output_shape[1:], dtype=image.K.floatx())
+
+        if len(uncached_indexes) > 0:
+            uncached_features = self.conv_cache_feature_model.predict(batch_request_info.get_image_array(), batch_size=batch_size, verbose=verbose)
+            features[[feature_rows_by_index[index] for index in uncached_indexes]] = uncached_features
+            self.inference_feature_store.save_features([image_infos[index] for index in uncached_indexes], uncached_features)
+
+        cached_features = batch_request_info.get_cached_features()
+
+        for index in unpredicted_indexes:
+            if cached_features[index] is not None:
+                features[feature_rows_by_index[index]] = cached_features[index]
+
+        return self.conv_cache_head_model.predict(features, batch_size=batch_size, verbose=verbose)
+
+    def get_prediction_batch_size(self) -> int:
+        if self.BATCH_SIZE_TUNER is not None and not self.__prediction_batch_size_tuned:
+            self.PREDICTION_BATCH_SIZE = self.BATCH_SIZE_TUNER.get_prediction_batch_size(self.model, 'vgg16')
+            self.__prediction_batch_size_tuned = True
+
+        return self.PREDICTION_BATCH_SIZE
+
     def get_image_width(self):
         return 224
 
     def get_image_height(self):
         return 224
 
+    def get_prediction_resampling_mode(self) -> ResamplingMode:
+        return self.PREDICTION_RESAMPLING_MODE
+
     def get_classes(self) -> list:
         return self.classes
 
@@ -162,12 +286,105 @@ class Vgg16(IImageRecModel):
 
         self.model.summary()
         Vgg16.__compile(self.model)
+        self.__initialize_conv_cache_models()
+        self.inference_feature_store = None
+        self.prediction_store = None
+        self.__initialize_inference_feature_store()
+        self.__initialize_prediction_store()
         self.__establish_classes()
 
+    def __initialize_inference_feature_store(self):
+        if self.inference_feature_store is not None:
+            self.inference_feature_store.flush()
+
+        self.inference_feature_store = None
+
+        if self.CACHE_INFERENCE_FEATURES:
+            self.inference_feature_store = InferenceFeatureStore(self.CACHE_DIRECTORY + '/inferencecache/',
+                                                                 ConvCacheFingerprint.get_model_fingerprint(self.conv_cache_feature_model),
+                                                                 self.get_image_width(), self.get_image_height(), self.PREDICTION_RESAMPLING_MODE,
+                                                                 self.INFERENCE_FEATURE_CACHE_MAX_BYTES)
+
+    def __initialize_prediction_store(self):
+        if self.prediction_store is not None:
+            self.prediction_store.flush()
+
+        self.prediction_store = None
+
+        if self.CACHE_PREDICTIONS:
+            self.prediction_store = PredictionStore(self.__get_prediction_cache_directory(), ConvCacheFingerprint.get_model_fingerprint(self.model),
+                                                    self.__get_latest_saved_weights_file_name(), self.get_image_width(), self.get_image_height(),
+                                                    self.PREDICTION_RESAMPLING_MODE, self.PREDICTION_CACHE_MAX_BYTES)
+
+    # Replaces the given training and validation batch sizes with the fastest ones for this machine, the first time
+    # training happens.  Training is tuned on whichever model fit_generator actually trains, and validation on evaluating
+    # that same model.
+    def __tune_training_batch_sizes(self):
+        if self.BATCH_SIZE_TUNER is None or self.__training_batch_sizes_tuned:
+            return
+
+        training_model = self.conv_cache_head_model if self.FAST_CONV_CACHE_TRAINING else self.model
+        training_model_name = 'vgg16_conv_cache_head' if self.FAST_CONV_CACHE_TRAINING else 'vgg16'
+        training_batch_size = self.BATCH_SIZE_TUNER.get_training_batch_size(training_model, training_model_name)
+        validation_batch_size = self.BATCH_SIZE_TUNER.get_prediction_batch_size(training_model, training_model_name)
+        self.__training_batch_sizes_tuned = True
+
+        # Iterators fix their batch size when created
+        if training_batch_size != self.TRAINING_BATCH_SIZE:
+            self.TRAINING_BATCH_SIZE = training_batch_size
+            self.TRAINING_BATCHES = self.__get_batches(self.TRAINING_IMAGES_PATH, shuffle=True, batch_size=self.TRAINING_BATCH_SIZE)
+
+        if validation_batch_size != self.VALIDATION_BATCH_SIZE:
+            self.VALIDATION_BATCH_SIZE = validation_batch_size
+            self.VALIDATION_BATCHES = self.__get_batches(self.VALIDATION_IMAGES_PATH, shuffle=False, batch_size=self.VALIDATION_BATCH_SIZE)
+
+    def __get_prediction_cache_directory(self) -> str:
+        return self.CACHE_DIRECTORY + '/predictioncache/'
+
+    # The head's leading frozen layers (the pooling, plus any frozen dense layers) act the same at training and test
+    # time, so they can be folded into the cached features:  the cache then stores their much smaller output, and only
+    # the rest of the head is trained on it.  Both models share their layers with dense_model_portion.
+    def __initialize_conv_cache_models(self):
+        head_layers = self.dense_model_portion.layers
+        num_folded_layers = 0
+
+        if self.FOLD_FROZEN_HEAD_INTO_CONV_CACHE:
+            while num_folded_layers < len(head_layers) - 1 and Vgg16.__is_foldable_into_conv_cache(head_layers[num_folded_layers]):
+                num_folded_layers = num_folded_layers + 1
+
+            # Flattening doesn't make anything smaller, and keeping channels lets quantization work per channel
+            while num_folded_layers > 0 and type(head_layers[num_folded_layers - 1]) is Flatten:
+                num_folded_layers = num_folded_layers - 1
+
+        if num_folded_layers == 0:
+            self.conv_cache_feature_model = self.conv_model_portion
+            self.conv_cache_head_model = self.dense_model_portion
+            return
+
+        features = self.conv_model_portion.output
+
+        for layer in head_layers[:num_folded_layers]:
+            features = layer(features)
+
+        self.conv_cache_feature_model = Model(inputs=self.conv_model_portion.input, outputs=features)
+        head_input = Input(shape=self.conv_cache_feature_model.output_shape[1:])
+        head_output = head_input
+
+        for layer in head_layers[num_folded_layers:]:
+            head_output = layer(head_output)
+
+        self.conv_cache_head_model = Model(inputs=head_input, outputs=head_output)
+        Vgg16.__compile(self.conv_cache_head_model)
+
     @staticmethod
     def __is_dense_layer(layer: Sequential)->bool:
         return type(layer) is Dense
 
+    # Dropout and batch normalization behave differently while training, so they can't be folded
+    @staticmethod
+    def __is_foldable_into_conv_cache(layer: Sequential)->bool:
+        return type(layer) is MaxPooling2D or type(layer) is Flatten or (Vgg16.__is_dense_layer(layer) and not layer.trainable)
+
     @staticmethod
     def __is_conv_layer(layer: Sequential)->bool:
         return type(layer) is Convolution2D or type(layer) is Conv2D
@@ -263,7 +480,17 @@ class Vgg16(IImageRecModel):
         latest_saved_epoch = self.__determine_epoch_num_from_weights_file_name(latest_file_name)
         return self.LOAD_WEIGHTS_FROM_CACHE and latest_saved_epoch > 0
 
+    # Splits set up in manifest or packed mode (see DatasetManifest and PackedDataset) are loaded straight from their
+    # manifest or shards
     def __get_batches(self, path, gen=image.ImageDataGenerator(), shuffle=True, batch_size=8, class_mode='categorical') -> DirectoryIterator:
+        if PackedDataset.exists(path):
+            return PackedDatasetIterator(PackedDataset.load(path), gen, target_size=(self.get_image_width(), self.get_image_height()),
+                                         color_mode='rgb', class_mode=class_mode, batch_size=batch_size, shuffle=shuffle)
+
+        if DatasetManifest.exists(path):
+            return ManifestDirectoryIterator(DatasetManifest.load(path), gen, target_size=(self.get_image_width(), self.get_image_height()),
+                                             color_mode='rgb', class_mode=class_mode, batch_size=batch_size, shuffle=shuffle)
+
         return gen.flow_from_directory(path, target_size=(self.get_image_width(), self.get_image_height()), color_mode='rgb',
                                        class_mode=class_mode, shuffle=shuffle, batch_size=batch_size)
 
@@ -280,23 +507,37 @@ class Vgg16(IImageRecModel):
                                                            save_best_only=False,
                                                            save_weights_only=False, mode='auto', period=1)
 
-        validation_steps = int(np.ceil(val_batches.samples / self.VALIDATION_BATCH_SIZE))
-
         # OPTIMIZATION:  First, train the conv model on features, save those, then train fc layer for much faster feedback
         # Requires static images
         if self.FAST_CONV_CACHE_TRAINING:
             conv_cache_directory = self.CACHE_DIRECTORY + '/convcache/'
 
             conv_cache_training_batches = ConvCacheIterator(cache_directory=conv_cache_directory, batches=batches,
-                    batch_id = 'training', conv_model=self.conv_model_portion, batch_size=self.TRAINING_BATCH_SIZE, shuffle=True)
+                    batch_id = 'training', conv_model=self.conv_cache_feature_model, batch_size=self.TRAINING_BATCH_SIZE, shuffle=True,
+                    shuffle_mode=ConvCacheShuffleMode.GLOBAL, storage_type=self.CONV_CACHE_STORAGE_TYPE,
+                    num_augmented_variants=self.NUM_AUGMENTED_VARIANTS,
+                    augmentation_generator=image.ImageDataGenerator(**self.AUGMENTATION_GENERATOR_ARGUMENTS))
 
             conv_cache_validation_batches = ConvCacheIterator(cache_directory=conv_cache_directory, batches=val_batches,
-                    batch_id = 'validation', conv_model=self.conv_model_portion, batch_size=self.VALIDATION_BATCH_SIZE, shuffle=False)
-
-            self.dense_model_portion.fit_generator(conv_cache_training_batches, steps_per_epoch=steps_per_epoch, epochs=nb_epoch, initial_epoch=initial_epoch,
-                                     validation_data=conv_cache_validation_batches, validation_steps=validation_steps,
-                                     callbacks=[early_stopping, model_checkpoint])
+                    batch_id = 'validation', conv_model=self.conv_cache_feature_model, batch_size=self.VALIDATION_BATCH_SIZE, shuffle=False,
+                    storage_type=self.CONV_CACHE_STORAGE_TYPE)
+
+            # Checkpoints are still of the whole head, so they load into the full model as before
+            head_model_checkpoint = ModelPortionCheckpoint(self.dense_model_portion, model_checkpoint.filepath, monitor='val_loss', verbose=0,
+                                                           save_best_only=False, save_weights_only=False, mode='auto', period=1)
+            # Cache batches never straddle parts, so a full pass takes more steps than the images over the batch size
+            if steps_per_epoch is None:
+                steps_per_epoch = conv_cache_training_batches.get_num_steps_per_epoch()
+
+            self.conv_cache_head_model.fit_generator(conv_cache_training_batches, steps_per_epoch=steps_per_epoch, epochs=nb_epoch, initial_epoch=initial_epoch,
+                                     validation_data=conv_cache_validation_batches,
+                                     validation_steps=conv_cache_validation_batches.get_num_steps_per_epoch(),
+                                     callbacks=[early_stopping, head_model_checkpoint])
         else:
+            if steps_per_epoch is None:
+                steps_per_epoch = int(np.ceil(batches.samples / self.TRAINING_BATCH_SIZE))
+
+            validation_steps = int(np.ceil(val_batches.samples / self.VALIDATION_BATCH_SIZE))
             self.model.fit_generator(batches, steps_per_epoch=steps_per_epoch, epochs=nb_epoch, initial_epoch=initial_epoch,
                                      validation_data=val_batches, validation_steps=validation_steps,
                                      callbacks=[early_stopping, model_checkpoint])
@@ -0,0 +1,50 @@
+import numpy as np
+
+from common.model.deeplearning.prediction.PredictionFusionMode import PredictionFusionMode
+
+
+# Vectorized test time augmentation:  works directly on the raw (N, C) confidence matrix of N images, with a group index
+# per image saying which test id (0..num_groups - 1) it belongs to, so that no per class or per image objects are made.
+class PredictionAggregator:
+    EPSILON = 1e-7
+
+    # Returns the fused (num_groups, C) confidences, along with the row each group's result is attributed to:  the most
+    # confident row for MAX (the first such row on ties), and otherwise the group's first row (the full image, which
+    # comes ahead of its crops).  Every group must have at least one row.
+    @staticmethod
+    def fuse(confidences: np.ndarray, group_indexes: np.ndarray, fusion_mode: PredictionFusionMode) -> (np.ndarray, np.ndarray):
+        confidences = np.asarray(confidences, dtype=np.float64)
+        group_indexes = np.asarray(group_indexes, dtype=np.int64)
+        top_confidences = confidences.max(axis=1)
+
+        if fusion_mode == PredictionFusionMode.MAX:
+            # lexsort sorts by its last key first, and is stable
+            order = np.lexsort((-top_confidences, group_indexes))
+            representative_rows = order[PredictionAggregator.__get_group_starts(group_indexes[order])]
+            return confidences[representative_rows], representative_rows
+
+        order = np.argsort(group_indexes, kind='mergesort')
+        group_starts = PredictionAggregator.__get_group_starts(group_indexes[order])
+        first_rows = order[group_starts]
+
+        def sum_groups(values: np.ndarray) -> np.ndarray:
+            return np.add.reduceat(values[order], group_starts, axis=0)
+
+        group_sizes = np.diff(np.append(group_starts, len(order)))[:, np.newaxis]
+
+        if fusion_mode == PredictionFusionMode.MEAN:
+            return sum_groups(confidences) / group_sizes, first_rows
+
+        if fusion_mode == PredictionFusionMode.GEOMETRIC_MEAN:
+            fused = np.exp(sum_groups(np.log(np.maximum(confidences, PredictionAggregator.EPSILON))) / group_sizes)
+            return fused / fused.sum(axis=1, keepdims=True), first_rows
+
+        if fusion_mode == PredictionFusionMode.CONFIDENCE_WEIGHTED:
+            weights = top_confidences[:, np.newaxis]
+            return sum_groups(confidences * weights) / sum_groups(weights), first_rows
+
+        raise ValueError('Unsupported fusion mode: ' + str(fusion_mode))
+
+    @staticmethod
+    def __get_group_starts(sorted_group_indexes: np.ndarray) -> np.ndarray:
+        return np.flatnonzero(np.append(True, sorted_group_indexes[1:] != sorted_group_indexes[:-1]))
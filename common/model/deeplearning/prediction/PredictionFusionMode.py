@@ -0,0 +1,13 @@
+from enum import Enum
+
+
+# How the predictions for all of a test id's images (the full image and its crops) are combined into one
+class PredictionFusionMode(Enum):
+    # The single most confident image's prediction
+    MAX = 1
+    # Per class average
+    MEAN = 2
+    # Per class geometric mean, renormalized to sum to one.  Any image that rules a class out pulls it down hard.
+    GEOMETRIC_MEAN = 3
+    # Per class average, with each image weighted by its top confidence
+    CONFIDENCE_WEIGHTED = 4
@@ -1,4 +1,6 @@
 class PredictionInfo:
+    __slots__ = ('__confidence', '__class_id', '__class_name')
+
     @staticmethod
     def generate_prediction_infos(confidences: [float], class_ids: [int], class_names: [str], min_confidence: float, max_confidence: float) -> []:
         prediction_infos = []
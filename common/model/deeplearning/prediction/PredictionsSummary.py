@@ -1,30 +1,56 @@
+import numpy as np
+
+from common.image.CropBox import CropBox
 from common.image.ImageInfo import ImageInfo
-from common.model.deeplearning.prediction import PredictionInfo
+from common.model.deeplearning.prediction.PredictionInfo import PredictionInfo
 
 
+# Compact on purpose, since there's one per test image:  a float32 row (normally a view into a confidence matrix shared
+# with the rest of its batch), the test id, and just enough to rebuild the ImageInfo when it's asked for.  PredictionInfo
+# objects are only made by the getters that return them.
 class PredictionsSummary:
-    def __init__(self, image_info: ImageInfo, predictions: []):
-        self.__image_info = image_info
-        predictions.sort(reverse=True)
-        self.__predictions = predictions
-        self.__class_id_to_confidence = dict()
-        for prediction in predictions:
-            self.__class_id_to_confidence[prediction.get_class_id()] = prediction.get_confidence()
-
-    def get_all_predictions(self):
-        return self.__predictions
+    __slots__ = ('__confidences', '__test_id', '__classes', '__image_path', '__crop_box')
+
+    # One summary per row of confidences (number of images, number of classes).  The rows are clipped to [0, 1] and
+    # stored as float32 views into a single copy of the matrix.
+    @staticmethod
+    def generate_instances(confidences: np.ndarray, image_infos: [ImageInfo], classes: {}) -> []:
+        shared_confidences = np.clip(confidences, 0.0, 1.0).astype(np.float32)
+        return [PredictionsSummary(shared_confidences[index], image_info.get_image_number(), classes, image_info.get_image_path(),
+                                   image_info.get_crop_box()) for index, image_info in enumerate(image_infos)]
+
+    def __init__(self, confidences: np.ndarray, test_id, classes: {}, image_path: str, crop_box: CropBox = None):
+        self.__confidences = confidences
+        self.__test_id = test_id
+        self.__classes = classes
+        self.__image_path = image_path
+        self.__crop_box = crop_box
+
+    # Most confident first
+    def get_all_predictions(self) -> [PredictionInfo]:
+        class_ids = np.argsort(-self.__confidences, kind='mergesort')
+        return [self.__generate_prediction_info(class_id) for class_id in class_ids]
 
     def get_top_prediction(self) -> PredictionInfo:
-        return self.get_all_predictions()[0]
+        return self.__generate_prediction_info(np.argmax(self.__confidences))
 
     def get_confidence_for_class_id(self, class_id):
-        return self.__class_id_to_confidence.get(class_id)
+        if not (0 <= class_id < len(self.__confidences)):
+            return None
+
+        return float(self.__confidences[class_id])
 
-    def get_test_id(self) -> int:
-        return self.__image_info.get_image_number()
+    def get_confidences(self) -> np.ndarray:
+        return self.__confidences
+
+    def get_test_id(self):
+        return self.__test_id
 
     def get_image_info(self) -> ImageInfo:
-        return self.__image_info
+        return ImageInfo.get_instance(self.__test_id, self.__image_path, self.__crop_box)
+
+    def __generate_prediction_info(self, class_id) -> PredictionInfo:
+        return PredictionInfo(float(self.__confidences[class_id]), int(class_id), self.__classes[class_id])
 
     def __lt__(self, other):
-        return self.get_top_prediction().get_confidence() < other.get_top_prediction().get_confidence()
+        return self.__confidences.max() < other.get_confidences().max()
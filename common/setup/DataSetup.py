@@ -1,19 +1,37 @@
-import shutil
 from glob import glob
 from numpy.random import permutation
 import os
+import threading
 
+from common.dataset.DatasetManifest import DatasetManifest
+from common.dataset.PackedDataset import PackedDataset
+from common.image.AugmentationSettings import AugmentationSettings
+from common.setup.DirectoryMaterializer import DirectoryMaterializer
 from common.setup.ImagesDirectoryCreationMode import ImagesDirectoryCreationMode
-from keras.preprocessing.image import ImageDataGenerator, array_to_img, img_to_array, load_img
-import concurrent.futures
+from common.setup.OfflineAugmenter import OfflineAugmenter
 
 class DataSetup:
+    # num_workers sizes the file operation thread pool (see DirectoryMaterializer).  allow_hardlinks (off by default) lets
+    # copies be hardlinks where reflinks aren't supported, which is safe as long as nothing modifies image files in place.
+    # creation_mode is how images get into the working (and sample) directories:  COPY, LINK or SYMLINK, MANIFEST to
+    # only write DatasetManifest files, or PACKED to write PackedDataset shards.  In MANIFEST and PACKED modes the
+    # directories are virtual while setting up:  planned operations just update a map of virtual image path -> real
+    # image path, which directory listings consult, and each split's index (and shards) are written at the end.
+    # num_augmentation_workers sizes the training data augmentation process pool (see OfflineAugmenter).
+    def __init__(self, num_workers: int = None, allow_hardlinks: bool = False,
+                 creation_mode: ImagesDirectoryCreationMode = ImagesDirectoryCreationMode.COPY, num_augmentation_workers: int = None):
+        self._materializer = DirectoryMaterializer(num_workers, allow_hardlinks)
+        self._augmenter = OfflineAugmenter(AugmentationSettings.GENERATOR_ARGUMENTS, num_augmentation_workers)
+        self._creation_mode = creation_mode
+        self.__virtual_image_paths = {}
+        self.__virtual_image_paths_lock = threading.Lock()
+
     def establish_working_data_directory_if_needed(self, source_directory: str, destination_directory: str,
                 destination_sample_directory: str, image_file_extension='jpg', valid_to_test_ratio=0.1, sample_ratio=0.02,
                 train_augment_factor=0):
         source_directory=DataSetup._cleanup_directory_path(source_directory)
         destination_directory=DataSetup._cleanup_directory_path(destination_directory)
-        DataSetup._establish_directory_if_needed(destination_directory)
+        self._establish_directory_if_needed(destination_directory)
 
         if not self._need_to_establish_working_data_directory(destination_directory):
             return
@@ -33,121 +51,193 @@ class DataSetup:
         self._augment_training_data_if_applicable(training_directory=destination_training_data_directory,
                                                   train_augment_factor=train_augment_factor, image_file_extension=image_file_extension)
 
+        if self.__uses_virtual_directories():
+            self.__save_split_indexes()
+
     def _augment_training_data_if_applicable(self, training_directory: str, train_augment_factor: int, image_file_extension: str):
         if train_augment_factor <= 0:
             return
 
-        sub_directory_paths = self._get_sub_directories(training_directory)
-        with concurrent.futures.ThreadPoolExecutor() as executor:
-            for sub_directory_path in sub_directory_paths:
-                source_images = DataSetup._get_files_with_extension(sub_directory_path, image_file_extension)
-                futures = []
-                for source_image in source_images:
-                    futures.append(executor.submit(self._add_augmented_images, train_augment_factor, source_image))
+        tasks = []
 
-                concurrent.futures.wait(futures)
+        for sub_directory_path in self._get_sub_directories(training_directory):
+            for source_image in self._get_files_with_extension(sub_directory_path, image_file_extension):
+                save_to_dir = os.path.dirname(os.path.abspath(source_image))
+                save_prefix = os.path.splitext(os.path.basename(source_image))[0] + '_aug'
+                # Seeded by the path within the training directory, so augmentation doesn't depend on where the data lives
+                seed_key = DatasetManifest.normalize_path(os.path.relpath(source_image, training_directory))
+                tasks.append((self.__get_real_path(source_image), save_to_dir, save_prefix, seed_key))
 
+        augmented_image_paths = self._augmenter.augment(tasks, train_augment_factor)
+
+        # Augmented images are new files either way; with virtual directories they're the only real files in the split's
+        # directory (until they're packed, in PACKED mode)
+        if self.__uses_virtual_directories():
+            self._execute_operations([(image_path, image_path, ImagesDirectoryCreationMode.COPY) for image_path in augmented_image_paths])
 
     def _establish_training_and_test_data(self, source_directory: str, destination_directory: str, image_file_extension: str):
         source_directory=DataSetup._cleanup_directory_path(source_directory)
         destination_directory=DataSetup._cleanup_directory_path(destination_directory)
-        DataSetup._establish_directory_if_needed(destination_directory)
-        source_data_directoryPaths = DataSetup._get_sub_directories(source_directory)
+        self._establish_directory_if_needed(destination_directory)
+        source_data_directoryPaths = self._get_sub_directories(source_directory)
 
         for source_data_directory_path in source_data_directoryPaths:
             new_directory_path = str.replace(source_data_directory_path, source_directory, destination_directory)
-            DataSetup._establish_directory_if_needed(new_directory_path)
+            self._establish_directory_if_needed(new_directory_path)
             self._create_new_images_directory(source_data_directory_path, new_directory_path,
-                                              image_file_extension, 1.0, ImagesDirectoryCreationMode.COPY)
+                                              image_file_extension, 1.0, self._creation_mode)
 
     def _need_to_establish_working_data_directory(self, destination_directory):
-        destination_sub_directory_names = DataSetup._get_sub_directories(destination_directory)
-        return len(destination_sub_directory_names) == 0
+        destination_sub_directory_names = self._get_sub_directories(destination_directory)
+        index_paths = glob(DatasetManifest.normalize_path(destination_directory) + '/*' + DatasetManifest.FILE_SUFFIX) \
+                      + glob(DatasetManifest.normalize_path(destination_directory) + '/*' + PackedDataset.FILE_SUFFIX)
+        return len(destination_sub_directory_names) == 0 and len(index_paths) == 0
 
     def _establish_validation_data(self, training_directory: str, valid_directory: str, image_file_extension: str, valid_to_test_ratio: float):
         training_directory=DataSetup._cleanup_directory_path(training_directory)
         valid_directory=DataSetup._cleanup_directory_path(valid_directory)
-        DataSetup._establish_directory_if_needed(valid_directory)
+        self._establish_directory_if_needed(valid_directory)
         self._create_new_images_directory(training_directory, valid_directory, image_file_extension, valid_to_test_ratio, ImagesDirectoryCreationMode.MOVE)
 
     def _establish_sample_data(self, main_data_directory: str, sample_directory: str, image_file_extension: str, sample_ratio: float):
         main_data_directory=DataSetup._cleanup_directory_path(main_data_directory)
         sample_directory=DataSetup._cleanup_directory_path(sample_directory)
-        DataSetup._establish_directory_if_needed(sample_directory)
-        main_data_directoryPaths = DataSetup._get_sub_directories(main_data_directory)
+        self._establish_directory_if_needed(sample_directory)
+        main_data_directoryPaths = self._get_sub_directories(main_data_directory)
 
         for main_data_directory_path in main_data_directoryPaths:
             new_sample_directory_path = str.replace(main_data_directory_path, main_data_directory, sample_directory)
-            DataSetup._establish_directory_if_needed(new_sample_directory_path)
+            self._establish_directory_if_needed(new_sample_directory_path)
             self._create_new_images_directory(main_data_directory_path, new_sample_directory_path, image_file_extension, sample_ratio,
-                                              ImagesDirectoryCreationMode.COPY)
+                                              self._creation_mode)
 
+    # Plans every file operation first, then carries them all out once
     def _create_new_images_directory(self, source_dir: str, destination_dir: str, image_file_extension: str, ratio_to_copy: float,
                                      creation_mode: ImagesDirectoryCreationMode):
-        source_sub_directories = DataSetup._get_sub_directories(source_dir)
+        source_sub_directories = self._get_sub_directories(source_dir)
+        operations = []
 
-        with concurrent.futures.ThreadPoolExecutor() as executor:
-            futures = []
-            for source_sub_directory in source_sub_directories:
-                self.__create_new_images_subdirectory(source_sub_directory, source_dir, destination_dir, image_file_extension, ratio_to_copy, creation_mode)
-                futures.append(executor.submit(DataSetup.__create_new_images_subdirectory, source_sub_directory,
-                                               source_dir, destination_dir, image_file_extension, ratio_to_copy, creation_mode))
-            concurrent.futures.wait(futures)
+        for source_sub_directory in source_sub_directories:
+            operations.extend(self.__plan_new_images_subdirectory(source_sub_directory, source_dir, destination_dir, image_file_extension,
+                                                                  ratio_to_copy, creation_mode))
 
-    @staticmethod
-    def __create_new_images_subdirectory(source_sub_directory: str, source_dir: str, destination_dir: str, image_file_extension: str, ratio_to_copy: float,
-                                         creation_mode: ImagesDirectoryCreationMode):
+        self._execute_operations(operations)
+
+    # Carries out planned (source path, destination path, creation mode) operations, or with virtual directories just
+    # records them there
+    def _execute_operations(self, operations: [(str, str, ImagesDirectoryCreationMode)]):
+        if not self.__uses_virtual_directories():
+            self._materializer.materialize(operations)
+            return
+
+        with self.__virtual_image_paths_lock:
+            for source_path, destination_path, creation_mode in operations:
+                real_path = self.__virtual_image_paths.get(DataSetup.__get_virtual_key(source_path), os.path.abspath(source_path))
+
+                if creation_mode == ImagesDirectoryCreationMode.MOVE:
+                    self.__virtual_image_paths.pop(DataSetup.__get_virtual_key(source_path), None)
+
+                self.__virtual_image_paths[DataSetup.__get_virtual_key(destination_path)] = real_path
+
+    def __plan_new_images_subdirectory(self, source_sub_directory: str, source_dir: str, destination_dir: str, image_file_extension: str,
+                                       ratio_to_copy: float, creation_mode: ImagesDirectoryCreationMode) -> [(str, str, ImagesDirectoryCreationMode)]:
         destination_sub_directory = str.replace(source_sub_directory, source_dir, destination_dir)
-        DataSetup._establish_directory_if_needed(destination_sub_directory)
-        source_images = DataSetup._get_files_with_extension(source_sub_directory, image_file_extension)
+        self._establish_directory_if_needed(destination_sub_directory)
+        source_images = self._get_files_with_extension(source_sub_directory, image_file_extension)
         num_images_to_copy = int(round(ratio_to_copy * len(source_images), 0))
         images_to_move_or_copy = permutation(source_images)[:num_images_to_copy+1]
+        operations = []
 
         for source_image_to_move_or_copy in images_to_move_or_copy:
             new_image_path = str.replace(source_image_to_move_or_copy, source_dir, destination_dir)
-            if creation_mode == ImagesDirectoryCreationMode.MOVE:
-                shutil.move(source_image_to_move_or_copy, new_image_path)
+            operations.append((source_image_to_move_or_copy, new_image_path, creation_mode))
+
+        return operations
+
+    def __get_real_path(self, path: str) -> str:
+        with self.__virtual_image_paths_lock:
+            return self.__virtual_image_paths.get(DataSetup.__get_virtual_key(path), path)
+
+    def __uses_virtual_directories(self) -> bool:
+        return self._creation_mode in (ImagesDirectoryCreationMode.MANIFEST, ImagesDirectoryCreationMode.PACKED)
+
+    def __save_split_indexes(self):
+        split_path_to_entries = {}
+
+        with self.__virtual_image_paths_lock:
+            for virtual_path, real_path in self.__virtual_image_paths.items():
+                class_directory = os.path.dirname(virtual_path)
+                split_path = os.path.dirname(class_directory)
+
+                if not (split_path in split_path_to_entries):
+                    split_path_to_entries[split_path] = []
+
+                split_path_to_entries[split_path].append((os.path.basename(class_directory), real_path))
+
+        for split_path, entries in split_path_to_entries.items():
+            if self._creation_mode == ImagesDirectoryCreationMode.PACKED:
+                PackedDataset.write(split_path, entries)
+                print('Packed ' + split_path + ' (' + str(len(entries)) + ' images)')
             else:
-                shutil.copy(source_image_to_move_or_copy, new_image_path)
-
-    def _add_augmented_images(self, augment_factor: int, original_image_path: str):
-        datagen = ImageDataGenerator(
-            rotation_range=15,
-            width_shift_range=0.1,
-            height_shift_range=0.1,
-            shear_range=0.2,
-            zoom_range=0.1,
-            horizontal_flip=True,
-            channel_shift_range=0.2,
-            fill_mode='nearest')
-
-        original_image = load_img(original_image_path)
-        x = img_to_array(original_image)
-        x = x.reshape((1,) + x.shape)
-
-        save_to_dir = os.path.dirname(os.path.abspath(original_image_path))
-        save_prefix = os.path.splitext(os.path.basename(original_image_path))[0]+'_aug'
-
-        image_num = 0
-        for batch in datagen.flow(x, batch_size=1, save_to_dir=save_to_dir, save_prefix=save_prefix, save_format='jpeg'):
-            image_num += 1
-            if image_num >= augment_factor:
-                break
+                DatasetManifest(split_path, entries).save()
+                print('Wrote manifest for ' + split_path + ' (' + str(len(entries)) + ' images)')
+
+        if self._creation_mode == ImagesDirectoryCreationMode.PACKED:
+            self.__remove_packed_real_files()
+
+    # Files made in the virtual directories (augmented images) are in the shards now
+    def __remove_packed_real_files(self):
+        with self.__virtual_image_paths_lock:
+            real_paths = [real_path for virtual_path, real_path in self.__virtual_image_paths.items()
+                          if DataSetup.__get_virtual_key(real_path) == virtual_path]
+
+        for real_path in real_paths:
+            os.remove(real_path)
+
+        # Class directories and then their split directories, if that leaves them empty
+        class_directories = set(os.path.dirname(real_path) for real_path in real_paths)
+
+        for directory in sorted(class_directories | set(os.path.dirname(directory) for directory in class_directories), reverse=True):
+            if os.path.isdir(directory) and len(os.listdir(directory)) == 0:
+                os.rmdir(directory)
+
+    @staticmethod
+    def __get_virtual_key(path: str) -> str:
+        return os.path.abspath(DatasetManifest.normalize_path(path))
 
     @staticmethod
     def _cleanup_directory_path(directory: str):
         return str.replace(directory, "/", "\\")
 
-    @staticmethod
-    def _get_sub_directories(directory: str):
-        return glob(directory + "/*/")
+    # Listings include virtual directories and images (in MANIFEST and PACKED modes), in the same form glob gives for real
+    # ones
+    def _get_sub_directories(self, directory: str):
+        sub_directories = glob(directory + "/*/")
+        virtual_children = self.__get_virtual_children(directory)
+        virtual_sub_directory_names = set(child_path[0] for child_path in virtual_children if len(child_path) > 1)
+        return DataSetup.__merge_listings(sub_directories, [directory + "/" + name + "/" for name in sorted(virtual_sub_directory_names)])
+
+    def _get_files_with_extension(self, directory: str, extension: str):
+        file_paths = glob(directory + "/*." + extension)
+        virtual_children = self.__get_virtual_children(directory)
+        virtual_file_names = [child_path[0] for child_path in virtual_children if len(child_path) == 1 and child_path[0].endswith("." + extension)]
+        return DataSetup.__merge_listings(file_paths, [directory + "/" + name for name in sorted(virtual_file_names)])
+
+    # Virtual directories only exist in the map of virtual image paths
+    def _establish_directory_if_needed(self, directory: str):
+        if not self.__uses_virtual_directories() and not os.path.exists(directory):
+            os.makedirs(directory)
 
-    @staticmethod
-    def _get_files_with_extension(directory: str, extension: str):
-        return glob(directory + "/*." + extension)
+    # Paths (as tuples of names) of the virtual images under a directory, relative to it
+    def __get_virtual_children(self, directory: str) -> [(str,)]:
+        directory_key = DataSetup.__get_virtual_key(directory)
+
+        with self.__virtual_image_paths_lock:
+            return [tuple(os.path.relpath(virtual_path, directory_key).split(os.sep)) for virtual_path in self.__virtual_image_paths.keys()
+                    if virtual_path.startswith(directory_key + os.sep)]
 
     @staticmethod
-    def _establish_directory_if_needed(directory: str):
-        if not os.path.exists(directory):
-            os.makedirs(directory)
+    def __merge_listings(real_paths: [str], virtual_paths: [str]) -> [str]:
+        real_keys = set(DataSetup.__get_virtual_key(path) for path in real_paths)
+        return real_paths + [path for path in virtual_paths if not (DataSetup.__get_virtual_key(path) in real_keys)]
 
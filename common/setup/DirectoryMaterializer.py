@@ -0,0 +1,168 @@
+import concurrent.futures
+import errno
+import os
+import shutil
+import threading
+import time
+
+from common.setup.ImagesDirectoryCreationMode import ImagesDirectoryCreationMode
+
+
+# Carries out a planned list of (source path, destination path, creation mode) operations, each exactly once, across a
+# thread pool.  File operations are I/O bound, so the pool is a lot bigger than the number of cores by default.
+# Destination directories are all created up front, so workers never race to create them.
+#
+# Copies are made as cheaply as the filesystem allows:  a reflink (copy on write clone, i.e. btrfs or XFS) if it's
+# supported, otherwise a hardlink if allowed (off by default; fine for data sets whose files are only ever added, moved
+# or deleted, never modified in place, and reported since the copies then share their data), and only otherwise a real
+# copy.  Once a method fails for lack of support it isn't tried
+# again.  Moves are renames unless they cross filesystems.  LINK always hardlinks (copying only across filesystems), and
+# SYMLINK links to the source's real path, so links of links don't chain.
+class DirectoryMaterializer:
+    # Linux FICLONE ioctl
+    FICLONE = 0x40049409
+    UNSUPPORTED_ERRNOS = {errno.EXDEV, errno.EPERM, errno.EINVAL, errno.ENOTTY, errno.EOPNOTSUPP, errno.ENOSYS, errno.EMLINK}
+
+    def __init__(self, num_workers: int = None, allow_hardlinks: bool = False):
+        self.__num_workers = num_workers if num_workers is not None else min(64, (os.cpu_count() or 1) * 8)
+        self.__reflinks_supported = DirectoryMaterializer.__can_reflink()
+        self.__hardlinks_supported = allow_hardlinks
+        self.__lock = threading.Lock()
+        self.__method_counts = {}
+        self.__num_hardlinked_copies = 0
+
+    def materialize(self, operations: [(str, str, ImagesDirectoryCreationMode)]):
+        if len(operations) == 0:
+            return
+
+        for directory in sorted(set(os.path.dirname(destination_path) for source_path, destination_path, creation_mode in operations)):
+            if directory != '' and not os.path.exists(directory):
+                os.makedirs(directory, exist_ok=True)
+
+        self.__method_counts = {}
+        self.__num_hardlinked_copies = 0
+        start = time.perf_counter()
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.__num_workers) as executor:
+            # Consuming the results re-raises the first failure, if any
+            for result in executor.map(self.__execute, operations):
+                pass
+
+        seconds = max(time.perf_counter() - start, 1e-9)
+        method_summary = ', '.join(method + ': ' + str(count) for method, count in sorted(self.__method_counts.items()))
+        print('Materialized ' + str(len(operations)) + ' files in ' + '{:.2f}'.format(seconds) + 's ('
+              + '{:.0f}'.format(len(operations) / seconds) + ' files/sec; ' + method_summary + ')')
+
+        if self.__num_hardlinked_copies > 0:
+            print('Reflinks not supported, so ' + str(self.__num_hardlinked_copies) + ' copies were made as hardlinks instead:  they share '
+                  + 'their data with the source files')
+
+    def __execute(self, operation: (str, str, ImagesDirectoryCreationMode)):
+        source_path, destination_path, creation_mode = operation
+
+        if creation_mode == ImagesDirectoryCreationMode.MOVE:
+            method = DirectoryMaterializer.__move(source_path, destination_path)
+        elif creation_mode == ImagesDirectoryCreationMode.LINK:
+            method = DirectoryMaterializer.__link(source_path, destination_path)
+        elif creation_mode == ImagesDirectoryCreationMode.SYMLINK:
+            method = DirectoryMaterializer.__symlink(source_path, destination_path)
+        elif creation_mode == ImagesDirectoryCreationMode.COPY:
+            method = self.__copy(source_path, destination_path)
+        else:
+            raise ValueError('Unsupported creation mode for files: ' + str(creation_mode))
+
+        with self.__lock:
+            self.__method_counts[method] = self.__method_counts.get(method, 0) + 1
+
+    def __copy(self, source_path: str, destination_path: str) -> str:
+        DirectoryMaterializer.__remove_if_exists(destination_path)
+
+        if self.__reflinks_supported:
+            try:
+                DirectoryMaterializer.__reflink(source_path, destination_path)
+                return 'reflink'
+            except OSError as error:
+                if not (error.errno in DirectoryMaterializer.UNSUPPORTED_ERRNOS):
+                    raise
+
+                self.__reflinks_supported = False
+
+        if self.__hardlinks_supported:
+            try:
+                os.link(source_path, destination_path)
+
+                with self.__lock:
+                    self.__num_hardlinked_copies = self.__num_hardlinked_copies + 1
+
+                return 'hardlink'
+            except OSError as error:
+                if not (error.errno in DirectoryMaterializer.UNSUPPORTED_ERRNOS):
+                    raise
+
+                self.__hardlinks_supported = False
+
+        shutil.copyfile(source_path, destination_path)
+        return 'copy'
+
+    @staticmethod
+    def __link(source_path: str, destination_path: str) -> str:
+        DirectoryMaterializer.__remove_if_exists(destination_path)
+
+        try:
+            os.link(source_path, destination_path)
+            return 'hardlink'
+        except OSError as error:
+            if error.errno != errno.EXDEV:
+                raise
+
+        shutil.copyfile(source_path, destination_path)
+        return 'copy'
+
+    @staticmethod
+    def __symlink(source_path: str, destination_path: str) -> str:
+        DirectoryMaterializer.__remove_if_exists(destination_path)
+        os.symlink(os.path.realpath(source_path), destination_path)
+        return 'symlink'
+
+    # Same as shutil.copy, which replaced whatever was already there
+    @staticmethod
+    def __remove_if_exists(path: str):
+        if os.path.lexists(path):
+            os.remove(path)
+
+    @staticmethod
+    def __move(source_path: str, destination_path: str) -> str:
+        try:
+            os.replace(source_path, destination_path)
+            return 'rename'
+        except OSError as error:
+            if error.errno != errno.EXDEV:
+                raise
+
+        shutil.move(source_path, destination_path)
+        return 'move'
+
+    @staticmethod
+    def __reflink(source_path: str, destination_path: str):
+        import fcntl
+
+        with open(source_path, 'rb') as source_file:
+            destination_fd = os.open(destination_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+
+            try:
+                fcntl.ioctl(destination_fd, DirectoryMaterializer.FICLONE, source_file.fileno())
+            except OSError:
+                os.close(destination_fd)
+                os.remove(destination_path)
+                raise
+
+            os.close(destination_fd)
+
+    @staticmethod
+    def __can_reflink() -> bool:
+        try:
+            import fcntl
+        except ImportError:
+            return False
+
+        return hasattr(fcntl, 'ioctl') and os.uname().sysname == 'Linux'
@@ -4,3 +4,11 @@ from enum import Enum
 class ImagesDirectoryCreationMode(Enum):
     COPY = 1
     MOVE = 2
+    # Hardlinks to the source files (copies where the destination is on another filesystem)
+    LINK = 3
+    # Symlinks to the source files' real paths
+    SYMLINK = 4
+    # No files at all:  splits are written as DatasetManifest index files pointing at the source files
+    MANIFEST = 5
+    # Splits are packed into PackedDataset shard files of the encoded images, plus an index
+    PACKED = 6
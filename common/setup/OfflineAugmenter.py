@@ -0,0 +1,78 @@
+import io
+import multiprocessing
+import os
+import time
+import zlib
+
+import numpy as np
+from keras.preprocessing.image import ImageDataGenerator, array_to_img, img_to_array, load_img
+
+# Per worker process state, set up once by the pool initializer
+_worker_image_data_generator = None
+_worker_augment_factor = None
+
+
+def _initialize_worker(generator_arguments: {}, augment_factor: int):
+    global _worker_image_data_generator, _worker_augment_factor
+    _worker_image_data_generator = ImageDataGenerator(**generator_arguments)
+    _worker_augment_factor = augment_factor
+
+
+# Every augmented image of the task's source images is encoded in memory first, then they're all written out together
+def _augment_images(tasks: [(str, str, str, str)]) -> [str]:
+    encoded_images = []
+
+    for image_path, save_directory, save_prefix, seed_key in tasks:
+        x = img_to_array(load_img(image_path))
+        np.random.seed(OfflineAugmenter.generate_seed(seed_key))
+
+        for image_num in range(_worker_augment_factor):
+            augmented_image = array_to_img(_worker_image_data_generator.random_transform(x), scale=True)
+            image_bytes = io.BytesIO()
+            augmented_image.save(image_bytes, format='jpeg')
+            encoded_images.append((os.path.join(save_directory, save_prefix + '_' + str(image_num) + '.jpeg'), image_bytes.getvalue()))
+
+    for augmented_image_path, image_bytes in encoded_images:
+        with open(augmented_image_path, 'wb') as augmented_image_file:
+            augmented_image_file.write(image_bytes)
+
+    return [augmented_image_path for augmented_image_path, image_bytes in encoded_images]
+
+
+# Writes augment_factor randomly transformed copies of each source image, across a pool of worker processes (the
+# transforms are numpy work, which threads would serialize on the GIL).  Each worker builds its ImageDataGenerator
+# once, and source images are handed out images_per_task at a time.  Each source image's transforms are seeded from
+# the CRC32 of its seed key (i.e. its path relative to the data set), so the same data set always gets the same
+# augmented images, whichever worker happens to make them.  They're named <save prefix>_<augmentation number>.jpeg.
+class OfflineAugmenter:
+    def __init__(self, generator_arguments: {}, num_workers: int = None, images_per_task: int = 8):
+        self.__generator_arguments = generator_arguments
+        self.__num_workers = num_workers if num_workers is not None else (os.cpu_count() or 1)
+        self.__images_per_task = images_per_task
+
+    @staticmethod
+    def generate_seed(seed_key: str) -> int:
+        return zlib.crc32(seed_key.encode('utf-8')) & 0xffffffff
+
+    # Takes (source image path, save directory, save prefix, seed key) tasks, and returns the paths of the augmented
+    # images written
+    def augment(self, tasks: [(str, str, str, str)], augment_factor: int) -> [str]:
+        if len(tasks) == 0 or augment_factor <= 0:
+            return []
+
+        for save_directory in sorted(set(task[1] for task in tasks)):
+            os.makedirs(save_directory, exist_ok=True)
+
+        task_batches = [tasks[start:start + self.__images_per_task] for start in range(0, len(tasks), self.__images_per_task)]
+        augmented_image_paths = []
+        start = time.perf_counter()
+
+        with multiprocessing.Pool(processes=min(self.__num_workers, len(task_batches)), initializer=_initialize_worker,
+                                  initargs=(self.__generator_arguments, augment_factor)) as pool:
+            for batch_augmented_image_paths in pool.imap_unordered(_augment_images, task_batches):
+                augmented_image_paths.extend(batch_augmented_image_paths)
+
+        seconds = max(time.perf_counter() - start, 1e-9)
+        print('Augmented ' + str(len(tasks)) + ' images into ' + str(len(augmented_image_paths)) + ' in ' + '{:.2f}'.format(seconds)
+              + 's (' + '{:.0f}'.format(len(augmented_image_paths) / seconds) + ' images/sec)')
+        return augmented_image_paths
@@ -0,0 +1,107 @@
+import collections
+import threading
+
+
+# Runs an iterable on a background thread, handing items over through a bounded buffer.  The producer blocks once the
+# buffer is full, so at most max_queue_size items (plus the one being produced) are ever held in memory.  Exceptions
+# raised by the producer are re-raised in the consumer.
+#
+# close() wakes up both sides:  a producer blocked on a full buffer stops, and a consumer blocked on an empty one (i.e.
+# the next stage's producer thread) gets StopIteration.  Items that will never be consumed (those left in the buffer,
+# and whatever the producer was about to add) are handed to discard_callback, so that they can release what they hold.
+class BackgroundGenerator:
+    __END_OF_ITEMS = object()
+
+    class __ProducerFailure:
+        def __init__(self, exception: BaseException):
+            self.exception = exception
+
+    def __init__(self, source_iterable, max_queue_size: int, name: str = None, discard_callback=None):
+        self.__max_queue_size = max(max_queue_size, 1)
+        self.__discard_callback = discard_callback
+        self.__items = collections.deque()
+        self.__condition = threading.Condition()
+        self.__stopped = False
+        self.__finished = False
+        self.__thread = threading.Thread(target=self.__produce, args=(source_iterable,), name=name)
+        self.__thread.daemon = True
+        self.__thread.start()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.__finished:
+            raise StopIteration
+
+        with self.__condition:
+            while len(self.__items) == 0 and not self.__stopped:
+                self.__condition.wait()
+
+            if self.__stopped:
+                self.__finished = True
+                raise StopIteration
+
+            item = self.__items.popleft()
+            self.__condition.notify_all()
+
+        if item is BackgroundGenerator.__END_OF_ITEMS:
+            self.__finished = True
+            raise StopIteration
+
+        if isinstance(item, BackgroundGenerator.__ProducerFailure):
+            self.__finished = True
+            raise item.exception
+
+        return item
+
+    def next(self):
+        return self.__next__()
+
+    # Stops the producer early, i.e. when the consumer is abandoned part way through
+    def close(self):
+        with self.__condition:
+            self.__finished = True
+            self.__stopped = True
+            discarded_items = list(self.__items)
+            self.__items.clear()
+            self.__condition.notify_all()
+
+        self.__discard(discarded_items)
+
+    # Waits for the producer thread to finish; returns whether it did within the timeout
+    def join(self, timeout_seconds: float = None) -> bool:
+        self.__thread.join(timeout_seconds)
+        return not self.__thread.is_alive()
+
+    def __produce(self, source_iterable):
+        try:
+            for item in source_iterable:
+                if not self.__put(item):
+                    return
+        except BaseException as exception:
+            self.__put(BackgroundGenerator.__ProducerFailure(exception))
+            return
+
+        self.__put(BackgroundGenerator.__END_OF_ITEMS)
+
+    def __put(self, item) -> bool:
+        with self.__condition:
+            while len(self.__items) >= self.__max_queue_size and not self.__stopped:
+                self.__condition.wait()
+
+            if not self.__stopped:
+                self.__items.append(item)
+                self.__condition.notify_all()
+                return True
+
+        self.__discard([item])
+        return False
+
+    def __discard(self, items: []):
+        if self.__discard_callback is None:
+            return
+
+        for item in items:
+            if item is not BackgroundGenerator.__END_OF_ITEMS and not isinstance(item, BackgroundGenerator.__ProducerFailure):
+                self.__discard_callback(item)